@@ -6,123 +6,314 @@
 #$ -e /mnt/munin2/Badea/Lab/mouse/sinha_sbatch/slurm-$JOB_ID.out
 #$ -N ${1}_LPCA_denoising
 
-import os.path
-from os import path
+"""
+basic_LPCA_denoise.py
+
+dipy denoising of a 4D DWI (local PCA unless --method says otherwise):
+
+  python basic_LPCA_denoise.py <id> <dwi.nii.gz> <..._bvals.txt|..._bvecs.txt> <outpath> [options]
+
+writes <outpath>/<PREFIX>_<id>_nii4D.nii.gz (LPCA_, MPPCA_, NLMEANS_, P2S_) and prints a
+timing/quality report: runtime, std of the removed residual and b0 SNR (mean denoised
+b0 signal / residual std) over the mask, or over the voxels above 10% of the 99th
+percentile of the mean b0 without one. The report is kept in the output's manifest and
+shown again when a run is skipped.
+
+Methods:
+  lpca       : localpca with the pca_noise_estimate noise map (kept in a sidecar and
+               reused across runs, see --sigma)
+  mppca      : Marchenko-Pastur PCA, the noise level is estimated per patch
+  nlmeans    : non-local means with per-volume sigma from estimate_sigma (N=0)
+  patch2self : self-supervised regression across volumes, OLS (needs scikit-learn)
+lpca and mppca run block-parallel in --workers processes (identical output for any
+count) and --pca-method eig is faster than svd on high-direction data; nlmeans runs
+--workers threads.
+
+Array tasks mostly start, find their output up to date and exit: module level only
+imports the standard library, and numpy/dipy are imported on the path that needs them
+(the result-cache check runs before any of it). `python lpca_benchmark.py startup`
+measures this.
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import os
 import sys
+from time import time
+
+from result_cache import ResultCache
 
-#runno=sys.argv[1] # switching to more generic "id"
-id=sys.argv[1]
-fdwi=sys.argv[2]
-#bval_folder=sys.argv[3] # Need to have gtab handling that 1: takes in a single value, & 2: supports DSI Studio btables
-# However, for now we'll stick with the bval/bvec pair to keep things moving forward.
-bval_or_bvec_or_btable=sys.argv[3]
-outpath=sys.argv[4]
 #find other pointers@
 #https://github.com/nipy/nipype/blob/fbf2c35f533b7805ca93c742006472e0809d8d03/nipype/workflows/dmri/mrtrix/diffusion.py
 #to do: coreg/eddy correction/bias field (if not part of denoising already)
 #https://github.com/nipy/dipy/blob/349e6b181ac89f333f07146751a2295b732b5c04/scratch/very_scratch/registration_example.py
 
-from time import time
-import numpy as np
-from dipy.io.image import load_nifti, save_nifti
-from dipy.io.gradients import read_bvals_bvecs
-from dipy.core.gradients import gradient_table
-from dipy.reconst.shm import CsaOdfModel
-import nibabel as nib
-from nibabel.streamlines import Field
-from nibabel.orientations import aff2axcodes
-from dipy.workflows.denoise import NLMeansFlow
-from dipy.denoise.denspeed import nlmeans_3d
-from dipy.denoise.localpca import localpca
-from dipy.denoise.pca_noise_estimate import pca_noise_estimate
-from dipy.denoise.non_local_means import non_local_means
-from dipy.denoise.adaptive_soft_matching import adaptive_soft_matching
-from dipy.denoise.nlmeans import nlmeans
-from dipy.denoise.noise_estimate import estimate_sigma
-from dipy.segment.mask import median_otsu
-import matplotlib.pyplot as plt
-from time import time
-from dipy.segment.mask import median_otsu
-from dipy.tracking.utils import random_seeds_from_mask
-from nibabel.streamlines import save as save_trk
-from nibabel.streamlines import Tractogram
-from dipy.data import get_sphere
-from dipy.direction import peaks_from_model
-from dipy.tracking.streamline import Streamlines
-
-from dipy.io.streamline import save_trk
-
-
-np.seterr(divide='ignore', invalid='ignore')
-
-print(id)
-
-t1 = time()
-
-#fbval=bval_folder + runno + '_fsl_bvals.txt' 
-#fbvec=bval_folder + runno + '_fsl_bvecs.txt'
-
-# The following shenanigans should allow us to specify EITHER the bval OR the bvec file.
-# It is assuming that the both have the same prefix, with the exeception of ending in bvecs.txt or bvals.txt
-
-# 
-fbval=bval_or_bvec_or_btable.replace("bvecs.txt","bvals.txt")
-fbvec=fbval.replace("bvals.txt","bvecs.txt")
-
-bvals, bvecs = read_bvals_bvecs(fbval, fbvec)
-
-    
-print(f'b values {bvals}')
-print(f'b vecs {bvecs}')
-    
-
-gtab = gradient_table(bvals, bvecs)
-
-# Currently need to run over pre-masked data.
-no_masking=1
-if no_masking:
-   # masked_path=outpath + id + '_nii4D_masked.nii.gz'
-    masked_path=fdwi
-    if path.exists(masked_path):
-        maskdata, affine, vox_size = load_nifti(masked_path, return_voxsize=True)
-else:
-    data, affine, vox_size = load_nifti(fdwi, return_voxsize=True)
-    idx = bvals > 10
-    print(f'non zero b values {bvals[idx]}')
-    #mask1 = data[..., 0] > 0
-    #maskdata, mask = median_otsu(data, 3, 1, True, dilate=2)
-    maskdata, mask = median_otsu(data, idx,  3, 1, False, dilate=2)
-    
-    #mask_img = nib.Nifti1Image(maskdata.astype(np.int16), affine)
-    #nib.save(mask_img, 'tensor_fa.nii.gz')
-    # masked_path=outpath+runno+'_nii4D_masked.nii.gz'
-    save_nifti(masked_path, maskdata, affine)
-    mask_path=outpath + id +'_mask.nii.gz'
-    save_nifti(mask_path, mask.astype(np.ubyte), affine)
-        
-data=maskdata
-
-from dipy.reconst.dti import TensorModel
-
-duration1 = time() - t1
-        
-# print('BIAC006'+' DTI duration %.3f' % (duration1,))
-
-lpca_path=outpath+'/LPCA_' + id + '_nii4D.nii.gz'
-if path.exists(lpca_path):
-    print('File already exists; Skipping LPCA denoising (path: ' + lpca_path + ')' )
-else:
-    print('Beginning LPCA denoising for: '+ id + '.  (Expected result: ' + lpca_path + ')' )
+SIGMA_OPTS = {'correct_bias': True, 'smooth': 1}
+OTSU_OPTS = {'median_radius': 3, 'numpass': 1, 'dilate': 2}
+P2S_OPTS = {'model': 'ols', 'b0_threshold': 50}
+B0_THRESHOLD = 50
+
+# output prefix, default patch radius and default pca_method per --method
+METHODS = {
+    'lpca': ('LPCA', 2, 'svd'),
+    'mppca': ('MPPCA', 2, 'eig'),
+    'nlmeans': ('NLMEANS', 1, None),
+    'patch2self': ('P2S', 0, None),
+}
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Denoising of a 4D DWI (dipy localpca, mppca, nlmeans or patch2self).")
+    ap.add_argument("id")
+    ap.add_argument("fdwi", help="4D DWI NIfTI")
+    #bval_folder=sys.argv[3] # Need to have gtab handling that 1: takes in a single value, & 2: supports DSI Studio btables
+    # However, for now we'll stick with the bval/bvec pair to keep things moving forward.
+    ap.add_argument("bval_or_bvec", help="*bvals.txt or *bvecs.txt (the other one is found by name)")
+    ap.add_argument("outpath", help="Output folder; writes <PREFIX>_<id>_nii4D.nii.gz")
+    ap.add_argument("--method", choices=list(METHODS), default="lpca")
+    ap.add_argument("--workers", type=int, default=int(os.environ.get("NSLOTS", "1")),
+                    help="Processes for block-parallel lpca/mppca, threads for nlmeans (default: $NSLOTS or 1); the result does not depend on it")
+    ap.add_argument("--block", type=int, default=None, help="lpca/mppca block core edge in voxels (default: auto)")
+    ap.add_argument("--patch-radius", type=int, default=None, help="Default: 2 for lpca/mppca, 1 for nlmeans, 0 for patch2self")
+    ap.add_argument("--pca-method", choices=["svd", "eig"], default=None,
+                    help="lpca/mppca decomposition (default: svd for lpca, eig for mppca); eig is faster with many directions")
+    ap.add_argument("--tau-factor", type=float, default=2.3, help="lpca threshold factor")
+    ap.add_argument("--sigma", default=None,
+                    help="lpca noise map sidecar (default: <outpath>/LPCA_<id>_sigma.nii.gz); reused while the DWI and gradient table are unchanged")
+    ap.add_argument("--sigma-only", action="store_true", help="Only compute (or validate) the lpca noise map sidecar, no denoising")
+    masking = ap.add_mutually_exclusive_group()
+    masking.add_argument("--mask", default=None, help="3D brain mask NIfTI (nonzero = brain): denoise only there, 0 outside")
+    masking.add_argument("--auto-mask", action="store_true",
+                         help="Brain mask from median_otsu on the mean DWI (saved as <outpath>/<id>_mask.nii.gz)")
+    args = ap.parse_args(argv)
+    _, radius, pca_method = METHODS[args.method]
+    if args.patch_radius is None:
+        args.patch_radius = radius
+    if args.pca_method is None:
+        args.pca_method = pca_method or 'svd'
+    return args
+
+
+def gradient_files(bval_or_bvec):
+    # The following shenanigans should allow us to specify EITHER the bval OR the bvec file.
+    # It is assuming that the both have the same prefix, with the exeception of ending in bvecs.txt or bvals.txt
+    fbval = bval_or_bvec.replace("bvecs.txt", "bvals.txt")
+    fbvec = fbval.replace("bvals.txt", "bvecs.txt")
+    return fbval, fbvec
+
+
+def gtab_digest(gtab):
+    import numpy as np
+
+    return hashlib.sha256(np.round(gtab.bvals, 3).astype(np.float64).tobytes() + np.round(gtab.bvecs, 6).astype(np.float64).tobytes()).hexdigest()
+
+
+def method_params(args):
+    """Every option that changes the output of args.method (for the result cache)."""
+    params = {'method': args.method, 'patch_radius': args.patch_radius}
+    if args.method == 'lpca':
+        params.update(sigma=SIGMA_OPTS, pca_method=args.pca_method, tau_factor=args.tau_factor)
+    elif args.method == 'mppca':
+        params.update(pca_method=args.pca_method)
+    elif args.method == 'nlmeans':
+        params.update(sigma={'estimator': 'estimate_sigma', 'N': 0}, rician=True)
+    else:
+        params.update(P2S_OPTS)
+    return params
+
+
+def brain_mask(args, data, bvals, affine, mask_path):
+    """
+    Only mask voxels are denoised (0 elsewhere), and for lpca/mppca only the mask's
+    bounding box plus patch_radius is processed; no masked copy of the 4D data is written.
+    """
+    import numpy as np
+    from dipy.io.image import load_nifti, save_nifti
+
+    if args.mask:
+        mask, _ = load_nifti(args.mask)
+        mask = mask > 0
+        if mask.shape != data.shape[:3]:
+            raise SystemExit(f"ERROR: mask shape {mask.shape} does not match DWI shape {data.shape[:3]}")
+        return mask
+    if args.auto_mask:
+        from dipy.segment.mask import median_otsu
+
+        idx = bvals > 10
+        print(f'non zero b values {bvals[idx]}')
+        # median_otsu(data, vol_idx=idx) thresholds the mean of those volumes; pass that mean
+        # directly so that no masked 4D copy is made
+        _, mask = median_otsu(data[..., idx].mean(axis=-1), **OTSU_OPTS)
+        save_nifti(mask_path, mask.astype(np.ubyte), affine)
+        return mask
+    return None
+
+
+def noise_map(sigma_cache, sigma_path, data, gtab, affine):
+    """The sidecar noise map if its manifest is current, else pca_noise_estimate (saved)."""
+    from dipy.io.image import load_nifti, save_nifti
+
     t = time()
-        
-    print(data.shape)
-    data2=data
-    sigma1 = pca_noise_estimate(data2, gtab, correct_bias=True, smooth=1)
+    if sigma_cache.fresh():
+        sigma, _ = load_nifti(sigma_path)
+        print('Reusing noise map ' + sigma_path)
+        return sigma
+    from dipy.denoise.pca_noise_estimate import pca_noise_estimate
+
+    sigma_cache.invalidate()
+    sigma = pca_noise_estimate(data, gtab, **SIGMA_OPTS)
+    save_nifti(sigma_path, sigma, affine)
+    sigma_cache.store([sigma_path])
     print("Sigma estimation time", time() - t)
-    
-    #lpca
+    return sigma
+
+
+def denoise(method, data, bvals, sigma=None, mask=None, patch_radius=None, pca_method=None, tau_factor=2.3, workers=1, block=None):
+    """
+    Run one --method on data. sigma is the lpca noise map (ignored otherwise); outside
+    the mask the result is 0.
+    """
+    _, radius, default_pca = METHODS[method]
+    patch_radius = radius if patch_radius is None else patch_radius
+    if method in ('lpca', 'mppca'):
+        import lpca_parallel
+
+        lpca = method == 'lpca'
+        return lpca_parallel.localpca_parallel(
+            data, sigma if lpca else None, mask=mask, patch_radius=patch_radius, pca_method=pca_method or default_pca,
+            tau_factor=tau_factor if lpca else None, workers=workers, block=block)
+    if method == 'nlmeans':
+        from dipy.denoise.nlmeans import nlmeans
+        from dipy.denoise.noise_estimate import estimate_sigma
+
+        return nlmeans(data, estimate_sigma(data, N=0), mask=mask, patch_radius=patch_radius, rician=True, num_threads=workers)
+    from dipy.denoise.patch2self import patch2self
+
+    den = patch2self(data, bvals, patch_radius=patch_radius, **P2S_OPTS)
+    if mask is not None:
+        den[~mask] = 0
+    return den
+
+
+def quality_report(method, data, den, bvals, mask, seconds):
+    """
+    Runtime, std of the residual data - den and b0 SNR (mean denoised b0 / residual std)
+    over the mask, or the voxels above 10% of the 99th percentile of the mean b0.
+    """
+    import numpy as np
+
+    b0 = bvals <= B0_THRESHOLD
+    if not b0.any():
+        b0 = np.ones_like(b0)
+    if mask is None:
+        ref = data[..., b0].mean(axis=-1)
+        mask = ref > 0.1 * np.percentile(ref, 99)
+    n, s, ss = 0, 0.0, 0.0
+    for v in range(data.shape[-1]):  # one volume at a time: no 4D residual copy
+        r = data[..., v][mask].astype(np.float64) - den[..., v][mask]
+        n, s, ss = n + r.size, s + r.sum(), ss + np.dot(r, r)
+    std = float(np.sqrt(max(ss / n - (s / n) ** 2, 0.0))) if n else float('nan')
+    signal = float(np.mean([den[..., v][mask].mean() for v in np.flatnonzero(b0)])) if n else float('nan')
+    return {
+        'method': method,
+        'seconds': round(seconds, 3),
+        'voxels': int(mask.sum()),
+        'residual_std': std,
+        'snr_b0': signal / std if std > 0 else None,
+    }
+
+
+def print_report(report):
+    snr = report['snr_b0']
+    print(f"Report [{report['method']}]: {report['seconds']:.1f} s, residual std {report['residual_std']:.4g}, "
+          f"b0 SNR {'n/a' if snr is None else f'{snr:.1f}'} over {report['voxels']} voxels")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    id = args.id
+    fdwi = args.fdwi
+    outpath = args.outpath
+    fbval, fbvec = gradient_files(args.bval_or_bvec)
+    print(id)
+    if args.method == 'patch2self' and not args.sigma_only and importlib.util.find_spec('sklearn') is None:
+        raise SystemExit("ERROR: --method patch2self needs scikit-learn")
+
+    import dipy  # version only; dipy loads its submodules lazily
+
+    # Skip (before loading any data) when the manifest next to the output shows the same
+    # inputs, settings, dipy version and code; an output without one is recomputed.
+    out_path = outpath + '/' + METHODS[args.method][0] + '_' + id + '_nii4D.nii.gz'
+    sigma_path = args.sigma or outpath + '/LPCA_' + id + '_sigma.nii.gz'
+    mask_path = outpath + '/' + id + '_mask.nii.gz'
+    mask_mode = {'median_otsu': OTSU_OPTS} if args.auto_mask else ('file' if args.mask else 'none')
+    params = {**method_params(args), 'mask': mask_mode, 'dipy': dipy.__version__}
+    inputs = [fdwi, fbval, fbvec] + ([args.mask] if args.mask else [])
+    code = [__file__, importlib.util.find_spec("lpca_parallel").origin]
+    cache = ResultCache(out_path, 'stat', inputs, params, code)
+    if not args.sigma_only:
+        # The --auto-mask file is shared by every --method run of this id, so it is not
+        # one of this method's outputs (each rewrite would invalidate the others): its
+        # content is covered by the DWI input and OTSU_OPTS, only its presence is checked
+        if cache.fresh() and (not args.auto_mask or os.path.exists(mask_path)):
+            print('Output is up to date; Skipping ' + args.method + ' denoising (path: ' + out_path + ')')
+            if cache.result:
+                print_report(cache.result)
+            return 0
+        cache.invalidate()
+
+    import numpy as np
+    from dipy.core.gradients import gradient_table
+    from dipy.io.gradients import read_bvals_bvecs
+    from dipy.io.image import load_nifti, save_nifti
+
+    import lpca_parallel
+
+    np.seterr(divide='ignore', invalid='ignore')
+
+    bvals, bvecs = read_bvals_bvecs(fbval, fbvec)
+    print(f'b values {bvals}')
+    print(f'b vecs {bvecs}')
+    gtab = gradient_table(bvals, bvecs=bvecs)
+
+    # The noise map only depends on the DWI, the gradient table and the estimator settings,
+    # not on patch_radius/tau_factor: it is kept in a sidecar whose manifest records the DWI's
+    # sha256 and a digest of the gradient table, and reused until one of them changes.
+    sigma_cache = None
+    if args.method == 'lpca' or args.sigma_only:
+        sigma_params = {'estimator': 'pca_noise_estimate', **SIGMA_OPTS, 'gtab': gtab_digest(gtab), 'b0_threshold': gtab.b0_threshold, 'dipy': dipy.__version__}
+        sigma_cache = ResultCache(sigma_path, 'hash', [fdwi], sigma_params, [])
+        if args.sigma_only and sigma_cache.fresh():
+            print('Noise map is up to date (path: ' + sigma_path + ')')
+            return 0
+
+    data, affine = load_nifti(fdwi)
+    print(data.shape)
+    sigma = noise_map(sigma_cache, sigma_path, data, gtab, affine) if sigma_cache else None
+    if args.sigma_only:
+        return 0
+
+    mask = brain_mask(args, data, bvals, affine, mask_path)
+    if mask is not None:
+        box = lpca_parallel.mask_bbox(mask, lpca_parallel.patch_radius_3d(args.patch_radius))
+        box_frac = 0 if box is None else np.prod([b.stop - b.start for b in box]) / np.prod(mask.shape)
+        print(f'Mask: {int(mask.sum())} voxels, bounding box {100 * box_frac:.0f}% of the FOV')
+
+    # lpca/mppca are block-parallel and identical to dipy's localpca/mppca on the whole volume
+    print('Beginning ' + args.method + ' denoising for: ' + id + '.  (Expected result: ' + out_path + ')')
     t = time()
-    denoised_arr = localpca(data2, sigma=sigma1, patch_radius=2,pca_method='svd', tau_factor=2.3)
-    save_nifti(lpca_path, denoised_arr, affine)
-    print("Time taken for local PCA denoising", -t + time())
+    print(f'Workers: {args.workers}')
+    denoised_arr = denoise(args.method, data, bvals, sigma=sigma, mask=mask, patch_radius=args.patch_radius, pca_method=args.pca_method,
+                           tau_factor=args.tau_factor, workers=args.workers, block=args.block)
+    seconds = time() - t
+    save_nifti(out_path, denoised_arr, affine)
+    report = quality_report(args.method, data, denoised_arr, bvals, mask, seconds)
+    cache.store([out_path], result=report)
+    print("Time taken for " + args.method + " denoising", seconds)
+    print_report(report)
+    return 0
+
 
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+fake_sbatch.py
+
+Local stand-in for sbatch, to exercise the submitters without a cluster:
+
+  python submit_simple_n4_slurm.py ... --sbatch_path ./fake_sbatch.py
+
+Prints a new job id ("<id>" with --parsable, else "Submitted batch job <id>") and
+appends one JSON line per call (job id, arguments, script name) to
+$FAKE_SBATCH_DIR/submissions.jsonl. Nothing is run.
+
+Environment:
+  FAKE_SBATCH_DIR   state folder (job counter + log), default /tmp/fake_sbatch
+  FAKE_SBATCH_DELAY seconds each call takes, like a busy controller (default 0.2)
+  FAKE_SBATCH_FAIL  probability that a call fails with a transient controller error (default 0)
+"""
+
+import fcntl
+import json
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+
+def main() -> int:
+    state = Path(os.environ.get("FAKE_SBATCH_DIR", "/tmp/fake_sbatch"))
+    state.mkdir(parents=True, exist_ok=True)
+    time.sleep(float(os.environ.get("FAKE_SBATCH_DELAY", "0.2")))
+
+    if random.random() < float(os.environ.get("FAKE_SBATCH_FAIL", "0")):
+        print("sbatch: error: Batch job submission failed: Socket timed out on send/recv operation", file=sys.stderr)
+        return 1
+
+    args = sys.argv[1:]
+    script = args[-1] if args else None  # sbatch [options] script
+    if script is None or not Path(script).is_file():
+        print(f"sbatch: error: Unable to open file {script}", file=sys.stderr)
+        return 1
+
+    with open(state / "counter", "a+", encoding="utf-8") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        job_id = int(f.read().strip() or "1000") + 1
+        f.seek(0)
+        f.truncate()
+        f.write(str(job_id))
+        with open(state / "submissions.jsonl", "a", encoding="utf-8") as log:
+            log.write(json.dumps({"job_id": job_id, "args": args, "script": Path(script).name}) + "\n")
+
+    print(job_id if "--parsable" in args else f"Submitted batch job {job_id}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+lpca_benchmark.py
+
+Timing harness for the LPCA denoising used by basic_LPCA_denoise.py.
+
+Usage:
+  # wall clock of block-parallel localpca vs the monolithic dipy call on a synthetic DWI
+  python lpca_benchmark.py workers --shape 64 64 32 --n-dirs 30 --workers 1 2 4 8
+
+  # same on a real DWI (sigma from pca_noise_estimate, as in basic_LPCA_denoise.py)
+  python lpca_benchmark.py workers --dwi dwi.nii.gz --bvals id_bvals.txt --workers 4 8 16
+
+  # full FOV vs masked (mask bounding box only) denoising
+  python lpca_benchmark.py mask --shape 64 64 32 --n-dirs 30
+  python lpca_benchmark.py mask --dwi dwi.nii.gz --bvals id_bvals.txt --mask mask.nii.gz --workers 8
+
+  # runtime, residual std, b0 SNR and RMSE against the truth for each --method choice
+  python lpca_benchmark.py methods --shape 64 64 32 --n-dirs 60 --workers 8
+
+  # start-up cost of basic_LPCA_denoise.py (python -X importtime): its former import block,
+  # the module import, and a whole run that finds its output up to date (the cache-hit skip);
+  # exits non-zero when that run's imports exceed the target
+  python lpca_benchmark.py startup --target-ms 150
+
+Synthetic DWIs are a mono-exponential decay S0 * exp(-b * D(dir)) with a smooth diffusivity
+field inside an ellipsoid, zero background and additive Gaussian noise of known sigma.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from typing import List, Tuple
+
+import numpy as np
+
+from lpca_parallel import available_cpus, localpca_parallel, mask_bbox, patch_radius_3d
+
+
+def synthetic_dwi(
+    shape: Tuple[int, int, int],
+    n_dirs: int,
+    noise: float = 20.0,
+    seed: int = 0,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (float64 4D DWI, sigma map) with one b0 and n_dirs b=3000 directions."""
+    clean = synthetic_dwi_clean(shape, n_dirs, seed)
+    rng = np.random.default_rng(seed + 1)
+    return clean + noise * rng.standard_normal(clean.shape), np.full(shape, noise)
+
+
+def synthetic_dwi_clean(shape: Tuple[int, int, int], n_dirs: int, seed: int = 0) -> np.ndarray:
+    """Noise-free float64 4D DWI: one b0, then n_dirs b=3000 directions."""
+    rng = np.random.default_rng(seed)
+    grids = np.meshgrid(*[np.linspace(-1, 1, s) for s in shape], indexing="ij")
+    r2 = sum(g * g for g in grids)
+    inside = r2 < 0.85
+    dirs = rng.standard_normal((n_dirs, 3))
+    dirs /= np.linalg.norm(dirs, axis=1, keepdims=True)
+
+    S0 = np.where(inside, 1000.0, 0.0)
+    vols = [S0]
+    for d in dirs:
+        # anisotropic diffusivity (mm^2/s) varying smoothly across the ellipsoid
+        D = 0.4e-3 + 0.3e-3 * (1 - r2) * (1 + np.abs(sum(g * c for g, c in zip(grids, d))))
+        vols.append(S0 * np.exp(-3000.0 * D))
+    return np.stack(vols, axis=-1)
+
+
+def load_dwi(dwi_path: str, bvals_path: str) -> Tuple[np.ndarray, np.ndarray]:
+    from dipy.core.gradients import gradient_table
+    from dipy.denoise.pca_noise_estimate import pca_noise_estimate
+    from dipy.io.gradients import read_bvals_bvecs
+    from dipy.io.image import load_nifti
+
+    fbval = bvals_path.replace("bvecs.txt", "bvals.txt")
+    bvals, bvecs = read_bvals_bvecs(fbval, fbval.replace("bvals.txt", "bvecs.txt"))
+    data, _ = load_nifti(dwi_path)
+    t0 = time.perf_counter()
+    sigma = pca_noise_estimate(data, gradient_table(bvals, bvecs), correct_bias=True, smooth=1)
+    print(f"sigma estimation: {time.perf_counter() - t0:.2f} s")
+    return data, sigma
+
+
+def print_table(title: str, rows: List[Tuple[str, float]], ref: float) -> None:
+    # Same layout as vfa_benchmark.py; not imported from there, which loads the whole VFA stack
+    print(f"--- {title} ---")
+    for label, t in rows:
+        print(f"  {label:>12s} : {t:8.3f} s   x{ref / t:5.2f}")
+
+
+def bench_workers(args) -> None:
+    if args.dwi:
+        data, sigma = load_dwi(args.dwi, args.bvals)
+    else:
+        data, sigma = synthetic_dwi(tuple(args.shape), args.n_dirs)
+    print(f"shape={data.shape} patch_radius={args.patch_radius} pca={args.pca_method} cpus={available_cpus()}")
+    opts = dict(patch_radius=args.patch_radius, pca_method=args.pca_method, tau_factor=2.3)
+
+    ref = None
+    if not args.no_reference:
+        from dipy.denoise.localpca import localpca
+
+        t0 = time.perf_counter()
+        ref = localpca(data, sigma=sigma, **opts)
+        t_ref = time.perf_counter() - t0
+        print(f"monolithic localpca: {t_ref:.2f} s")
+
+    rows = []
+    for w in args.workers:
+        t0 = time.perf_counter()
+        out = localpca_parallel(data, sigma, workers=w, block=args.block, **opts)
+        t = time.perf_counter() - t0
+        label = f"workers={w}"
+        if ref is not None:
+            same = np.array_equal(out, ref, equal_nan=True)
+            print(f"  {label}: {'identical' if same else f'max |diff| {np.nanmax(np.abs(out - ref)):.3g}'}")
+        rows.append((label, t))
+    print_table("block-parallel localpca", rows, t_ref if ref is not None else rows[0][1])
+
+
+def bench_mask(args) -> None:
+    if args.dwi:
+        data, sigma = load_dwi(args.dwi, args.bvals)
+    else:
+        data, sigma = synthetic_dwi(tuple(args.shape), args.n_dirs)
+    if args.mask:
+        from dipy.io.image import load_nifti
+
+        mask = load_nifti(args.mask)[0] > 0
+    else:
+        # the synthetic ellipsoid, or the signal-bearing voxels of the b0 of a real DWI
+        mask = data[..., 0] > 0.5 * np.percentile(data[..., 0], 99)
+    box = mask_bbox(mask, patch_radius_3d(args.patch_radius))
+    box_frac = np.prod([b.stop - b.start for b in box]) / mask.size
+    print(f"shape={data.shape} mask={100 * mask.mean():.0f}% of the FOV, bounding box {100 * box_frac:.0f}% workers={args.workers}")
+    opts = dict(patch_radius=args.patch_radius, pca_method=args.pca_method, tau_factor=2.3, workers=args.workers)
+
+    rows = []
+    t0 = time.perf_counter()
+    localpca_parallel(data, sigma, **opts)
+    rows.append(("full FOV", time.perf_counter() - t0))
+    t0 = time.perf_counter()
+    localpca_parallel(data, sigma, mask=mask, **opts)
+    rows.append(("masked", time.perf_counter() - t0))
+    print_table("localpca, full FOV vs mask bounding box", rows, rows[0][1])
+
+
+def bench_methods(args) -> None:
+    from importlib.util import find_spec
+
+    from basic_LPCA_denoise import denoise, quality_report
+
+    clean = synthetic_dwi_clean(tuple(args.shape), args.n_dirs)
+    rng = np.random.default_rng(1)
+    data = clean + args.noise * rng.standard_normal(clean.shape)
+    sigma = np.full(clean.shape[:3], float(args.noise))
+    bvals = np.r_[0.0, np.full(args.n_dirs, 3000.0)]
+    inside = clean[..., 0] > 0
+    print(f"shape={data.shape} noise sigma={args.noise:g} workers={args.workers} (RMSE against the noise-free DWI, inside the phantom)")
+
+    rows = []
+    for spec in args.methods:
+        method, _, pca_method = spec.partition("/")
+        if method == "patch2self" and find_spec("sklearn") is None:
+            print(f"  {spec:>12s} : skipped (needs scikit-learn)")
+            continue
+        t0 = time.perf_counter()
+        den = denoise(method, data, bvals, sigma=sigma, pca_method=pca_method or None, workers=args.workers)
+        t = time.perf_counter() - t0
+        report = quality_report(method, data, den, bvals, None, t)
+        rmse = np.sqrt(np.mean((den[inside] - clean[inside]) ** 2))
+        print(f"  {spec:>12s} : {t:8.3f} s   residual std {report['residual_std']:7.2f}   b0 SNR {report['snr_b0']:6.1f}   RMSE {rmse:7.2f}")
+        rows.append((spec, t))
+    if rows:
+        print_table("denoising methods", rows, rows[0][1])
+
+
+# -------------------------
+# Reference: the module-level imports of basic_LPCA_denoise.py before it had a main()
+# -------------------------
+
+LEGACY_IMPORTS = [
+    "from time import time",
+    "import numpy as np",
+    "from dipy.io.image import load_nifti, save_nifti",
+    "from dipy.io.gradients import read_bvals_bvecs",
+    "from dipy.core.gradients import gradient_table",
+    "from dipy.reconst.shm import CsaOdfModel",
+    "import nibabel as nib",
+    "from nibabel.streamlines import Field",
+    "from nibabel.orientations import aff2axcodes",
+    "from dipy.workflows.denoise import NLMeansFlow",
+    "from dipy.denoise.denspeed import nlmeans_3d",
+    "from dipy.denoise.localpca import localpca",
+    "from dipy.denoise.pca_noise_estimate import pca_noise_estimate",
+    "from dipy.denoise.non_local_means import non_local_means",
+    "from dipy.denoise.adaptive_soft_matching import adaptive_soft_matching",
+    "from dipy.denoise.nlmeans import nlmeans",
+    "from dipy.denoise.noise_estimate import estimate_sigma",
+    "from dipy.segment.mask import median_otsu",
+    "import matplotlib.pyplot as plt",
+    "from dipy.tracking.utils import random_seeds_from_mask",
+    "from nibabel.streamlines import save as save_trk",
+    "from nibabel.streamlines import Tractogram",
+    "from dipy.data import get_sphere",
+    "from dipy.direction import peaks_from_model",
+    "from dipy.tracking.streamline import Streamlines",
+    "from dipy.io.streamline import save_trk",
+    "import dipy",
+]
+
+
+def import_profile(code: str, repeats: int) -> Tuple[float, float, List[Tuple[float, str]]]:
+    """
+    Best of repeats runs of python -X importtime -c code (in this folder):
+    (wall s incl. interpreter start, summed import s, [(self s, module)] sorted slowest first).
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=here, capture_output=True, text=True)
+        wall = time.perf_counter() - t0
+        if proc.returncode != 0:
+            raise SystemExit(f"ERROR: import failed:\n{proc.stderr[-2000:]}")
+        mods = []
+        for line in proc.stderr.splitlines():
+            if line.startswith("import time:") and "|" in line:
+                self_us, _, name = line[len("import time:"):].split("|")
+                if self_us.strip().isdigit():
+                    mods.append((int(self_us) * 1e-6, name.strip()))
+        total = sum(t for t, _ in mods)
+        if best is None or total < best[1]:
+            best = (wall, total, sorted(mods, reverse=True))
+    return best
+
+
+def write_synthetic_case(folder: str, shape: Tuple[int, int, int] = (12, 12, 8), n_dirs: int = 12) -> List[str]:
+    """Small synthetic DWI with bvals/bvecs files in folder; returns the basic_LPCA_denoise.py arguments."""
+    import nibabel as nib
+
+    data, _ = synthetic_dwi(shape, n_dirs)
+    dirs = np.random.default_rng(0).standard_normal((n_dirs, 3))
+    bvecs = np.vstack([np.zeros(3), dirs / np.linalg.norm(dirs, axis=1, keepdims=True)])
+    bvals = np.r_[0.0, np.full(n_dirs, 3000.0)]
+    dwi = os.path.join(folder, "dwi.nii.gz")
+    nib.save(nib.Nifti1Image(data.astype(np.float32), np.eye(4)), dwi)
+    np.savetxt(os.path.join(folder, "bench_bvals.txt"), bvals[None], fmt="%g")
+    np.savetxt(os.path.join(folder, "bench_bvecs.txt"), bvecs.T, fmt="%.6f")
+    out = os.path.join(folder, "out")
+    os.makedirs(out, exist_ok=True)
+    return ["bench", dwi, os.path.join(folder, "bench_bvals.txt"), out]
+
+
+def bench_startup(args) -> None:
+    legacy = "\n".join(f"try:\n    {line}\nexcept Exception:\n    pass" for line in LEGACY_IMPORTS)
+    with tempfile.TemporaryDirectory() as folder:
+        argv = write_synthetic_case(folder)
+        run = f"import sys\nimport basic_LPCA_denoise\nsys.exit(basic_LPCA_denoise.main({argv!r}))"
+        # first run denoises and writes the manifest; the profiled runs then take the skip path
+        here = os.path.dirname(os.path.abspath(__file__))
+        proc = subprocess.run([sys.executable, "-c", run], cwd=here, capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise SystemExit(f"ERROR: basic_LPCA_denoise.py failed on the synthetic case:\n{proc.stderr[-2000:]}")
+
+        rows = []
+        for label, code in [("former imports", legacy), ("module import", "import basic_LPCA_denoise"),
+                            ("up-to-date run", run)]:
+            wall, total, mods = import_profile(code, args.repeats)
+            print(f"{label}: {total * 1e3:.1f} ms in {len(mods)} imports, {wall * 1e3:.0f} ms wall with interpreter start")
+            for t, name in mods[: args.top]:
+                print(f"    {t * 1e3:7.1f} ms  {name}")
+            rows.append((label, total))
+    print_table("import time", rows, rows[0][1])
+    if rows[-1][1] * 1e3 > args.target_ms:
+        raise SystemExit(f"ERROR: an up-to-date basic_LPCA_denoise.py run imported for {rows[-1][1] * 1e3:.1f} ms "
+                         f"(target {args.target_ms:g} ms)")
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Benchmarks for LPCA denoising.")
+    sub = ap.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("workers", help="Process scaling of block-parallel localpca vs the monolithic call")
+    p.add_argument("--shape", nargs=3, type=int, default=[48, 48, 24])
+    p.add_argument("--n-dirs", type=int, default=30, help="Diffusion directions of the synthetic DWI (plus one b0)")
+    p.add_argument("--dwi", help="Use this 4D NIfTI instead of synthetic data")
+    p.add_argument("--bvals", help="bvals (or bvecs) file of --dwi, named *bvals.txt / *bvecs.txt")
+    p.add_argument("--patch-radius", type=int, default=2)
+    p.add_argument("--pca-method", choices=["svd", "eig"], default="svd")
+    p.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4, 8])
+    p.add_argument("--block", type=int, default=None, help="Block core edge in voxels (default: auto)")
+    p.add_argument("--no-reference", action="store_true", help="Skip the monolithic run (and the identity check)")
+    p.set_defaults(func=bench_workers)
+
+    p = sub.add_parser("mask", help="Full FOV vs masked (bounding box) denoising")
+    p.add_argument("--shape", nargs=3, type=int, default=[48, 48, 24])
+    p.add_argument("--n-dirs", type=int, default=30, help="Diffusion directions of the synthetic DWI (plus one b0)")
+    p.add_argument("--dwi", help="Use this 4D NIfTI instead of synthetic data")
+    p.add_argument("--bvals", help="bvals (or bvecs) file of --dwi, named *bvals.txt / *bvecs.txt")
+    p.add_argument("--mask", help="3D mask NIfTI (default: thresholded b0)")
+    p.add_argument("--patch-radius", type=int, default=2)
+    p.add_argument("--pca-method", choices=["svd", "eig"], default="svd")
+    p.add_argument("--workers", type=int, default=1)
+    p.set_defaults(func=bench_mask)
+
+    p = sub.add_parser("methods", help="Runtime and quality of the basic_LPCA_denoise.py --method choices")
+    p.add_argument("--shape", nargs=3, type=int, default=[48, 48, 24])
+    p.add_argument("--n-dirs", type=int, default=30, help="Diffusion directions of the synthetic DWI (plus one b0)")
+    p.add_argument("--noise", type=float, default=20.0, help="Gaussian noise std (b0 signal is 1000)")
+    p.add_argument("--methods", nargs="+", default=["lpca/svd", "lpca/eig", "mppca/eig", "mppca/svd", "nlmeans", "patch2self"],
+                   help="method[/pca_method]")
+    p.add_argument("--workers", type=int, default=1)
+    p.set_defaults(func=bench_methods)
+
+    p = sub.add_parser("startup", help="Import time of an up-to-date basic_LPCA_denoise.py run vs its former import block")
+    p.add_argument("--target-ms", type=float, default=150.0, help="Fail when the up-to-date run imports for longer")
+    p.add_argument("--repeats", type=int, default=3)
+    p.add_argument("--top", type=int, default=5, help="Slowest modules to list")
+    p.set_defaults(func=bench_startup)
+
+    args = ap.parse_args()
+    if getattr(args, "dwi", None) and not args.bvals:
+        raise SystemExit("ERROR: --dwi needs --bvals")
+    return args
+
+
+def main():
+    warnings.simplefilter("ignore", UserWarning)  # dipy's patch-size advice, once per block
+    np.seterr(divide="ignore", invalid="ignore")  # as in basic_LPCA_denoise.py (theta = 0 at uncovered mask edges)
+    args = parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+result_cache.py
+
+Sidecar manifests that let the processing scripts skip outputs whose inputs, options
+and code have not changed (vfa_t1map_multi.py / vfa_t1map_2fa.py with --cache,
+basic_LPCA_denoise.py always).
+
+After a successful run, <out stem>.manifest.json next to the main output records:
+  - inputs : per file size and mtime_ns, plus sha256 in "hash" mode
+  - params : resolved acquisition values (TR/FAs, ...) and every option that changes
+             the result
+  - code   : sha256 of the source files that produced the output
+  - outputs: size and mtime_ns of every file written
+  - result : the run's summary, so that a skipped run can still report it
+A re-run is skipped when all of these match and the outputs are untouched; anything
+else recomputes (the old manifest is removed first, so an interrupted run never
+leaves a manifest vouching for a half-written output).
+
+Modes:
+  stat : inputs compare by size + mtime (a stat per file, milliseconds)
+  hash : inputs compare by size + sha256, so touched/copied but identical files still
+         hit; a recorded hash is reused while the file's size and mtime are unchanged,
+         so only modified files are re-read
+"""
+
+import functools
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List, Optional
+
+CACHE_MODES = ("off", "stat", "hash")
+MANIFEST_VERSION = 1
+
+
+def manifest_path(out_path: str) -> str:
+    """foo_T1.nii.gz -> foo_T1.manifest.json (same folder)."""
+    for ext in (".nii.gz", ".nii"):
+        if out_path.endswith(ext):
+            return out_path[: -len(ext)] + ".manifest.json"
+    return out_path + ".manifest.json"
+
+
+def file_sha256(path: str, chunk: int = 1 << 22) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _source_sha256(path: str) -> str:
+    return file_sha256(path)
+
+
+def code_digest(paths: Iterable[str]) -> str:
+    """sha256 over the given source files (hashed once per process)."""
+    h = hashlib.sha256()
+    for p in sorted(os.path.abspath(p) for p in paths):
+        h.update(os.path.basename(p).encode())
+        h.update(_source_sha256(p).encode())
+    return h.hexdigest()
+
+
+def _stat(path: str) -> Dict[str, int]:
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def fingerprint(paths: Iterable[str], mode: str, known: Optional[Dict[str, Dict]] = None) -> Dict[str, Dict]:
+    """
+    abspath -> {"size", "mtime_ns"[, "sha256"]}. In "hash" mode the sha256 from known
+    (a previous fingerprint) is reused for files whose size and mtime still match.
+    """
+    known = known or {}
+    out = {}
+    for p in paths:
+        p = os.path.abspath(p)
+        fp = _stat(p)
+        if mode == "hash":
+            prev = known.get(p) or {}
+            same = prev.get("size") == fp["size"] and prev.get("mtime_ns") == fp["mtime_ns"]
+            fp["sha256"] = prev["sha256"] if same and "sha256" in prev else file_sha256(p)
+        out[p] = fp
+    return out
+
+
+def _same_files(a: Dict[str, Dict], b: Dict[str, Dict], fields) -> bool:
+    return a.keys() == b.keys() and all(
+        all(a[p].get(f) == b[p].get(f) for f in fields) for p in a
+    )
+
+
+def _jsonable(obj):
+    return json.loads(json.dumps(obj))
+
+
+class ResultCache:
+    """
+    Manifest check/store for one output. Usage:
+
+        cache = ResultCache(out, "stat", inputs=[...], params={...}, code=[__file__, ...])
+        if cache.fresh():
+            return cache.result
+        cache.invalidate()
+        ... compute and write outputs ...
+        cache.store([out, ...], result={...})
+
+    Input fingerprints are taken at construction, i.e. before the computation reads
+    them: an input modified while the run is in progress is seen as changed next time.
+    """
+
+    def __init__(self, out_path: str, mode: str, inputs: List[str], params: Dict[str, object], code: List[str]):
+        if mode not in CACHE_MODES or mode == "off":
+            raise ValueError(f"Unsupported cache mode: {mode}")
+        self.path = manifest_path(out_path)
+        self.mode = mode
+        self.prev = self._load()
+        self.inputs = fingerprint(inputs, mode, self.prev.get("inputs") if self.prev else None)
+        self.params = _jsonable(params)
+        self.code = code_digest(code)
+        self.result: Optional[Dict[str, object]] = None
+
+    def _load(self) -> Optional[Dict[str, object]]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                m = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return m if isinstance(m, dict) and m.get("version") == MANIFEST_VERSION else None
+
+    def fresh(self) -> bool:
+        """True if the recorded run used the same inputs, params and code and its outputs are untouched."""
+        m = self.prev
+        if m is None or m.get("mode") != self.mode or m.get("params") != self.params or m.get("code") != self.code:
+            return False
+        fields = ("size", "sha256") if self.mode == "hash" else ("size", "mtime_ns")
+        if not _same_files(m.get("inputs", {}), self.inputs, fields):
+            return False
+        outputs = m.get("outputs", {})
+        try:
+            if not outputs or fingerprint(outputs, "stat") != outputs:
+                return False
+        except OSError:
+            return False
+        self.result = m.get("result")
+        return True
+
+    def invalidate(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def store(self, outputs: List[str], result: Optional[Dict[str, object]] = None) -> None:
+        """Record a successful run (call after every output has been written)."""
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "mode": self.mode,
+            "inputs": self.inputs,
+            "params": self.params,
+            "code": self.code,
+            "outputs": fingerprint(outputs, "stat"),
+            "result": _jsonable(result) if result is not None else None,
+        }
+        tmp = f"{self.path}.tmp{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, self.path)
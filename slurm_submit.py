@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""
+slurm_submit.py
+
+Concurrent, throttled sbatch submission (used by submit_simple_n4_slurm.py).
+
+Each sbatch call is a round trip to the Slurm controller. Submitting hundreds of jobs
+one after the other takes minutes, and bursts of calls trip the controller's RPC rate
+limits. SubmissionEngine submits from a bounded thread pool and every sbatch call
+(retries included) first takes a token from a shared token bucket: at most `burst`
+calls back to back, then `rate` calls per second.
+
+A failed call is retried with exponential backoff (plus jitter) when sbatch's error
+looks transient (controller busy/unreachable, socket timeouts, sbatch itself timing
+out); anything else (bad script, invalid partition/account, ...) fails at once.
+Note that an sbatch that timed out may still have queued its job: the job scripts
+must tolerate running twice (the N4 script skips existing outputs).
+
+Every outcome is appended to a JSON-lines ledger:
+  {"time", "key" (the input file), "job_id", "script", "status", "attempts", "error"}
+read_ledger() returns the latest record per key.
+
+Set sbatch= to a stub (fake_sbatch.py) to exercise all of this without a cluster.
+
+LocalEngine runs the same job scripts on this machine instead (workstations, CI with a
+stub N4): a pool of jobs sized to the CPUs, each job pinned to its own CPUs, its output
+in the file named by the script's #SBATCH --output (%j = a local job id), its exit
+status recorded in the ledger ("done" / "failed").
+"""
+
+import fcntl
+import json
+import os
+import queue
+import random
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence
+
+# sbatch stderr for errors worth retrying
+TRANSIENT_RE = re.compile(
+    r"socket timed out|timed out|unable to contact slurm controller|slurm_receive_msg|"
+    r"resource temporarily unavailable|connection refused|connection reset|"
+    r"transport endpoint|try again|temporarily|slurmctld.*(busy|not responding)|"
+    r"communication connection failure",
+    re.IGNORECASE,
+)
+
+# Runs argv[2:] pinned to the CPUs in argv[1] ("0,1,..."): a launcher process instead of
+# preexec_fn, which is not safe in a process with threads (submit() runs in a thread pool)
+PIN_LAUNCHER = (
+    "import os, sys\n"
+    "if hasattr(os, 'sched_setaffinity'):\n"
+    "    os.sched_setaffinity(0, [int(c) for c in sys.argv[1].split(',')])\n"
+    "try:\n"
+    "    os.execvp(sys.argv[2], sys.argv[2:])\n"
+    "except OSError as e:\n"
+    "    sys.exit(f'cannot run {sys.argv[-1]}: {e}')\n"
+)
+
+
+def parse_job_id(stdout: str) -> str:
+    """Job id from sbatch --parsable output ("<id>" or "<id>;<cluster>")."""
+    m = re.match(r"^(\d+)", stdout.strip())
+    if not m:
+        raise RuntimeError(f"Could not parse job id from: {stdout}")
+    return m.group(1)
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `burst` tokens, refilled at `rate` per second (rate <= 0: unlimited)."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = float(rate)
+        self.capacity = float(max(1, burst))
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+@dataclass
+class SubmitRequest:
+    key: str  # what the job is for (input file); the ledger is keyed by it
+    script: Path  # sbatch script; renamed to <job_id>_<job_name>.sbatch once submitted
+    job_name: str
+    sbatch_args: List[str] = field(default_factory=list)  # extra sbatch options, before the script
+
+
+@dataclass
+class SubmitResult:
+    request: SubmitRequest
+    job_id: str | None
+    script: Path
+    attempts: int
+    error: str | None = None
+    log: Path | None = None  # LocalEngine: the job's output
+    seconds: float | None = None  # LocalEngine: run time
+
+    @property
+    def ok(self) -> bool:
+        return self.job_id is not None and self.error is None
+
+
+class SubmissionEngine:
+    def __init__(
+        self,
+        *,
+        sbatch: str = "sbatch",
+        max_parallel: int = 8,
+        rate: float = 5.0,
+        burst: int = 10,
+        retries: int = 4,
+        backoff: float = 1.0,
+        max_backoff: float = 30.0,
+        timeout: float = 60.0,
+        ledger: Path | None = None,
+    ):
+        self.sbatch = sbatch
+        self.max_parallel = max(1, max_parallel)
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.ledger = ledger
+        self.ledger_lock = threading.Lock()
+
+    def _call(self, request: SubmitRequest) -> tuple[int, str, str]:
+        self.bucket.acquire()
+        try:
+            result = subprocess.run(
+                [self.sbatch, "--parsable", *request.sbatch_args, str(request.script)],
+                capture_output=True,
+                text=True,
+                timeout=self.timeout,
+            )
+        except subprocess.TimeoutExpired:
+            return -1, "", f"sbatch timed out after {self.timeout:g} s"
+        except OSError as e:
+            return -2, "", f"cannot run {self.sbatch}: {e}"
+        return result.returncode, result.stdout.strip(), result.stderr.strip()
+
+    def submit(self, request: SubmitRequest) -> SubmitResult:
+        """Submit one script (blocking), with retries; records the outcome in the ledger."""
+        attempt = 0
+        while True:
+            attempt += 1
+            rc, stdout, stderr = self._call(request)
+            if rc == 0:
+                try:
+                    job_id = parse_job_id(stdout)
+                except RuntimeError as e:
+                    result = SubmitResult(request, None, request.script, attempt, str(e))
+                    break
+                final_script = request.script.with_name(f"{job_id}_{request.job_name}.sbatch")
+                request.script.rename(final_script)
+                result = SubmitResult(request, job_id, final_script, attempt)
+                break
+            error = stderr or stdout or f"sbatch exit code {rc}"
+            if attempt > self.retries or rc == -2 or not TRANSIENT_RE.search(error):
+                result = SubmitResult(request, None, request.script, attempt, error)
+                break
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+            time.sleep(delay * random.uniform(0.5, 1.0))
+        self._record(result)
+        return result
+
+    def submit_all(
+        self,
+        requests: List[SubmitRequest],
+        on_result: Callable[[SubmitResult], None] | None = None,
+    ) -> List[SubmitResult]:
+        """Submit concurrently; on_result is called (serialized) as each one finishes. Results keep the input order."""
+        lock = threading.Lock()
+
+        def run(request):
+            result = self.submit(request)
+            if on_result is not None:
+                with lock:
+                    on_result(result)
+            return result
+
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as ex:
+            return list(ex.map(run, requests))
+
+    def status(self, result: SubmitResult) -> str:
+        """Ledger status of a result."""
+        return "submitted" if result.ok else "failed"
+
+    def _record(self, result: SubmitResult) -> None:
+        self.record(
+            key=result.request.key,
+            job_id=result.job_id,
+            script=str(result.script),
+            status=self.status(result),
+            attempts=result.attempts,
+            error=result.error,
+        )
+
+    def record(self, *, key: str, job_id: str | None, script: str, status: str, attempts: int = 0, error: str | None = None) -> None:
+        """Append one ledger record (no-op without a ledger)."""
+        if self.ledger is None:
+            return
+        record = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "key": key,
+            "job_id": job_id,
+            "script": script,
+            "status": status,
+            "attempts": attempts,
+            "error": error,
+        }
+        with self.ledger_lock:
+            with open(self.ledger, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+class LocalEngine(SubmissionEngine):
+    """
+    Runs job scripts locally, as sbatch would start them, up to max_parallel at a time
+    (default: as many cpus_per_job slots as this machine has CPUs). Each running job is
+    pinned (sched_setaffinity, via PIN_LAUNCHER) to a CPU set of its own and sees SLURM_JOB_ID,
+    SLURM_JOB_NAME and SLURM_CPUS_PER_TASK. submit() blocks until the job has finished.
+    """
+
+    def __init__(
+        self,
+        *,
+        state_dir: Path,
+        cpus_per_job: int = 1,
+        max_parallel: int | None = None,
+        ledger: Path | None = None,
+        on_start: Callable[[SubmitRequest, str, Sequence[int]], None] | None = None,
+    ):
+        cpus = available_cpus()
+        cpus_per_job = max(1, min(cpus_per_job, len(cpus)))
+        n_slots = len(cpus) // cpus_per_job
+        super().__init__(max_parallel=max_parallel or n_slots, rate=0, retries=0, ledger=ledger)
+
+        self.state_dir = Path(state_dir)
+        self.cpus_per_job = cpus_per_job
+        self.on_start = on_start
+        # CPU sets handed out to running jobs; more jobs than sets share them round-robin
+        self.slots: queue.Queue = queue.Queue()
+        for i in range(self.max_parallel):
+            k = i % n_slots
+            self.slots.put(cpus[k * cpus_per_job:(k + 1) * cpus_per_job])
+
+    def next_job_id(self) -> str:
+        """Local job ids count up from 1 per state_dir (shared by concurrent runs)."""
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.state_dir / "local_job_id", "a+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            job_id = int(f.read().strip() or "0") + 1
+            f.seek(0)
+            f.truncate()
+            f.write(str(job_id))
+        return str(job_id)
+
+    def status(self, result: SubmitResult) -> str:
+        return "done" if result.ok else "failed"
+
+    def submit(self, request: SubmitRequest) -> SubmitResult:
+        text = request.script.read_text()
+        job_id = self.next_job_id()
+        script = request.script.with_name(f"{job_id}_{request.job_name}.sbatch")
+        request.script.rename(script)
+
+        log = script_log_path(text, job_id, request.job_name)
+        log.parent.mkdir(parents=True, exist_ok=True)
+
+        shebang = text.splitlines()[0] if text.startswith("#!") else "#!/bin/bash"
+        env = dict(
+            os.environ,
+            SLURM_JOB_ID=job_id,
+            SLURM_JOB_NAME=request.job_name,
+            SLURM_CPUS_PER_TASK=str(self.cpus_per_job),
+        )
+
+        cpus = self.slots.get()
+        try:
+            if self.on_start is not None:
+                self.on_start(request, job_id, cpus)
+            start = time.monotonic()
+            with open(log, "w", encoding="utf-8") as out:
+                try:
+                    rc = subprocess.run(
+                        [sys.executable, "-c", PIN_LAUNCHER, ",".join(map(str, cpus)),
+                         *shlex.split(shebang[2:]), str(script)],
+                        stdout=out,
+                        stderr=subprocess.STDOUT,
+                        env=env,
+                    ).returncode
+                except OSError as e:
+                    out.write(f"cannot run {script}: {e}\n")
+                    rc = -1
+            seconds = time.monotonic() - start
+        finally:
+            self.slots.put(cpus)
+
+        error = None if rc == 0 else f"exit code {rc} (log: {log})"
+        result = SubmitResult(request, job_id, script, 1, error, log=log, seconds=seconds)
+        self._record(result)
+        return result
+
+
+def script_log_path(text: str, job_id: str, job_name: str) -> Path:
+    """Output file of a job script (#SBATCH --output, default slurm-%j.out) with %j/%x/%% filled in."""
+    pattern = "slurm-%j.out"
+    for line in text.splitlines():
+        m = re.match(r"#SBATCH\s+(?:--output=|-o\s*)(\S+)", line)
+        if m:
+            pattern = m.group(1)
+            break
+    fields = {"j": job_id, "A": job_id, "x": job_name, "%": "%"}
+    return Path(re.sub(r"%([jAx%])", lambda m: fields[m.group(1)], pattern))
+
+
+def available_cpus() -> List[int]:
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def job_active(job_id: str, squeue: str = "squeue") -> bool:
+    """True if Slurm still has the job pending or running (False if squeue is unavailable)."""
+    try:
+        result = subprocess.run([squeue, "-h", "-j", job_id, "-o", "%T"], capture_output=True, text=True, timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0 and bool(result.stdout.strip())
+
+
+def read_ledger(path: Path) -> Dict[str, dict]:
+    """Latest ledger record per key (empty if there is no ledger yet)."""
+    records = {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by an interrupted run
+                records[rec.get("key")] = rec
+    except FileNotFoundError:
+        pass
+    return records
@@ -2,10 +2,22 @@
 
 import argparse
 import re
-import subprocess
 import sys
+from datetime import datetime
 from pathlib import Path
 
+from slurm_submit import LocalEngine, SubmissionEngine, SubmitRequest, SubmitResult, available_cpus
+
+# N4 settings used by default (also by vfa_pipeline.py)
+N4_DEFAULTS = dict(
+    dimension=3,
+    shrink_factor=1,
+    convergence="[200x200x100x50,1e-8]",
+    bspline="[8]",
+    histogram_sharpening="[0.15,0.01,200]",
+    mask_dilate_iters=3,
+)
+
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
@@ -15,27 +27,140 @@ def shell_quote(s: str) -> str:
     return "'" + s.replace("'", "'\"'\"'") + "'"
 
 
-def submit_job(script_path: Path):
-    result = subprocess.run(
-        ["sbatch", "--parsable", str(script_path)],
-        capture_output=True,
-        text=True,
-    )
-    return result.returncode, result.stdout.strip(), result.stderr.strip()
+def report_submission(result: SubmitResult) -> None:
+    name = Path(result.request.key).name
+
+    if not result.ok:
+        eprint(f"[SUBMIT FAIL] {name} (after {result.attempts} attempt(s))")
+        eprint(result.error)
+        return
+
+    print(f"[SUBMITTED] {name}")
+    print(f"  job_id : {result.job_id}")
+    print(f"  script : {result.script}")
+
+
+def report_local_start(request: SubmitRequest, job_id: str, cpus) -> None:
+    print(f"[RUNNING] {request.job_name} (job {job_id}, CPUs {','.join(map(str, cpus))})", flush=True)
+
+
+def report_local(result: SubmitResult, done: int, total: int) -> None:
+    name = result.request.job_name
+
+    if result.job_id is None:
+        eprint(f"[{done}/{total}] [RUN FAIL] {name}")
+        eprint(result.error)
+        return
+
+    status = "DONE" if result.ok else "FAILED"
+    print(f"[{done}/{total}] [{status}] {name} (job {result.job_id}, {result.seconds:.1f} s)", flush=True)
+    print(f"  log    : {result.log}")
+
+
+def task_inputs_block(task_id: str = '"${SLURM_ARRAY_TASK_ID:?not running as an array task}"') -> str:
+    """Shell that sets input_nii ... method_out from line task_id + 1 of $task_manifest."""
+    return f"""\
+task_id={task_id}
+task_line="$(sed -n "$((task_id + 1))p" "$task_manifest")"
+
+if [[ -z "$task_line" ]]; then
+    echo "ERROR: No task $task_id in $task_manifest"
+    exit 1
+fi
+
+IFS=$'\\t' read -r input_nii output_nii bias_nii mask_nii method_in method_out <<< "$task_line"
+
+# "-" marks an empty field (consecutive tabs would be merged by read)
+[[ "$mask_nii" == "-" ]] && mask_nii=""
+[[ "$method_in" == "-" ]] && method_in=""
+[[ "$method_out" == "-" ]] && method_out=""
+
+echo "Task $task_id: $input_nii"
+"""
+
+
+def pack_runner_block(n_tasks: int, parallel: int, log_dir: Path) -> str:
+    """
+    Shell that runs the run_task function for manifest lines 0 .. n_tasks - 1, at most
+    `parallel` at a time, each logging to its own file, and reports every image's status.
+    """
+    return f"""\
+pack_parallel={parallel}
+n_tasks={n_tasks}
+log_dir={shell_quote(str(log_dir))}
+
+declare -a pids=()
+declare -a inputs=()
+declare -a logs=()
+n_skipped=0
+
+for ((i = 0; i < n_tasks; i++)); do
+    IFS=$'\\t' read -r input_nii output_nii bias_nii _ <<< "$(sed -n "$((i + 1))p" "$task_manifest")"
+
+    if [[ "$overwrite_flag" != "1" && -f "$output_nii" && -f "$bias_nii" ]]; then
+        echo "[SKIPPED] $input_nii (outputs exist)"
+        n_skipped=$((n_skipped + 1))
+        continue
+    fi
+
+    while (( $(jobs -rp | wc -l) >= pack_parallel )); do
+        sleep 1
+    done
+
+    inputs[i]="$input_nii"
+    logs[i]="$log_dir/slurm-${{SLURM_JOB_ID:-local}}_$i.out"
+    echo "[START] $input_nii"
+    run_task "$i" > "${{logs[i]}}" 2>&1 &
+    pids[i]=$!
+done
+
+n_done=0
+n_failed=0
+
+for i in "${{!pids[@]}}"; do
+    rc=0
+    wait "${{pids[i]}}" || rc=$?
+
+    if [[ "$rc" == "0" ]]; then
+        echo "[DONE] ${{inputs[i]}}"
+        n_done=$((n_done + 1))
+    else
+        echo "[FAILED] ${{inputs[i]}} (exit $rc, log: ${{logs[i]}})"
+        n_failed=$((n_failed + 1))
+    fi
+done
+
+echo
+echo "Pack: $n_done done, $n_skipped skipped, $n_failed failed (of $n_tasks)"
+
+if (( n_failed > 0 )); then
+    exit 1
+fi
+"""
 
 
-def parse_job_id(stdout: str) -> str:
-    m = re.match(r"^(\d+)", stdout.strip())
-    if not m:
-        raise RuntimeError(f"Could not parse job id from: {stdout}")
-    return m.group(1)
+def write_task_manifest(path: Path, tasks: list[dict]) -> None:
+    """One tab-separated line per array task: input output bias mask method_in method_out."""
+    fields = ("input_nii", "output_nii", "bias_nii", "mask_nii", "method_in", "method_out")
+    lines = []
+
+    for task in tasks:
+        values = [None if task[k] is None else str(task[k]) for k in fields]
+
+        for v in values:
+            if v is not None and ("\t" in v or "\n" in v or v == "-"):
+                raise ValueError(f"Path not usable in a task manifest: {v!r}")
+
+        lines.append("\t".join("-" if v is None else v for v in values))
+
+    path.write_text("\n".join(lines) + "\n")
 
 
 def build_job_script(
     *,
-    input_nii: Path,
-    output_nii: Path,
-    bias_nii: Path,
+    input_nii: Path | None,
+    output_nii: Path | None,
+    bias_nii: Path | None,
     mask_nii: Path | None,
     method_in: Path | None,
     method_out: Path | None,
@@ -55,8 +180,21 @@ def build_job_script(
     partition: str | None,
     overwrite: bool,
     job_name: str,
+    task_manifest: Path | None = None,
+    array: str | None = None,
+    pack: int | None = None,
+    pack_parallel: int = 1,
 ):
-    log_pattern = sbatch_dir / "slurm-%j.out"
+    """
+    One N4 job for input_nii, or with task_manifest (write_task_manifest) either an
+    array job (array = "0-N%K") whose tasks read their input_nii ... method_out from
+    the manifest, or (pack = number of manifest lines) one job that runs all of them,
+    pack_parallel at a time.
+    """
+    if array:
+        log_pattern = sbatch_dir / "slurm-%A_%a.out"
+    else:
+        log_pattern = sbatch_dir / "slurm-%j.out"
 
     lines = [
         "#!/bin/bash",
@@ -71,6 +209,9 @@ def build_job_script(
     if partition:
         lines.append(f"#SBATCH --partition={partition}")
 
+    if array:
+        lines.append(f"#SBATCH --array={array}")
+
     script = "\n".join(lines) + "\n\n"
 
     script += f"""\
@@ -83,9 +224,6 @@ echo "SLURM_JOB_ID=${{SLURM_JOB_ID:-}}"
 
 export ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS={threads}
 
-input_nii={shell_quote(str(input_nii))}
-output_nii={shell_quote(str(output_nii))}
-bias_nii={shell_quote(str(bias_nii))}
 overwrite_flag={"1" if overwrite else "0"}
 
 n4_exe={shell_quote(n4_path)}
@@ -93,20 +231,33 @@ imagemath_exe={shell_quote(imagemath_path)}
 
 """
 
-    if mask_nii is not None:
-        script += f"mask_nii={shell_quote(str(mask_nii))}\n"
-    else:
-        script += 'mask_nii=""\n'
+    if task_manifest is not None:
+        script += f"task_manifest={shell_quote(str(task_manifest))}\n"
 
-    if method_in is not None:
-        script += f"method_in={shell_quote(str(method_in))}\n"
+    if pack:
+        # one image per call, in a subshell: its `exit`s end that image only
+        script += "\nrun_task() (\n" + task_inputs_block('"$1"')
+    elif task_manifest is not None:
+        script += task_inputs_block()
     else:
-        script += 'method_in=""\n'
+        script += f"input_nii={shell_quote(str(input_nii))}\n"
+        script += f"output_nii={shell_quote(str(output_nii))}\n"
+        script += f"bias_nii={shell_quote(str(bias_nii))}\n"
 
-    if method_out is not None:
-        script += f"method_out={shell_quote(str(method_out))}\n"
-    else:
-        script += 'method_out=""\n'
+        if mask_nii is not None:
+            script += f"mask_nii={shell_quote(str(mask_nii))}\n"
+        else:
+            script += 'mask_nii=""\n'
+
+        if method_in is not None:
+            script += f"method_in={shell_quote(str(method_in))}\n"
+        else:
+            script += 'method_in=""\n'
+
+        if method_out is not None:
+            script += f"method_out={shell_quote(str(method_out))}\n"
+        else:
+            script += 'method_out=""\n'
 
     script += f"""
 
@@ -130,14 +281,26 @@ cmd=(
 
 """
 
-    if mask_nii is not None:
+    # array tasks may or may not have a mask: decided at run time
+    mask_block = mask_nii is not None or task_manifest is not None
+
+    if task_manifest is not None:
+        script += """
+dilated_mask=""
+
+if [[ -n "$mask_nii" ]]; then
+"""
+
+    if mask_block:
         script += f"""
 if [[ ! -f "$mask_nii" ]]; then
     echo "ERROR: Missing mask: $mask_nii"
     exit 1
 fi
 
-dilated_mask="$(dirname "$mask_nii")/$(basename "$mask_nii" .nii.gz)_dilated_tmp.nii.gz"
+# Named after this job's output, not the mask: several jobs may share one mask
+# (vfa_pipeline.py --n4_mask) and run at the same time
+dilated_mask="${{output_nii%.nii.gz}}_mask_dilated_tmp.nii.gz"
 
 echo
 echo "Dilating mask ({mask_dilate_iters} iterations)..."
@@ -151,6 +314,11 @@ fi
 
 cmd+=( -x "$dilated_mask" )
 
+"""
+
+    if task_manifest is not None:
+        script += """
+fi
 """
 
     script += f"""
@@ -181,11 +349,20 @@ fi
 
 """
 
-    if mask_nii is not None:
+    if task_manifest is not None:
+        script += """
+if [[ -n "$dilated_mask" ]]; then
+    rm -f "$dilated_mask"
+fi
+"""
+    elif mask_nii is not None:
         script += """
 rm -f "$dilated_mask"
 """
 
+    if pack:
+        script += ")\n\n" + pack_runner_block(pack, pack_parallel, sbatch_dir)
+
     script += """
 echo
 echo "===== JOB END ====="
@@ -227,7 +404,7 @@ def main():
     p.add_argument(
         "--mask_dilate_iters",
         type=int,
-        default=3,
+        default=N4_DEFAULTS["mask_dilate_iters"],
         help="Number of dilation iterations for supplied masks",
     )
 
@@ -241,23 +418,23 @@ def main():
         default="ImageMath",
     )
 
-    p.add_argument("--dimension", type=int, default=3)
+    p.add_argument("--dimension", type=int, default=N4_DEFAULTS["dimension"])
 
-    p.add_argument("--shrink_factor", type=int, default=1)
+    p.add_argument("--shrink_factor", type=int, default=N4_DEFAULTS["shrink_factor"])
 
     p.add_argument(
         "--convergence",
-        default="[200x200x100x50,1e-8]",
+        default=N4_DEFAULTS["convergence"],
     )
 
     p.add_argument(
         "--bspline",
-        default="[8]",
+        default=N4_DEFAULTS["bspline"],
     )
 
     p.add_argument(
         "--histogram_sharpening",
-        default="[0.15,0.01,200]",
+        default=N4_DEFAULTS["histogram_sharpening"],
     )
 
     p.add_argument("--threads", type=int, default=4)
@@ -269,8 +446,121 @@ def main():
     p.add_argument("--overwrite", action="store_true")
     p.add_argument("--dry_run", action="store_true")
 
+    # array mode
+    p.add_argument(
+        "--array",
+        action="store_true",
+        help="Submit one job array (task manifest + one script) instead of one job per file",
+    )
+
+    p.add_argument(
+        "--array_concurrency",
+        type=int,
+        default=16,
+        help="Array tasks running at once (the %%K of --array=0-N%%K; 0 = no cap)",
+    )
+
+    p.add_argument(
+        "--max_array_size",
+        type=int,
+        default=1000,
+        help="Tasks per array job (keep within the cluster's MaxArraySize); more files give several arrays",
+    )
+
+    # packed mode
+    p.add_argument(
+        "--pack",
+        type=int,
+        default=0,
+        help="Images per job (0 = one job per image); size --time/--mem_gb for a whole pack",
+    )
+
+    p.add_argument(
+        "--pack_parallel",
+        type=int,
+        default=None,
+        help="Images run at once within a packed job (default: min(pack, cpus)); "
+             "each gets cpus/pack_parallel ITK threads (replaces --threads)",
+    )
+
+    # executor
+    p.add_argument(
+        "--executor",
+        choices=("slurm", "local"),
+        default="slurm",
+        help="slurm: sbatch the jobs; local: run the same job scripts on this machine",
+    )
+
+    p.add_argument(
+        "--local_jobs",
+        type=int,
+        default=0,
+        help="Jobs run at once by the local executor (default: CPUs // --cpus)",
+    )
+
+    # submission engine
+    p.add_argument(
+        "--max_parallel",
+        type=int,
+        default=8,
+        help="Concurrent sbatch calls",
+    )
+
+    p.add_argument(
+        "--rate",
+        type=float,
+        default=5.0,
+        help="sbatch calls per second, retries included (0 = unlimited)",
+    )
+
+    p.add_argument(
+        "--burst",
+        type=int,
+        default=10,
+        help="sbatch calls allowed back to back before --rate applies",
+    )
+
+    p.add_argument(
+        "--retries",
+        type=int,
+        default=4,
+        help="Retries (exponential backoff) on transient sbatch errors",
+    )
+
+    p.add_argument(
+        "--ledger",
+        default=None,
+        help="Submission ledger, JSON lines (default: <input_dir>/sbatch/submissions.jsonl)",
+    )
+
+    p.add_argument(
+        "--sbatch_path",
+        default="sbatch",
+        help="sbatch executable (e.g. fake_sbatch.py to test without a cluster)",
+    )
+
     args = p.parse_args()
 
+    if args.pack and args.array:
+        eprint("ERROR: --pack and --array are mutually exclusive.")
+        return 1
+
+    if args.pack < 0:
+        eprint("ERROR: --pack must be >= 0.")
+        return 1
+
+    if args.executor == "local":
+        if args.array:
+            eprint("ERROR: --array needs Slurm; the local executor runs per-file or packed jobs in parallel.")
+            return 1
+
+        # a job cannot use more CPUs than the machine has: size --cpus/--threads to it
+        n_cpus = len(available_cpus())
+        if args.cpus > n_cpus:
+            print(f"[INFO] --cpus {args.cpus} -> {n_cpus} (CPUs on this machine)")
+            args.cpus = n_cpus
+        args.threads = min(args.threads, args.cpus)
+
     input_dir = Path(args.input_dir).expanduser().resolve()
 
     if not input_dir.exists():
@@ -290,6 +580,8 @@ def main():
     print(f"[INFO] input_dir : {input_dir}")
     print(f"[INFO] matches   : {len(nifti_paths)}")
 
+    tasks = []
+
     for input_nii in nifti_paths:
 
         if not input_nii.is_file():
@@ -335,66 +627,201 @@ def main():
                 eprint(f"[SKIP] Missing mask: {mask_nii}")
                 continue
 
-        job_name = f"n4_{stem}"
-
-        tmp_script = sbatch_dir / f"TMP_{job_name}.sbatch"
-
-        script_text = build_job_script(
-            input_nii=input_nii,
-            output_nii=output_nii,
-            bias_nii=bias_nii,
-            mask_nii=mask_nii,
-            method_in=method_in if method_in.exists() else None,
-            method_out=method_out,
-            sbatch_dir=sbatch_dir,
-            n4_path=args.n4_path,
-            imagemath_path=args.imagemath_path,
-            dimension=args.dimension,
-            shrink_factor=args.shrink_factor,
-            convergence=args.convergence,
-            bspline=args.bspline,
-            histogram_sharpening=args.histogram_sharpening,
-            mask_dilate_iters=args.mask_dilate_iters,
-            threads=args.threads,
-            cpus=args.cpus,
-            mem_gb=args.mem_gb,
-            time_str=args.time,
-            partition=args.partition,
-            overwrite=args.overwrite,
-            job_name=job_name,
+        tasks.append(
+            dict(
+                input_nii=input_nii,
+                output_nii=output_nii,
+                bias_nii=bias_nii,
+                mask_nii=mask_nii,
+                method_in=method_in if method_in.exists() else None,
+                method_out=method_out,
+            )
         )
 
-        tmp_script.write_text(script_text)
+    settings = dict(
+        sbatch_dir=sbatch_dir,
+        n4_path=args.n4_path,
+        imagemath_path=args.imagemath_path,
+        dimension=args.dimension,
+        shrink_factor=args.shrink_factor,
+        convergence=args.convergence,
+        bspline=args.bspline,
+        histogram_sharpening=args.histogram_sharpening,
+        mask_dilate_iters=args.mask_dilate_iters,
+        threads=args.threads,
+        cpus=args.cpus,
+        mem_gb=args.mem_gb,
+        time_str=args.time,
+        partition=args.partition,
+        overwrite=args.overwrite,
+    )
 
-        print(f"[PREPARED] {input_nii.name}")
+    requests = []
+    group_tasks = {}  # request key -> the tasks of that array/packed job
+
+    if args.array:
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        size = max(1, args.max_array_size)
+
+        for k, start in enumerate(range(0, len(tasks), size)):
+            chunk = tasks[start:start + size]
+            job_name = f"n4_array_{stamp}" + (f"_{k}" if len(tasks) > size else "")
+            task_manifest = sbatch_dir / f"{job_name}.tsv"
+            tmp_script = sbatch_dir / f"TMP_{job_name}.sbatch"
+
+            array = f"0-{len(chunk) - 1}"
+            if args.array_concurrency > 0:
+                array += f"%{args.array_concurrency}"
+
+            try:
+                write_task_manifest(task_manifest, chunk)
+            except ValueError as e:
+                eprint(f"ERROR: {e}")
+                return 1
+
+            tmp_script.write_text(
+                build_job_script(
+                    input_nii=None,
+                    output_nii=None,
+                    bias_nii=None,
+                    mask_nii=None,
+                    method_in=None,
+                    method_out=None,
+                    job_name=job_name,
+                    task_manifest=task_manifest,
+                    array=array,
+                    **settings,
+                )
+            )
+
+            print(f"[PREPARED] {job_name}: {len(chunk)} tasks, --array={array}")
+            print(f"  manifest : {task_manifest}")
+
+            requests.append(
+                SubmitRequest(key=str(task_manifest), script=tmp_script, job_name=job_name)
+            )
+            group_tasks[str(task_manifest)] = chunk
+
+    elif args.pack:
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        parallel = max(1, min(args.pack_parallel or args.cpus, args.pack))
+        pack_settings = dict(settings, threads=max(1, args.cpus // parallel))
+
+        for k, start in enumerate(range(0, len(tasks), args.pack)):
+            chunk = tasks[start:start + args.pack]
+            job_name = f"n4_pack_{stamp}_{k}"
+            task_manifest = sbatch_dir / f"{job_name}.tsv"
+            tmp_script = sbatch_dir / f"TMP_{job_name}.sbatch"
+
+            try:
+                write_task_manifest(task_manifest, chunk)
+            except ValueError as e:
+                eprint(f"ERROR: {e}")
+                return 1
+
+            tmp_script.write_text(
+                build_job_script(
+                    input_nii=None,
+                    output_nii=None,
+                    bias_nii=None,
+                    mask_nii=None,
+                    method_in=None,
+                    method_out=None,
+                    job_name=job_name,
+                    task_manifest=task_manifest,
+                    pack=len(chunk),
+                    pack_parallel=min(parallel, len(chunk)),
+                    **pack_settings,
+                )
+            )
+
+            print(
+                f"[PREPARED] {job_name}: {len(chunk)} images, {min(parallel, len(chunk))} at a time, "
+                f"{pack_settings['threads']} threads each"
+            )
+            print(f"  manifest : {task_manifest}")
+
+            requests.append(
+                SubmitRequest(key=str(task_manifest), script=tmp_script, job_name=job_name)
+            )
+            group_tasks[str(task_manifest)] = chunk
 
-        if args.dry_run:
-            continue
+    else:
+        for task in tasks:
+            stem = task["input_nii"].name[:-7]
+            job_name = f"n4_{stem}"
 
-        rc, stdout, stderr = submit_job(tmp_script)
+            tmp_script = sbatch_dir / f"TMP_{job_name}.sbatch"
 
-        if rc != 0:
-            eprint(f"[SUBMIT FAIL] {input_nii.name}")
+            tmp_script.write_text(build_job_script(**task, job_name=job_name, **settings))
 
-            if stdout:
-                eprint(stdout)
+            print(f"[PREPARED] {task['input_nii'].name}")
 
-            if stderr:
-                eprint(stderr)
+            requests.append(
+                SubmitRequest(key=str(task["input_nii"]), script=tmp_script, job_name=job_name)
+            )
 
-            continue
+    if args.dry_run or not requests:
+        return 0
 
-        job_id = parse_job_id(stdout)
+    ledger = Path(args.ledger).expanduser() if args.ledger else sbatch_dir / "submissions.jsonl"
 
-        final_script = sbatch_dir / f"{job_id}_{job_name}.sbatch"
+    if args.executor == "local":
+        engine = LocalEngine(
+            state_dir=sbatch_dir,
+            cpus_per_job=args.cpus,
+            max_parallel=args.local_jobs or None,
+            ledger=ledger,
+            on_start=report_local_start,
+        )
+
+        print(f"[INFO] running   : {len(requests)} job(s), {engine.max_parallel} at a time, {engine.cpus_per_job} CPU(s) each")
 
-        tmp_script.rename(final_script)
+        finished = []
+        results = engine.submit_all(
+            requests,
+            on_result=lambda r: (finished.append(r), report_local(r, len(finished), len(requests))),
+        )
+    else:
+        engine = SubmissionEngine(
+            sbatch=args.sbatch_path,
+            max_parallel=args.max_parallel,
+            rate=args.rate,
+            burst=args.burst,
+            retries=args.retries,
+            ledger=ledger,
+        )
+
+        results = engine.submit_all(requests, on_result=report_submission)
+
+    # array/packed jobs: also one ledger record per input file, with its
+    # <job_id>_<task> (array) or <job_id> (pack) id
+    for result in results:
+        if result.job_id is not None and result.request.key in group_tasks:
+            for i, task in enumerate(group_tasks[result.request.key]):
+                engine.record(
+                    key=str(task["input_nii"]),
+                    job_id=f"{result.job_id}_{i}" if args.array else result.job_id,
+                    script=str(result.script),
+                    status=engine.status(result),
+                    attempts=result.attempts,
+                    error=result.error,
+                )
+
+    n_ok = sum(r.ok for r in results)
+
+    kind = " array job(s)" if args.array else " packed job(s)" if args.pack else ""
+
+    if args.executor == "local":
+        print(f"[INFO] done      : {n_ok}/{len(results)}{kind}")
+    else:
+        print(f"[INFO] submitted : {n_ok}/{len(results)}{kind}")
 
-        print(f"[SUBMITTED] {input_nii.name}")
-        print(f"  job_id : {job_id}")
-        print(f"  script : {final_script}")
+    print(f"[INFO] ledger    : {ledger}")
 
-    return 0
+    # Nonzero when any job failed (local) or could not be submitted (slurm), so that
+    # wrappers see a partial run either way
+    return 0 if n_ok == len(results) else 1
 
 
 if __name__ == "__main__":
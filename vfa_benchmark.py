@@ -0,0 +1,544 @@
+#!/usr/bin/env python3
+"""
+vfa_benchmark.py
+
+Timing harness for the VFA T1 fitters on synthetic SPGR data.
+
+Usage:
+  # thread scaling of the N-point and 2-point fits on a 256^3 volume
+  python vfa_benchmark.py workers --shape 256 256 256 --workers 1 2 4 8 16
+
+  # fused vfa_core kernel vs the pre-vfa_core 2-point and N-point implementations
+  python vfa_benchmark.py kernel --shape 256 256 256
+
+  # streaming auto-mask vs the full-volume percentile sort (2 and 6 images)
+  python vfa_benchmark.py automask --shape 256 256 256 --n-imgs 2 6
+
+  # cost of per-voxel B1 correction relative to uniform flip angles
+  python vfa_benchmark.py b1 --shape 256 256 256 --workers 8
+
+  # runtime and peak memory against the fraction of the FOV inside the mask
+  python vfa_benchmark.py mask --shape 256 256 256 --frac 1 0.5 0.2 0.1
+
+  # OLS vs WLS vs NLLS fit engines: runtime and T1 error against the ground truth
+  python vfa_benchmark.py fit --shape 256 256 256 --noise 0.02 --workers 8
+
+  # JCAMP-DX method/acqp parser and the TR/FA key lookup vs the line-regex parser, on real files
+  # (the line-regex parser returns untyped strings; "full decode" types every value)
+  python vfa_benchmark.py method scan/5/method scan/5/acqp
+
+Except for "method", synthetic data follow S(a) = K * (1 - E1) * sin(a) / (1 - E1*cos(a)) with a smooth
+T1 field, additive Gaussian noise and zero-signal background (~60% of the box).
+"""
+
+import argparse
+import os
+import re
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+from vfa_core import (
+    build_default_mask,
+    e1_to_t1,
+    TR_FA_KEYS,
+    infer_tr_fa,
+    parse_bruker_method,
+    read_method_params,
+    vfa_fit_e1,
+    vfa_fit_e1_least_squares,
+    vfa_fit_e1_nlls,
+    vfa_fit_e1_wls,
+)
+from vfa_t1map_2fa import vfa_t1_two_point
+
+
+def synthetic_vfa(
+    shape: Tuple[int, ...],
+    fas_deg: List[float],
+    tr_s: float = 0.015,
+    noise: float = 0.01,
+    seed: int = 0,
+) -> Tuple[List[np.ndarray], np.ndarray]:
+    """Return (float32 volumes, true T1) for a smooth T1 field inside an ellipsoid."""
+    rng = np.random.default_rng(seed)
+    grids = np.meshgrid(*[np.linspace(-1, 1, s, dtype=np.float32) for s in shape], indexing="ij")
+    r2 = sum(g * g for g in grids)
+    inside = r2 < 0.85
+    T1 = np.where(inside, 0.8 + 1.2 * (1 - r2), 0.0).astype(np.float32)
+    E1 = np.exp(-tr_s / np.where(inside, T1, 1.0))
+
+    vols = []
+    for fa in fas_deg:
+        a = np.deg2rad(fa)
+        S = 1000.0 * (1 - E1) * np.sin(a) / (1 - E1 * np.cos(a))
+        S = np.where(inside, S, 0.0)
+        S = S + noise * 1000.0 * np.sin(a) * rng.standard_normal(shape)
+        vols.append(S.astype(np.float32))
+    return vols, T1
+
+
+def best_of(fn: Callable, repeats: int) -> float:
+    """Best wall-clock time (s) over repeats calls of fn()."""
+    best = np.inf
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def print_table(title: str, rows: List[Tuple[str, float]], ref: float) -> None:
+    print(f"--- {title} ---")
+    for label, t in rows:
+        print(f"  {label:>12s} : {t:8.3f} s   x{ref / t:5.2f}")
+
+
+def bench_workers(args) -> None:
+    shape = tuple(args.shape)
+    fas = args.fas
+    vols, _ = synthetic_vfa(shape, fas, tr_s=args.tr)
+    print(f"shape={shape} fas={fas} cpus={os.cpu_count()}")
+
+    rows = []
+    for w in args.workers:
+        t = best_of(lambda: vfa_fit_e1_least_squares(vols, fas, None, 1e-6, 0.999999, workers=w), args.repeats)
+        rows.append((f"workers={w}", t))
+    print_table(f"N-point OLS ({len(fas)} angles)", rows, rows[0][1])
+
+    rows = []
+    for w in args.workers:
+        t = best_of(lambda: vfa_t1_two_point(vols[0], vols[-1], fas[0], fas[-1], args.tr, workers=w), args.repeats)
+        rows.append((f"workers={w}", t))
+    print_table("2-point closed form", rows, rows[0][1])
+
+
+# -------------------------
+# Reference implementations (before vfa_core), kept for the kernel, automask and method benchmarks
+# -------------------------
+
+def legacy_parse_bruker_method(method_path):
+    with open(method_path, "r", encoding="utf-8", errors="replace") as f:
+        lines = f.readlines()
+    data = {}
+    key = None
+    buf = []
+    entry_re = re.compile(r"^\s*##\$(?P<key>[A-Za-z0-9_]+)\s*=\s*(?P<val>.*)\s*$")
+    for line in lines:
+        m = entry_re.match(line)
+        if m:
+            if key is not None:
+                data[key] = "\n".join(buf).strip()
+            key = m.group("key").strip()
+            buf = [m.group("val").strip()]
+        elif key is not None:
+            buf.append(line.rstrip("\n"))
+    if key is not None:
+        data[key] = "\n".join(buf).strip()
+    return data
+
+
+def legacy_infer_tr_fa(d):
+    def first_number(raw):
+        if raw is None:
+            return None
+        s = raw.strip()
+        if len(s) >= 2 and s[0] == s[-1] and s[0] in "\"'":
+            s = s[1:-1]
+        m = re.search(r"[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?", s.replace("<", " ").replace(">", " "))
+        return float(m.group(0)) if m else None
+
+    tr = first_number(next((d[k] for k in ("PVM_RepetitionTime", "RepetitionTime", "PVM_TR", "TR") if k in d), None))
+    tr_s = tr / 1000.0 if tr is not None and tr > 0.5 else tr
+    fa = None
+    for k in ("PVM_FlipAngle", "FlipAngle", "PVM_ExcPulseAngle", "PVM_ExcPulAngle", "PVM_ExcFlipAngle", "PVM_ExFlipAngle"):
+        v = first_number(d.get(k))
+        if v is not None and 0 < v < 180:
+            return tr_s, v
+    for k in ("ExcPulse1", "ExcPulse2", "ExcPulse", "PVM_ExcPulse1", "PVM_ExcPulse2", "PVM_ExcPulse"):
+        m = re.search(r"\((.*)\)", " ".join(d[k].split())) if k in d else None
+        parts = m.group(1).split(",") if m else []
+        v = first_number(parts[2]) if len(parts) >= 3 else None
+        if v is not None and 0 < v < 180:
+            return tr_s, v
+    return tr_s, fa
+
+
+def legacy_build_default_mask(vols, frac=0.05):
+    vols = [np.asarray(v) for v in vols]
+    comb = np.maximum.reduce(vols)
+    comb = comb[np.isfinite(comb)]
+    if comb.size == 0:
+        return np.zeros(vols[0].shape, dtype=np.uint8)
+    p = np.percentile(comb, 95)
+    thr = frac * p
+    return (np.maximum.reduce(vols) > thr).astype(np.uint8)
+
+
+def legacy_fit_e1_least_squares(vols, fas_deg, mask, e1_min, e1_max):
+    n = len(vols)
+    shape = vols[0].shape
+    fas = np.deg2rad(np.array(fas_deg, dtype=np.float64))
+    sin_a = np.sin(fas)
+    tan_a = np.tan(fas)
+
+    V = np.stack([v.astype(np.float64, copy=False) for v in vols], axis=0)
+    vox = np.prod(shape)
+    V2 = V.reshape((n, vox))
+
+    X = (V2 / tan_a[:, None])
+    Y = (V2 / sin_a[:, None])
+
+    good = np.all(np.isfinite(X) & np.isfinite(Y), axis=0) & np.all(V2 > 0, axis=0)
+    if mask is not None:
+        good &= (mask.reshape(vox) != 0)
+
+    E1 = np.full(vox, np.nan, dtype=np.float64)
+    b = np.full(vox, np.nan, dtype=np.float64)
+
+    Xg = X[:, good]
+    Yg = Y[:, good]
+
+    Xm = np.mean(Xg, axis=0)
+    Ym = np.mean(Yg, axis=0)
+    Xc = Xg - Xm
+    Yc = Yg - Ym
+
+    varX = np.sum(Xc * Xc, axis=0)
+    covXY = np.sum(Xc * Yc, axis=0)
+
+    ok = varX > 0
+    e1 = np.full(Xm.shape, np.nan, dtype=np.float64)
+    e1[ok] = covXY[ok] / varX[ok]
+    e1 = np.clip(e1, e1_min, e1_max)
+
+    bb = Ym - e1 * Xm
+
+    E1[good] = e1
+    b[good] = bb
+
+    return E1.reshape(shape), b.reshape(shape)
+
+
+def legacy_t1_two_point(S1, S2, fa1_deg, fa2_deg, tr_s, mask=None, e1_min=1e-6, e1_max=0.999999):
+    a1 = np.deg2rad(fa1_deg)
+    a2 = np.deg2rad(fa2_deg)
+
+    S1 = S1.astype(np.float64, copy=False)
+    S2 = S2.astype(np.float64, copy=False)
+
+    y1 = S1 / np.sin(a1)
+    y2 = S2 / np.sin(a2)
+    x1 = S1 / np.tan(a1)
+    x2 = S2 / np.tan(a2)
+
+    denom = x2 - x1
+    numer = y2 - y1
+
+    good = np.isfinite(numer) & np.isfinite(denom) & (np.abs(denom) > 0)
+    good &= (S1 > 0) & (S2 > 0)
+    if mask is not None:
+        good &= (mask != 0)
+
+    E1 = np.full(S1.shape, np.nan, dtype=np.float64)
+    E1[good] = numer[good] / denom[good]
+    E1 = np.clip(E1, e1_min, e1_max)
+
+    T1 = -tr_s / np.log(E1)
+    T1[~good] = 0.0
+    return T1
+
+
+def max_rel_diff(a: np.ndarray, b: np.ndarray) -> float:
+    g = np.isfinite(a) & np.isfinite(b) & (a != 0)
+    if not np.array_equal(np.isfinite(a), np.isfinite(b)):
+        return np.inf
+    return float(np.max(np.abs(a[g] - b[g]) / np.abs(a[g]))) if g.any() else 0.0
+
+
+def bench_kernel(args) -> None:
+    shape = tuple(args.shape)
+    fas = args.fas
+    vols, T1_true = synthetic_vfa(shape, fas, tr_s=args.tr)
+    mask = (T1_true > 0).astype(np.uint8)
+    print(f"shape={shape} fas={fas} masked={int(mask.sum())}")
+
+    res = {}
+
+    def run(key, fn):
+        def wrapped():
+            res[key] = fn()
+        return best_of(wrapped, args.repeats)
+
+    t_old = run("old", lambda: legacy_fit_e1_least_squares(vols, fas, mask, 1e-6, 0.999999)[0])
+    t_new = run("new", lambda: vfa_fit_e1(vols, fas, mask)["E1"])
+    print_table(f"N-point OLS ({len(fas)} angles)", [("legacy", t_old), ("fused", t_new)], t_old)
+    print(f"  max rel. E1 diff: {max_rel_diff(res['old'], res['new']):.3g}")
+
+    S1, S2 = vols[0], vols[-1]
+    t_old = run("old", lambda: legacy_t1_two_point(S1, S2, fas[0], fas[-1], args.tr, mask))
+    t_new = run("new", lambda: vfa_t1_two_point(S1, S2, fas[0], fas[-1], args.tr, mask))
+    print_table("2-point", [("legacy", t_old), ("fused", t_new)], t_old)
+    print(f"  max rel. T1 diff: {max_rel_diff(res['old'], res['new']):.3g}")
+
+
+def bench_automask(args) -> None:
+    shape = tuple(args.shape)
+    print(f"shape={shape} workers={args.workers}")
+    for n in args.n_imgs:
+        vols, _ = synthetic_vfa(shape, args.fas[:n], tr_s=args.tr)
+        vols = [np.asfortranarray(v) for v in vols]
+        res = {}
+
+        def old():
+            res["old"] = legacy_build_default_mask(vols)
+
+        def new():
+            res["new"] = build_default_mask(vols, workers=args.workers)
+
+        t_old = best_of(old, args.repeats)
+        t_new = best_of(new, args.repeats)
+        print_table(f"auto-mask, {n} images", [("legacy", t_old), ("streaming", t_new)], t_old)
+        print(f"  voxels differing: {int(np.count_nonzero(res['old'] != res['new']))}")
+        if args.cleanup:
+            t_clean = best_of(lambda: build_default_mask(vols, workers=args.workers, fill_holes=True, largest_component=True), args.repeats)
+            print(f"  with fill holes + largest component: {t_clean:.3f} s")
+
+
+def bench_b1(args) -> None:
+    shape = tuple(args.shape)
+    fas = args.fas
+    vols, T1_true = synthetic_vfa(shape, fas, tr_s=args.tr)
+    mask = (T1_true > 0).astype(np.uint8)
+    # Smooth +-20% transmit field along the first axis
+    b1 = np.broadcast_to(
+        np.linspace(0.8, 1.2, shape[0], dtype=np.float32).reshape((-1,) + (1,) * (len(shape) - 1)), shape
+    )
+    print(f"shape={shape} fas={fas} workers={args.workers} masked={int(mask.sum())}")
+
+    for fit in args.fit:
+        t_uni = best_of(lambda: vfa_fit_e1(vols, fas, mask, fit=fit, workers=args.workers, tr_s=args.tr), args.repeats)
+        t_b1 = best_of(lambda: vfa_fit_e1(vols, fas, mask, fit=fit, workers=args.workers, tr_s=args.tr, b1=b1), args.repeats)
+        print_table(f"{fit}: uniform FA vs B1 map", [("uniform", t_uni), ("b1map", t_b1)], t_uni)
+        print(f"  B1 overhead: x{t_b1 / t_uni:.2f}")
+
+
+def bench_mask(args) -> None:
+    shape = tuple(args.shape)
+    fas = args.fas
+    vols, _ = synthetic_vfa(shape, fas, tr_s=args.tr)
+    # NIfTI-like Fortran-ordered inputs, as vfa_io.LazyVolume yields
+    vols = [np.asfortranarray(v) for v in vols]
+    grids = np.meshgrid(*[np.linspace(-1, 1, s, dtype=np.float32) for s in shape], indexing="ij")
+    r = np.sqrt(sum(g * g for g in grids))
+    print(f"shape={shape} fas={fas} workers={args.workers}")
+
+    for fit in args.fit:
+        rows = []
+        for frac in args.frac:
+            # Centered ball holding ~frac of the voxels
+            mask = (r <= np.quantile(r, frac)).astype(np.uint8)
+
+            def run():
+                vfa_fit_e1(vols, fas, mask, fit=fit, workers=args.workers, tr_s=args.tr)
+
+            t = best_of(run, args.repeats)
+            tracemalloc.start()
+            run()
+            peak = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+            rows.append((f"{100 * mask.mean():.0f}% FOV", t, peak))
+        print_table(f"{fit}: runtime vs mask fraction", [(label, t) for label, t, _ in rows], rows[0][1])
+        for label, _, peak in rows:
+            print(f"  {label:>12s} : peak {peak:7.0f} MB")
+
+
+def t1_error(T1: np.ndarray, T1_true: np.ndarray) -> str:
+    """Median bias and IQR of the relative T1 error inside the object."""
+    g = T1_true > 0
+    rel = T1[g] / T1_true[g] - 1
+    q25, q50, q75 = np.percentile(rel, [25, 50, 75])
+    return f"bias {100 * q50:+6.2f}%  IQR {100 * (q75 - q25):5.2f}%"
+
+
+def bench_fit(args) -> None:
+    shape = tuple(args.shape)
+    fas = args.fas
+    vols, T1_true = synthetic_vfa(shape, fas, tr_s=args.tr, noise=args.noise)
+    mask = (T1_true > 0).astype(np.uint8)
+    print(f"shape={shape} fas={fas} noise={args.noise} workers={args.workers} masked={int(mask.sum())}")
+
+    res = {}
+
+    def ols():
+        res["ols"] = vfa_fit_e1_least_squares(vols, fas, mask, 1e-6, 0.999999, workers=args.workers)[0]
+
+    def wls():
+        res["wls"] = vfa_fit_e1_wls(vols, fas, mask, 1e-6, 0.999999, workers=args.workers)[0]
+
+    def nlls():
+        E1, _, conv, _ = vfa_fit_e1_nlls(vols, fas, mask, 1e-6, 0.999999, workers=args.workers)
+        res["nlls"] = E1
+        res["conv"] = conv
+
+    t_ols = best_of(ols, args.repeats)
+    t_wls = best_of(wls, args.repeats)
+    t_nlls = best_of(nlls, args.repeats)
+    print_table("fit engine", [("ols", t_ols), ("wls", t_wls), ("nlls", t_nlls)], t_ols)
+    for k in ("ols", "wls", "nlls"):
+        print(f"  {k:>12s} : {t1_error(e1_to_t1(res[k], args.tr), T1_true)}")
+    print(f"  nlls converged: {100 * np.nanmean(res['conv'][mask > 0]):.2f}%")
+
+
+# Records the JCAMP-DX parser must type correctly (checked before the "method" timings)
+METHOD_CASES = [
+    ("PVM_RepetitionTime", "15", 15),
+    ("PVM_EchoTime", "1.5e-3", 1.5e-3),
+    ("Method", "<Bruker:FLASH>", "Bruker:FLASH"),
+    ("ExcPulse1", "(1, 6000, 15, Yes, 4, 1, 0.5, 0, <hermite.exc>)", (1, 6000, 15, "Yes", 4, 1, 0.5, 0, "hermite.exc")),
+    ("ExcPulse1Ints", "(1, 5400, 30)", (1, 5400, 30)),  # all-integer struct, not a sizes header
+    ("PVM_Matrix", "( 2 )\n128 96", [128, 96]),
+    ("PVM_Empty", "( 0 )", []),
+    ("PVM_Grid", "( 2, 2 )\n@2*(0) 1 2", [[0, 0], [1, 2]]),
+    ("PVM_Names", "( 2, 8 )\n<a> <b>", ["a", "b"]),
+]
+
+# (key, verbatim record lines, expected): record layout rather than value syntax
+METHOD_LAYOUT_CASES = [
+    ("PVM_Repeated", "##$PVM_Repeated=1\n##$PVM_Repeated=2\n", 2),  # the last record wins
+    ("PVM_Indented", "  ##$PVM_Indented=3\n", 3),
+    ("PVM_OldMac", "##$PVM_OldMac=( 2 )\r4 5\r", [4, 5]),  # lone CR line ends
+]
+
+
+def check_method_parser() -> None:
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "method")
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            f.write("##TITLE=check\n")
+            for key, text, _ in METHOD_CASES:
+                f.write(f"##${key}={text}\n")
+            for _, text, _ in METHOD_LAYOUT_CASES:
+                f.write(text)
+            f.write("##END=\n")
+        params = parse_bruker_method(path)
+        for key, text, want in METHOD_CASES + METHOD_LAYOUT_CASES:
+            got = params[key]
+            got = got.tolist() if isinstance(got, np.ndarray) else got
+            if got != want:
+                raise SystemExit(f"ERROR: parser check {key}={text!r}: got {got!r}, expected {want!r}")
+            found = read_method_params(path, (key,)).get(key)
+            found = found.tolist() if isinstance(found, np.ndarray) else found
+            if found != want:
+                raise SystemExit(f"ERROR: key lookup {key}={text!r}: got {found!r}, expected {want!r}")
+    print(f"parser checks: {len(METHOD_CASES) + len(METHOD_LAYOUT_CASES)} records ok")
+
+
+def bench_method(args) -> None:
+    check_method_parser()
+    loops = args.loops
+    for path in args.files:
+        with open(path, "rb") as f:
+            blob = f.read()
+        n_lines = blob.count(b"\n")
+        n_keys = len(parse_bruker_method(path))
+        print(f"--- {path} ({len(blob) / 1024:.0f} KB, {n_lines} lines, {n_keys} records) ---")
+
+        def legacy():
+            for _ in range(loops):
+                legacy_parse_bruker_method(path)
+
+        def legacy_tr_fa():
+            for _ in range(loops):
+                legacy_infer_tr_fa(legacy_parse_bruker_method(path))
+
+        def tr_fa():
+            for _ in range(loops):
+                infer_tr_fa(parse_bruker_method(path))
+
+        def targeted():
+            for _ in range(loops):
+                infer_tr_fa(read_method_params(path, TR_FA_KEYS))
+
+        def typed_all():
+            for _ in range(loops):
+                parse_bruker_method(path).copy()
+
+        t_old = best_of(legacy, args.repeats) / loops
+        t_all = best_of(typed_all, args.repeats) / loops
+        for label, t in (
+            ("line regex", t_old),
+            ("regex+TR/FA", best_of(legacy_tr_fa, args.repeats) / loops),
+            ("parse+TR/FA", best_of(tr_fa, args.repeats) / loops),
+            ("key lookup", best_of(targeted, args.repeats) / loops),
+            ("full decode", t_all),
+        ):
+            print(f"  {label:>12s} : {t * 1e3:8.3f} ms  x{t_old / t:5.2f}")
+        if t_all > t_old:
+            print(f"  typing every value is {t_all / t_old:.1f}x the untyped line-regex split")
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Benchmarks for the VFA T1 fitters on synthetic data.")
+    sub = ap.add_subparsers(dest="bench", required=True)
+
+    def common(p):
+        p.add_argument("--shape", nargs="+", type=int, default=[128, 128, 128])
+        p.add_argument("--fas", nargs="+", type=float, default=[3.0, 6.0, 10.0, 15.0, 20.0, 30.0])
+        p.add_argument("--tr", type=float, default=0.015, help="TR in seconds")
+        p.add_argument("--repeats", type=int, default=3)
+
+    p = sub.add_parser("workers", help="Thread scaling of the slab-parallel fits")
+    common(p)
+    p.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4, 8, 16])
+    p.set_defaults(func=bench_workers)
+
+    p = sub.add_parser("kernel", help="Fused vfa_core kernel vs the legacy implementations")
+    common(p)
+    p.set_defaults(func=bench_kernel)
+
+    p = sub.add_parser("automask", help="Streaming auto-mask vs the percentile-sort implementation")
+    common(p)
+    p.add_argument("--n-imgs", nargs="+", type=int, default=[2, 6], help="Number of images combined into the mask")
+    p.add_argument("--workers", type=int, default=1)
+    p.add_argument("--cleanup", action="store_true", help="Also time hole filling + largest component (needs scipy)")
+    p.set_defaults(func=bench_automask)
+
+    p = sub.add_parser("b1", help="Runtime of B1-corrected fits vs uniform flip angles")
+    common(p)
+    p.add_argument("--fit", nargs="+", choices=["ols", "wls", "nlls"], default=["ols", "wls"])
+    p.add_argument("--workers", type=int, default=1)
+    p.set_defaults(func=bench_b1)
+
+    p = sub.add_parser("mask", help="Runtime and peak memory vs the masked fraction of the FOV")
+    common(p)
+    p.add_argument("--frac", nargs="+", type=float, default=[1.0, 0.5, 0.2, 0.1])
+    p.add_argument("--fit", nargs="+", choices=["ols", "wls", "nlls"], default=["ols", "wls"])
+    p.add_argument("--workers", type=int, default=1)
+    p.set_defaults(func=bench_mask)
+
+    p = sub.add_parser("fit", help="OLS vs WLS vs NLLS runtime and accuracy")
+    common(p)
+    p.add_argument("--noise", type=float, default=0.02, help="Noise std relative to K*sin(a)")
+    p.add_argument("--workers", type=int, default=1)
+    p.set_defaults(func=bench_fit)
+
+    p = sub.add_parser("method", help="JCAMP-DX parser vs the line-regex parser on method/acqp files")
+    p.add_argument("files", nargs="+")
+    p.add_argument("--loops", type=int, default=50, help="Parses per timed repeat")
+    p.add_argument("--repeats", type=int, default=5)
+    p.set_defaults(func=bench_method)
+
+    return ap.parse_args()
+
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
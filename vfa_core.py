@@ -0,0 +1,1135 @@
+#!/usr/bin/env python3
+"""
+vfa_core.py
+
+Shared compute core for the VFA T1 tools (vfa_t1map_2fa.py, vfa_t1map_multi.py,
+vfa_t1map_batch.py): Bruker .method parsing and one fitting kernel for 2..N angles.
+
+Model (spoiled GRE / SPGR):
+  S(a) = K * (1 - E1) * sin(a) / (1 - E1*cos(a))
+  x = S / tan(a),  y = S / sin(a)   =>   y = E1 * x + K*(1 - E1)
+
+Fit engines (vfa_fit_e1(fit=...)):
+  ols  : least squares line through (x, y). For n == 2 this is the closed-form
+         2-point formula E1 = (y2 - y1) / (x2 - x1).
+  wls  : DESPOT1-WLS, reweighting passes with w = (sin a / (1 - E1 cos a))^2
+  nlls : batched Levenberg-Marquardt on S(a) itself, seeded by OLS
+
+Kernel layout:
+  - volumes are fitted slab by slab along the last axis (optionally under a memory
+    budget and on a thread pool, see vfa_io.run_slabs)
+  - per slab, only voxels that pass the mask and have finite, positive signal at
+    every angle are gathered into one compact (n, k) array (as float64, or float32
+    with precision="float32", straight from the on-disk dtype). With a mask, only
+    the mask voxels are read at all, and slabs without any are skipped; results are
+    scattered once into the full-size outputs, so time and working memory scale
+    with the masked volume rather than the field of view
+  - x and y are never materialized for OLS: 1/sin(a) and 1/tan(a) are precomputed
+    per angle and the centered sums are accumulated angle by angle into two (k,)
+    scratch buffers
+  - with a relative B1 map, flip angles are b1 * nominal per voxel; the angle terms
+    become (n, k) arrays computed once per slab and the kernels run unchanged
+  - precision="float32" keeps the gathered signal, angle terms, kernel scratch and
+    outputs in float32 (half the memory traffic of float64). OLS sums are centered
+    so that no raw second moments are differenced; WLS differences raw weighted
+    moments (a few 1e-4 relative T1 in float32 on synthetic data);
+    vfa_precision_check.py measures the T1 deviation on real data
+Voxels that are not fitted get E1 = b = nan; e1_to_t1() maps them to 0.
+"""
+
+import functools
+import os
+import re
+import threading
+from collections.abc import Mapping
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from vfa_io import default_slab_depth, run_slabs
+
+
+# -------------------------
+# Method file parsing
+# -------------------------
+
+# Bruker parameter files (.method, acqp, visu_pars, ...) are JCAMP-DX: "##$KEY=VALUE"
+# records (values may span lines), "$$" comment lines and plain "##KEY=" header
+# records. A record starts a line (indenting is allowed), CR, CRLF and LF line ends
+# are all accepted, and a repeated key keeps its last value.
+# Values are typed (when first read, see MethodParams):
+#   12 / 1.5e-3              -> int / float
+#   Yes, Slice_Slab          -> str
+#   <text>                   -> str (without the brackets)
+#   (1, 5400, 30, <x.exc>)   -> tuple of typed fields; nested structs are tuples too
+#   (1, 5400, 30)            -> tuple as well: all-integer, but no body line follows
+#   ( 3 )\n1 2 3             -> numpy array (shaped by a multi-dimensional header),
+#                               "@n*(x)" runs expanded. Sized arrays of <strings> give
+#                               a str (one string) or a list of str, of structs a list
+#                               of tuples, of words a list of str.
+
+_DIMS_RE = re.compile(r"\(\s*(\d+(?:\s*,\s*\d+)*)\s*\)[ \t]*(?:\n|$)")
+_FLOAT_RE = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+_TOKEN_RE = re.compile(r"<[^>]*>|[()]|[^\s,()<>]+")
+_RUN_RE = re.compile(r"@(\d+)\*\(([^)]*)\)")
+# "##$KEY=" / "##KEY=" at the start of a (possibly indented) line
+_RECORD_RE = re.compile(r"\n[ \t]*##\$")
+_RECORD_END_RE = re.compile(r"\n[ \t]*##")
+_RECORD_END_RE_B = re.compile(rb"\n[ \t]*##")
+
+
+def _parse_scalar(s: str):
+    c = s[:1]
+    if c == "<":
+        s = s[1:-1] if s.endswith(">") else s
+        return s.replace("\n", "") if "\n" in s else s
+    if c.isdigit() or c in "-+.":
+        # int() never takes these, and a failed int() costs more than the float() itself
+        if "." not in s and "e" not in s and "E" not in s:
+            try:
+                return int(s)
+            except ValueError:
+                pass
+        try:
+            return float(s)
+        except ValueError:
+            pass
+    return " ".join(s.split()) if "\n" in s or "  " in s else s
+
+
+def _parse_structs(s: str) -> list:
+    """'(a, (b, c)) (d, e)' -> [(a, (b, c)), (d, e)]; fields split on commas or whitespace."""
+    tokens = _TOKEN_RE.findall(s)
+    if tokens and tokens[0] == "(" and tokens[-1] == ")" and s.count("(") == 1 and s.count(")") == 1:
+        return [tuple(map(_parse_scalar, tokens[1:-1]))]  # one flat struct, the common case
+    stack = [[]]
+    for t in tokens:
+        if t == "(":
+            stack.append([])
+        elif t == ")":
+            if len(stack) > 1:
+                done = tuple(stack.pop())
+                stack[-1].append(done)
+        else:
+            stack[-1].append(_parse_scalar(t))
+    return stack[0]
+
+
+def _parse_array(body: str, dims: Tuple[int, ...]):
+    body = body.strip()
+    if body.startswith("<"):
+        strings = _parse_structs(body)
+        return strings[0] if len(strings) == 1 else strings
+    if body.startswith("("):
+        return _parse_structs(body)
+    if "@" in body:
+        body = _RUN_RE.sub(lambda m: " ".join([m.group(2).strip()] * int(m.group(1))), body)
+    tokens = body.split()
+    is_float = "." in body or "e" in body or "E" in body
+    try:
+        a = np.array(tokens, dtype=np.float64 if is_float else np.int64)
+    except ValueError:
+        return tokens
+    if len(dims) > 1 and a.size == int(np.prod(dims)):
+        a = a.reshape(dims)
+    return a
+
+
+def _parse_value(val: str):
+    if "##" in val:
+        m = _RECORD_END_RE.search(val)
+        if m:
+            val = val[:m.start()]  # ##END= (or another non-$ record) after the last one
+    if "\n$$" in val:
+        val = "\n".join(ln for ln in val.split("\n") if not ln.startswith("$$"))
+    val = val.strip()
+    if val[:1] != "(":
+        return _parse_scalar(val)
+    m = _DIMS_RE.match(val)
+    if m:
+        dims = tuple(int(d) for d in m.group(1).split(","))
+        # a sizes header needs a body line; "(1, 5400, 30)" alone is a struct
+        if m.end() < len(val) or 0 in dims:
+            return _parse_array(val[m.end():], dims)
+    structs = _parse_structs(val)
+    return structs[0] if len(structs) == 1 else tuple(structs)
+
+
+class MethodParams(Mapping):
+    """
+    {KEY: typed value} returned by parse_bruker_method(). Parsing only splits the file
+    into records; each value is decoded the first time it is read and then kept, so
+    callers that need a few keys never pay for the large arrays. Iterating values(),
+    items(), dict(params) or copy() decodes everything, which is slower than the
+    untyped line-regex parser this replaced (about 4-5x on a 565 KB method, almost all
+    of it numeric array conversion; vfa_benchmark.py method). .raw holds the
+    undecoded record strings (and is what pickling sends). Not a dict: pass
+    dict(params) to json and the like.
+    """
+
+    def __init__(self, raw: Dict[str, str]):
+        self.raw = raw
+        self._values: Dict[str, object] = {}
+
+    def __getitem__(self, key):
+        values = self._values
+        if key in values:
+            return values[key]
+        v = values[key] = _parse_value(self.raw[key])
+        return v
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def __len__(self) -> int:
+        return len(self.raw)
+
+    def __contains__(self, key) -> bool:
+        return key in self.raw
+
+    def copy(self) -> Dict[str, object]:
+        return {k: self[k] for k in self.raw}
+
+    def __reduce__(self):
+        return MethodParams, (self.raw,)
+
+    def __repr__(self) -> str:
+        return repr(self.copy())
+
+
+def parse_bruker_method(method_path: str) -> MethodParams:
+    """Parse a Bruker JCAMP-DX parameter file (.method, acqp, ...) into {KEY: typed value}."""
+    if not os.path.isfile(method_path):
+        raise FileNotFoundError(f"Method file not found: {method_path}")
+
+    # Binary read: text-mode newline translation costs more than the whole split
+    with open(method_path, "rb") as f:
+        blob = f.read()
+    if b"\r" in blob:
+        blob = blob.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    text = blob.decode("utf-8", errors="replace")
+
+    raw: Dict[str, str] = {}
+    for rec in _RECORD_RE.split("\n" + text)[1:]:
+        key, eq, val = rec.partition("=")
+        if eq:
+            raw[key.strip()] = val  # a repeated record: the last one wins
+    return MethodParams(raw)
+
+
+def _trie_pattern(words: List[bytes]) -> bytes:
+    """Alternation of words factored by common prefixes (re tries a flat one word by word)."""
+    groups: Dict[bytes, List[bytes]] = {}
+    for w in words:
+        if w:
+            groups.setdefault(w[:1], []).append(w[1:])
+    alts = [re.escape(c) + _trie_pattern(rest) for c, rest in sorted(groups.items())]
+    optional = b"" in words
+    if not alts:
+        return b""
+    body = alts[0] if len(alts) == 1 and not optional else b"(?:" + b"|".join(alts) + b")"
+    return body + b"?" if optional else body
+
+
+@functools.lru_cache(maxsize=32)
+def _keys_re(keys: Tuple[str, ...]) -> "re.Pattern":
+    return re.compile(rb"\n[ \t]*##\$(" + _trie_pattern([k.encode() for k in keys]) + rb")[ \t]*=")
+
+
+def read_method_params(method_path: str, keys) -> Dict[str, object]:
+    """
+    {KEY: typed value} for just the given keys of a Bruker parameter file (missing keys
+    are left out). The file is scanned once for the wanted record headers only; no other
+    record is decoded. Same rules as parse_bruker_method (a repeated record: the last wins).
+    """
+    if not os.path.isfile(method_path):
+        raise FileNotFoundError(f"Method file not found: {method_path}")
+
+    with open(method_path, "rb") as f:
+        blob = b"\n" + f.read()
+    if b"\r" in blob:
+        blob = blob.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+    last: Dict[str, int] = {}
+    for m in _keys_re(tuple(sorted(set(keys)))).finditer(blob):
+        last[m.group(1).decode()] = m.end()
+    found: Dict[str, object] = {}
+    for key, start in last.items():
+        end = _RECORD_END_RE_B.search(blob, start)
+        val = blob[start:end.start() if end else len(blob)]
+        found[key] = _parse_value(val.decode("utf-8", errors="replace"))
+    return found
+
+
+def _first_number(v) -> Optional[float]:
+    """Scalar, first array element or numeric string as float; None otherwise."""
+    if isinstance(v, np.ndarray):
+        v = v.flat[0] if v.size else None
+    elif isinstance(v, (list, tuple)):
+        v = v[0] if v else None
+    if isinstance(v, (int, float, np.number)) and not isinstance(v, bool):
+        return float(v)
+    if isinstance(v, str):
+        m = _FLOAT_RE.search(v)
+        return float(m.group(0)) if m else None
+    return None
+
+
+def default_adjacent_method_path(nifti_path: str) -> str:
+    base = os.path.basename(nifti_path)
+    d = os.path.dirname(os.path.abspath(nifti_path))
+    if base.endswith(".nii.gz"):
+        stem = base[:-7]
+    elif base.endswith(".nii"):
+        stem = base[:-4]
+    else:
+        stem = os.path.splitext(base)[0]
+    return os.path.join(d, f"{stem}.method")
+
+
+# Parameters consulted by infer_tr_seconds / infer_fa_degrees, in order of preference
+TR_KEYS = ("PVM_RepetitionTime", "RepetitionTime", "PVM_TR", "TR", "ACQ_repetition_time")
+FA_SCALAR_KEYS = (
+    "PVM_FlipAngle", "FlipAngle",
+    "PVM_ExcPulseAngle", "PVM_ExcPulAngle",
+    "PVM_ExcFlipAngle", "PVM_ExFlipAngle",
+    "ACQ_flip_angle",
+)
+FA_TUPLE_KEYS = ("ExcPulse1", "ExcPulse2", "ExcPulse", "PVM_ExcPulse1", "PVM_ExcPulse2", "PVM_ExcPulse")
+TR_FA_KEYS = TR_KEYS + FA_SCALAR_KEYS + FA_TUPLE_KEYS
+
+
+def infer_tr_seconds(d: Dict[str, object]) -> Tuple[Optional[float], str]:
+    used = next((k for k in TR_KEYS if k in d), None)
+    tr_val = _first_number(d[used]) if used else None
+    if tr_val is None:
+        return None, "TR not found"
+    if tr_val > 0.5:
+        tr_s = tr_val / 1000.0
+        return tr_s, f"TR from {used}={tr_val} (ms->s => {tr_s:.6g}s)"
+    return tr_val, f"TR from {used}={tr_val} (assumed s)"
+
+
+def infer_fa_degrees(d: Dict[str, object]) -> Tuple[Optional[float], str]:
+    for k in FA_SCALAR_KEYS:
+        if k in d:
+            v = _first_number(d[k])
+            if v is not None and 0 < v < 180:
+                return v, f"FA from {k}={v}"
+
+    # Pulse structs: (1, 5400, 30, Yes, 4, ...), the 3rd field is the FA in degrees
+    for k in FA_TUPLE_KEYS:
+        v = d.get(k)
+        if isinstance(v, tuple) and len(v) >= 3:
+            v = _first_number(v[2])
+            if v is not None and 0 < v < 180:
+                return v, f"FA from {k} tuple third field = {v}"
+
+    return None, "FA not found"
+
+
+def infer_tr_fa(d: Dict[str, object]) -> Tuple[Optional[float], Optional[float], str]:
+    """(TR seconds, FA degrees, details) from a parsed method dict."""
+    tr_s, tr_note = infer_tr_seconds(d)
+    fa, fa_note = infer_fa_degrees(d)
+    return tr_s, fa, f"{tr_note}; {fa_note}"
+
+
+# Bump when parsing/inference changes so that cached metadata is re-parsed
+METHOD_PARSER_VERSION = 3
+
+# Metadata index used by infer_tr_fa_from_method (vfa_method_index.MethodIndex)
+_method_index = None
+_method_index_lock = threading.Lock()
+
+
+def use_method_index(path: Optional[str]) -> None:
+    """
+    Look up .method files through the metadata index at path (created if missing);
+    None goes back to parsing every file. Defaults to $VFA_METHOD_INDEX if set.
+    """
+    global _method_index
+    with _method_index_lock:
+        if path is None:
+            _method_index = None
+            return
+        if _method_index is not None and _method_index.path == os.path.abspath(os.path.expanduser(path)):
+            return
+        from vfa_method_index import MethodIndex
+        _method_index = MethodIndex(path)
+
+
+def infer_tr_fa_from_method(method_path: str) -> Tuple[Optional[float], Optional[float], str]:
+    """(TR seconds, FA degrees, details) of a method/acqp file, reading only the TR_FA_KEYS records."""
+    if _method_index is None and os.environ.get("VFA_METHOD_INDEX"):
+        use_method_index(os.environ["VFA_METHOD_INDEX"])
+    if _method_index is not None:
+        return _method_index.tr_fa(method_path)
+    return infer_tr_fa(read_method_params(method_path, TR_FA_KEYS))
+
+
+# Name used by vfa_t1map_2fa.py
+infer_tr_and_fa_from_method = infer_tr_fa_from_method
+
+
+# -------------------------
+# VFA fitting
+# -------------------------
+
+FIT_METHODS = ("ols", "wls", "nlls")
+PRECISIONS = ("float64", "float32")
+
+
+# Auto-mask percentile: values sampled per slab to bracket the 95th percentile
+_MASK_SAMPLES = 1 << 20
+_MASK_Q = 0.95
+
+
+def _lerp(a: float, b: float, t: float) -> float:
+    """Linear interpolation as np.percentile does it (stable for t close to 1)."""
+    return b - (b - a) * (1 - t) if t >= 0.5 else a + (b - a) * t
+
+
+def clean_mask(mask: np.ndarray, fill_holes: bool = False, largest_component: bool = False) -> np.ndarray:
+    """
+    Optional morphological cleanup of a binary mask: keep only the largest connected
+    component (face connectivity), then fill enclosed holes. Needs scipy.
+    """
+    if not (fill_holes or largest_component):
+        return mask
+    try:
+        from scipy import ndimage
+    except ImportError as e:
+        raise ImportError("Mask cleanup (hole filling / largest component) requires scipy") from e
+
+    m = mask != 0
+    if largest_component:
+        labels, n_labels = ndimage.label(m)
+        if n_labels > 1:
+            sizes = np.bincount(labels.ravel(order="K"))
+            sizes[0] = 0
+            m = labels == sizes.argmax()
+    if fill_holes:
+        # Holes are background components that do not touch the volume border; one
+        # labelling pass instead of binary_fill_holes' iterated dilation (same result)
+        bg, _ = ndimage.label(~m)
+        outside = np.zeros(int(bg.max()) + 1, dtype=bool)
+        outside[0] = True
+        for ax in range(m.ndim):
+            outside[np.take(bg, 0, axis=ax)] = True
+            outside[np.take(bg, -1, axis=ax)] = True
+        m = ~outside[bg] | m
+    return m.astype(np.uint8)
+
+
+def build_default_mask(
+    vols: List[np.ndarray],
+    frac: float = 0.05,
+    workers: int = 1,
+    fill_holes: bool = False,
+    largest_component: bool = False,
+) -> np.ndarray:
+    """
+    Intensity mask: max over the volumes > frac * 95th percentile of its finite values.
+
+    The volumes (arrays or vfa_io.LazyVolume) are read once, slab by slab along the
+    last axis (on a thread pool with workers > 1), keeping only the voxelwise max.
+    Instead of sorting every voxel, the same pass takes a strided sample whose
+    quantiles bracket the 95th percentile; one more slab pass counts the values below
+    the bracket and collects those inside it, and sorting just those gives the exact
+    np.percentile value. If the bracket misses the target rank it is widened.
+    See clean_mask() for fill_holes / largest_component.
+    """
+    shape = vols[0].shape
+    nz = shape[-1]
+    depth = default_slab_depth(nz, workers)
+    comb = np.empty(shape, dtype=np.result_type(*[v.dtype for v in vols]), order=_memory_order(vols[0]))
+    is_float = comb.dtype.kind == "f"
+    step = max(1, comb.size // _MASK_SAMPLES)
+    samples, n_finite, n_neginf = [], [], []
+
+    def max_slab(sl) -> None:
+        c = comb[sl]
+        np.copyto(c, vols[0][sl])
+        for v in vols[1:]:
+            np.maximum(c, v[sl], out=c)
+        flat = c.ravel(order="K")
+        sample = flat[::step]
+        if is_float:
+            samples.append(sample[np.isfinite(sample)])
+            n_finite.append(np.count_nonzero(np.isfinite(flat)))
+            n_neginf.append(np.count_nonzero(flat == -np.inf))
+        else:
+            samples.append(sample.copy())
+            n_finite.append(flat.size)
+
+    run_slabs(max_slab, nz, depth, workers)
+
+    n = sum(n_finite)
+    if n == 0:
+        return np.zeros(shape, dtype=np.uint8)
+    n_neginf = sum(n_neginf)
+
+    # Ranks np.percentile(..., 95) interpolates between (linear method)
+    h = (n - 1) * _MASK_Q
+    lo = int(np.floor(h))
+    hi = min(lo + 1, n - 1)
+
+    sample = np.sort(np.concatenate(samples))
+    m = sample.size
+    margin = 0.002 + 6 * np.sqrt(_MASK_Q * (1 - _MASK_Q) / m)
+    lo_v = sample[int((_MASK_Q - margin) * (m - 1))] if _MASK_Q - margin > 0 else -np.inf
+    hi_v = sample[min(m - 1, int(np.ceil((_MASK_Q + margin) * (m - 1))))]
+
+    while True:
+        below, inside = [], []
+
+        def bracket_slab(sl) -> None:
+            flat = comb[sl].ravel(order="K")
+            below.append(np.count_nonzero(flat < lo_v))
+            inside.append(flat[(flat >= lo_v) & (flat <= hi_v)])
+
+        run_slabs(bracket_slab, nz, depth, workers)
+        # -inf is below any finite lo_v but is not part of the percentile sample
+        n_below = sum(below) - (n_neginf if lo_v > -np.inf else 0)
+        cand = np.concatenate(inside)
+        cand = np.sort(cand[np.isfinite(cand)] if is_float else cand)
+        if n_below > lo:
+            lo_v = -np.inf
+        elif n_below + cand.size <= hi:
+            hi_v = np.inf
+        else:
+            break
+
+    p = _lerp(float(cand[lo - n_below]), float(cand[hi - n_below]), h - lo)
+    if is_float:
+        # np.percentile returns the input's float type; threshold in it as before
+        p = comb.dtype.type(p)
+
+    thr = frac * p
+    mask = (comb > thr).astype(np.uint8)
+    return clean_mask(mask, fill_holes, largest_component)
+
+
+def _per_voxel(a: np.ndarray) -> np.ndarray:
+    """Angle terms as (n, 1) for uniform flip angles, unchanged if already (n, k) per voxel."""
+    return a[:, None] if a.ndim == 1 else a
+
+
+def _gather(
+    S: List[np.ndarray],
+    mask: Optional[np.ndarray],
+    dtype: np.dtype = np.float64,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Gather the voxels with finite, positive signal at every angle (and inside mask)
+    into one compact array. S holds one flattened (vox,) array per angle in any
+    numeric dtype. With a mask, only mask voxels are read and checked.
+    Returns (idx, Sg): flat block indices of the k gathered voxels and Sg of shape (n, k).
+    """
+    if mask is None:
+        good = np.ones(S[0].shape, dtype=bool)
+        for Si in S:
+            good &= Si > 0
+            if Si.dtype.kind == "f":
+                good &= np.isfinite(Si)
+        idx = np.flatnonzero(good)
+    else:
+        idx = np.flatnonzero(mask)
+
+    Sg = np.empty((len(S), idx.size), dtype=dtype)
+    for Si, row in zip(S, Sg):
+        row[...] = Si[idx]
+    if mask is not None:
+        ok = np.isfinite(Sg[0])
+        for row in Sg:
+            ok &= row > 0
+            ok &= np.isfinite(row)
+        if not ok.all():
+            idx = idx[ok]
+            Sg = np.compress(ok, Sg, axis=1)
+    return idx, Sg
+
+
+def _ols_kernel(
+    Sg: np.ndarray,
+    inv_sin: np.ndarray,
+    inv_tan: np.ndarray,
+    e1_min: float,
+    e1_max: float,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    OLS slope/intercept of y = E1*x + b for gathered voxels Sg (n, k), with
+    x_i = S_i/tan(a_i) and y_i = S_i/sin(a_i) formed on the fly row by row.
+    Returns (E1, b), both (k,) in Sg's dtype.
+    """
+    n = len(Sg)
+    k = Sg.shape[1]
+    dt = Sg.dtype
+
+    if n == 2:
+        # Closed-form 2-point slope
+        x1 = Sg[0] * inv_tan[0]
+        y1 = Sg[0] * inv_sin[0]
+        dx = Sg[1] * inv_tan[1]
+        dx -= x1
+        dy = Sg[1] * inv_sin[1]
+        dy -= y1
+        e1 = np.full(k, np.nan, dtype=dt)
+        ok = dx != 0
+        np.divide(dy, dx, out=e1, where=ok)
+        np.clip(e1, e1_min, e1_max, out=e1)
+        # b = mean(y) - E1*mean(x), as for N angles (E1 may have been clipped)
+        dx *= 0.5
+        x1 += dx
+        dy *= 0.5
+        y1 += dy
+        x1 *= e1
+        y1 -= x1
+        return e1, y1
+
+    Xm = np.zeros(k, dtype=dt)
+    Ym = np.zeros(k, dtype=dt)
+    tx = np.empty(k, dtype=dt)
+    for Si, it, is_ in zip(Sg, inv_tan, inv_sin):
+        np.multiply(Si, it, out=tx)
+        Xm += tx
+        np.multiply(Si, is_, out=tx)
+        Ym += tx
+    Xm /= n
+    Ym /= n
+
+    ty = np.empty(k, dtype=dt)
+    varX = np.zeros(k, dtype=dt)
+    covXY = np.zeros(k, dtype=dt)
+    for Si, it, is_ in zip(Sg, inv_tan, inv_sin):
+        np.multiply(Si, it, out=tx)
+        tx -= Xm
+        np.multiply(Si, is_, out=ty)
+        ty -= Ym
+        ty *= tx
+        covXY += ty
+        tx *= tx
+        varX += tx
+
+    # Avoid divide-by-zero (ill-conditioned when angles are too close / saturated)
+    e1 = np.full(k, np.nan, dtype=dt)
+    np.divide(covXY, varX, out=e1, where=varX > 0)
+    np.clip(e1, e1_min, e1_max, out=e1)
+
+    Xm *= e1
+    Ym -= Xm
+    return e1, Ym
+
+
+def _angle_sum(P: np.ndarray, a: np.ndarray) -> np.ndarray:
+    """sum_i a_i * P_i per voxel, with a per angle (n,) or per voxel (n, k)."""
+    return a @ P if a.ndim == 1 else np.einsum("ij,ij->j", a, P)
+
+
+def _wls_kernel(
+    Sg: np.ndarray,
+    inv_sin: np.ndarray,
+    inv_tan: np.ndarray,
+    e1_min: float,
+    e1_max: float,
+    n_iter: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    DESPOT1-WLS for gathered voxels, seeded by OLS.
+
+    With i.i.d. noise on S, the residual y - E1*x - b has std proportional to
+    (1 - E1*cos(a)) / sin(a), so each reweighting pass uses
+      w = (sin(a) / (1 - E1*cos(a)))**2 = 1 / (1/sin(a) - E1/tan(a))**2
+    from the previous E1 estimate, so no sin/cos is needed beside the OLS terms.
+    Since x = S/tan(a) and y = S/sin(a), the weighted sums of x, y, x*x and x*y
+    are per-angle combinations of w*S and w*S**2: one (n, k) buffer holds w, then w*S, then w*S**2, and the sums over angles are matrix-vector
+    products (einsums with per-voxel B1 angles). _fit_block calls it on _VOXEL_CHUNK
+    voxels at a time; with 2 passes a whole fit takes about 1.7x the OLS time
+    (vfa_benchmark.py fit, 96^3, 6 angles).
+    """
+    e1, bb = _ols_kernel(Sg, inv_sin, inv_tan, e1_min, e1_max)
+
+    # Angle products of the x*x and x*y sums, once for all passes
+    tt = inv_tan * inv_tan
+    ts = inv_tan * inv_sin
+    it = _per_voxel(inv_tan)
+    is_ = _per_voxel(inv_sin)
+    W = np.empty_like(Sg)
+
+    for _ in range(n_iter):
+        np.multiply(it, e1, out=W)
+        np.subtract(is_, W, out=W)
+        W *= W
+        np.reciprocal(W, out=W)
+        sw = W.sum(axis=0)
+        W *= Sg
+        sx = _angle_sum(W, inv_tan)
+        sy = _angle_sum(W, inv_sin)
+        W *= Sg
+        sxx = _angle_sum(W, tt)
+        sxy = _angle_sum(W, ts)
+
+        varX = sxx - sx * sx / sw
+        covXY = sxy - sx * sy / sw
+        e1 = np.full(varX.shape, np.nan, dtype=Sg.dtype)
+        np.divide(covXY, varX, out=e1, where=varX > 0)
+        np.clip(e1, e1_min, e1_max, out=e1)
+        bb = (sy - e1 * sx) / sw
+
+    return e1, bb
+
+
+def _lm_spgr(
+    S: np.ndarray,
+    sin_a: np.ndarray,
+    cos_a: np.ndarray,
+    e1: np.ndarray,
+    K: np.ndarray,
+    e1_min: float,
+    e1_max: float,
+    max_iter: int,
+    tol: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Batched Levenberg-Marquardt for S(a) = K*(1-E1)*sin(a)/(1-E1*cos(a)).
+
+    S is (n, k); e1/K are (k,) starting values. Every iteration solves the damped 2x2
+    normal equations of all still-active voxels at once in closed form; voxels drop out
+    of the active set as they converge. Returns (E1, K, converged, rss), all (k,).
+    sin_a/cos_a are (n,) for uniform flip angles or (n, k) per voxel (B1-corrected).
+    """
+    per_voxel = sin_a.ndim == 2
+    s = _per_voxel(sin_a)
+    c = _per_voxel(cos_a)
+    sc1 = s * (c - 1)
+
+    e1 = e1.copy()
+    K = K.copy()
+    k = S.shape[1]
+    lam = np.full(k, 1e-3, dtype=S.dtype)
+    converged = np.zeros(k, dtype=bool)
+    rss = np.sum((S - K * (1 - e1) * s / (1 - e1 * c)) ** 2, axis=0)
+
+    # Sa (and per-voxel s, c, sc1) hold the active voxels only: shrunk with the active
+    # set rather than gathered from the full arrays at every step. np.compress keeps
+    # them C-ordered (a[:, mask] returns F order, and strided sums over the angles)
+    active = np.arange(k)
+    Sa = S
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        ea = e1[active]
+        Ka = K[active]
+        la = lam[active]
+
+        D = 1 - ea * c
+        g = (1 - ea) * s / D  # df/dK
+        h = Ka * sc1 / (D * D)  # df/dE1
+        r = Sa - Ka * g
+
+        JtJ_kk = np.sum(g * g, axis=0)
+        JtJ_ke = np.sum(g * h, axis=0)
+        JtJ_ee = np.sum(h * h, axis=0)
+        Jtr_k = np.sum(g * r, axis=0)
+        Jtr_e = np.sum(h * r, axis=0)
+
+        A = JtJ_kk * (1 + la)
+        B = JtJ_ee * (1 + la)
+        det = A * B - JtJ_ke * JtJ_ke
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dK = (B * Jtr_k - JtJ_ke * Jtr_e) / det
+            dE = (A * Jtr_e - JtJ_ke * Jtr_k) / det
+
+        e_new = np.clip(ea + dE, e1_min, e1_max)
+        K_new = Ka + dK
+        rss_new = np.sum((Sa - K_new * (1 - e_new) * s / (1 - e_new * c)) ** 2, axis=0)
+
+        rss_old = rss[active]
+        better = np.isfinite(rss_new) & (rss_new < rss_old)
+        step_small = (np.abs(e_new - ea) <= tol * (np.abs(ea) + tol)) & (np.abs(dK) <= tol * (np.abs(Ka) + tol))
+        small_gain = better & ((rss_old - rss_new) <= tol * rss_old)
+        done = step_small | small_gain | (rss_old == 0)
+
+        e1[active] = np.where(better, e_new, ea)
+        K[active] = np.where(better, K_new, Ka)
+        rss[active] = np.where(better, rss_new, rss_old)
+        lam[active] = np.where(better, la * 0.1, la * 10.0)
+
+        converged[active] = done
+        keep = ~done & (lam[active] < 1e12)
+        if not keep.all():
+            active = active[keep]
+            Sa = np.compress(keep, Sa, axis=1)
+            if per_voxel:
+                s = np.compress(keep, s, axis=1)
+                c = np.compress(keep, c, axis=1)
+                sc1 = np.compress(keep, sc1, axis=1)
+
+    return e1, K, converged, rss
+
+
+# Voxels per chunk of the OLS / WLS kernels in _fit_block: the per-angle scratch (the
+# WLS weights, per-voxel B1 angle terms) then stays in cache, about twice as fast as
+# whole-slab passes at 6 angles
+_VOXEL_CHUNK = 8192
+
+
+def _fit_block(
+    S: List[np.ndarray],
+    mask: Optional[np.ndarray],
+    fas: np.ndarray,
+    e1_min: float,
+    e1_max: float,
+    fit: str = "ols",
+    wls_iter: int = 2,
+    nlls_max_iter: int = 50,
+    nlls_tol: float = 1e-6,
+    tr_s: Optional[float] = None,
+    b1: Optional[np.ndarray] = None,
+    precision: str = "float64",
+) -> Tuple[np.ndarray, List[np.ndarray]]:
+    """
+    Fit one block: S is a list of flattened (vox,) arrays, one per angle (fas in radians).
+    b1 is an optional flattened relative-B1 block; the actual flip angle of a voxel is
+    b1 * fas, so the angle terms become (n, k) arrays instead of (n,) scalars.
+    Returns (idx, outs): flat block indices of the k fitted voxels and, for those voxels,
+    [E1, b] for ols/wls or [E1, b, converged, rms] for nlls as (k,) arrays of the
+    precision dtype (E1 = b = nan where the fit is degenerate). For nlls, b = K*(1-E1)
+    and rms is the RMS signal residual. If tr_s is given, T1 (seconds, 0 where E1 is
+    not in (0, 1)) is appended.
+    """
+    dt = np.dtype(precision)
+    idx, Sg = _gather(S, mask, dt)
+
+    if b1 is None:
+        sin_a = np.sin(fas)
+        cos_a = np.cos(fas)
+        inv_sin = 1.0 / sin_a
+        inv_tan = cos_a * inv_sin
+        sin_a, cos_a, inv_sin, inv_tan = (a.astype(dt) for a in (sin_a, cos_a, inv_sin, inv_tan))
+    else:
+        # Only voxels whose scaled flip angles all stay inside (0, 180) degrees
+        b1g = np.asarray(b1)[idx].astype(dt, copy=False)
+        with np.errstate(invalid="ignore"):
+            b1_ok = np.isfinite(b1g) & (b1g > 0) & (b1g * fas.max() < np.pi)
+        if not b1_ok.all():
+            idx = idx[b1_ok]
+            Sg = np.compress(b1_ok, Sg, axis=1)
+            b1g = b1g[b1_ok]
+        half = (0.5 * fas).astype(dt)[:, None]
+        if fit == "nlls":
+            # Filled chunk by chunk below, then shared by every LM step
+            sin_a = np.empty(Sg.shape, dtype=dt)
+            cos_a = np.empty(Sg.shape, dtype=dt)
+
+    # OLS / WLS (the NLLS seed) _VOXEL_CHUNK voxels at a time; with a B1 map the
+    # per-voxel angle terms are made per chunk too, never for the whole block
+    k = idx.size
+    e1 = np.empty(k, dtype=dt)
+    bb = np.empty(k, dtype=dt)
+    for j in range(0, k, _VOXEL_CHUNK):
+        sl = slice(j, j + _VOXEL_CHUNK)
+        if b1 is None:
+            c_inv_sin, c_inv_tan = inv_sin, inv_tan
+        else:
+            # Tangent half-angle form: one tan per angle and voxel gives
+            #   1/sin(a) = 1/(2t) + t/2,  1/tan(a) = 1/(2t) - t/2,  t = tan(a/2)
+            t = half * b1g[sl]
+            np.tan(t, out=t)
+            c_inv_tan = 0.5 / t
+            t *= 0.5
+            c_inv_sin = c_inv_tan + t
+            c_inv_tan -= t
+            if fit == "nlls":
+                np.divide(1.0, c_inv_sin, out=sin_a[:, sl])
+                np.multiply(c_inv_tan, sin_a[:, sl], out=cos_a[:, sl])
+        if fit == "wls":
+            e1[sl], bb[sl] = _wls_kernel(Sg[:, sl], c_inv_sin, c_inv_tan, e1_min, e1_max, wls_iter)
+        else:
+            e1[sl], bb[sl] = _ols_kernel(Sg[:, sl], c_inv_sin, c_inv_tan, e1_min, e1_max)
+
+    if fit != "nlls":
+        outs = [e1, bb]
+    else:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            K0 = bb / (1 - e1)
+        seeded = np.isfinite(e1) & np.isfinite(K0)
+        if not seeded.all():
+            idx = idx[seeded]
+            Sg = np.compress(seeded, Sg, axis=1)
+            e1 = e1[seeded]
+            K0 = K0[seeded]
+            if b1 is not None:
+                sin_a = np.compress(seeded, sin_a, axis=1)
+                cos_a = np.compress(seeded, cos_a, axis=1)
+        e1, K, ok, rss = _lm_spgr(Sg, sin_a, cos_a, e1, K0, e1_min, e1_max, nlls_max_iter, nlls_tol)
+        outs = [e1, K * (1 - e1), ok.astype(dt), np.sqrt(rss / len(S))]
+
+    if tr_s is not None:
+        ok = np.isfinite(e1) & (e1 > 0) & (e1 < 1)
+        t1 = np.zeros(e1.shape, dtype=dt)
+        np.log(e1, out=t1, where=ok)
+        np.divide(-tr_s, t1, out=t1, where=ok)
+        outs.append(t1)
+    return idx, outs
+
+
+# Rough count of live (k,) arrays per angle in one _fit_block call, on top of the
+# native slab (one full plane per angle) that the gathered voxels are read from.
+# OLS: the gathered copy and scratch.
+# WLS: as OLS (its w / w*S / w*S**2 buffer holds one _VOXEL_CHUNK of voxels).
+# NLLS: OLS plus the D, g, h, r and model temporaries.
+# B1 maps add per-voxel sin and cos for NLLS, plus s*(cos - 1) in the LM (the
+# OLS / WLS angle terms are per chunk).
+_BLOCK_ARRAYS_PER_ANGLE = {"ols": 2, "wls": 2, "nlls": 7}
+_B1_ARRAYS_PER_ANGLE = {"ols": 0, "wls": 0, "nlls": 3}
+
+
+def slab_depth_for_budget(
+    shape: Tuple[int, ...],
+    n: int,
+    mem_budget_mb: float,
+    fit: str = "ols",
+    b1: bool = False,
+    precision: str = "float64",
+    occupancy: float = 1.0,
+) -> int:
+    """
+    Number of planes along the last axis that keep one slab fit within mem_budget_mb.
+    occupancy is the fraction of voxels inside the mask (the fit's working set scales
+    with it; the native slab does not). Always at least 1, at most shape[-1].
+    """
+    if mem_budget_mb <= 0:
+        raise ValueError(f"Memory budget must be > 0 MB; got {mem_budget_mb}")
+    plane_vox = int(np.prod(shape[:-1])) if len(shape) > 1 else 1
+    per_angle = _BLOCK_ARRAYS_PER_ANGLE[fit] + (_B1_ARRAYS_PER_ANGLE[fit] if b1 else 0)
+    occupancy = min(max(occupancy, 0.0), 1.0)
+    bytes_per_plane = plane_vox * np.dtype(precision).itemsize * (n + occupancy * (n * per_angle + 6))
+    depth = int(mem_budget_mb * 1024 * 1024 // bytes_per_plane)
+    return max(1, min(shape[-1], depth))
+
+
+def _check_vfa_inputs(
+    vols: List[np.ndarray],
+    fas_deg: List[float],
+    mask: Optional[np.ndarray],
+    workers: int,
+    b1: Optional[np.ndarray] = None,
+) -> Tuple[Tuple[int, ...], np.ndarray]:
+    n = len(vols)
+    if n < 2:
+        raise ValueError("Need at least 2 flip angles.")
+    if len(fas_deg) != n:
+        raise ValueError("Need one flip angle per volume.")
+
+    shape = vols[0].shape
+    for v in vols[1:]:
+        if v.shape != shape:
+            raise ValueError("All volumes must have same shape.")
+    if mask is not None and mask.shape != shape:
+        raise ValueError("Mask must have same shape as volumes.")
+    if b1 is not None and b1.shape != shape:
+        raise ValueError("B1 map must have same shape as volumes.")
+
+    fas = np.deg2rad(np.array(fas_deg, dtype=np.float64))
+    if np.any(fas <= 0) or np.any(fas >= np.pi):
+        raise ValueError("Flip angles must be in (0,180) degrees.")
+
+    if workers < 1:
+        raise ValueError(f"workers must be >= 1; got {workers}")
+    return shape, fas
+
+
+def _memory_order(v) -> str:
+    """'F' or 'C': memory order of the slabs a volume (ndarray or vfa_io.LazyVolume) yields."""
+    if isinstance(v, np.ndarray):
+        return "F" if np.isfortran(v) else "C"
+    return getattr(v, "order", "C")
+
+
+def _scatter(out: np.ndarray, idx: np.ndarray, values: np.ndarray, order: str) -> None:
+    """Write values to the flat (in the given order) positions idx of out, in place."""
+    contiguous = out.flags.f_contiguous if order == "F" else out.flags.c_contiguous
+    if contiguous:
+        out.reshape(-1, order=order)[idx] = values
+    else:
+        out[np.unravel_index(idx, out.shape, order=order)] = values
+
+
+def _fit_slabs(
+    block_fn: Callable,
+    vols: List[np.ndarray],
+    mask: Optional[np.ndarray],
+    fills: List[float],
+    mem_budget_mb: Optional[float],
+    workers: int,
+    fit: str,
+    b1: Optional[np.ndarray] = None,
+    precision: str = "float64",
+) -> List[np.ndarray]:
+    """
+    Run block_fn(S, mask_block, b1_block) -> (idx, len(fills) (k,) arrays) over the volume,
+    either in a single pass or slab by slab along the last axis, and scatter the results
+    into full-size outputs that hold fills everywhere else. Slabs without mask voxels
+    are neither read nor fitted.
+    """
+    n = len(vols)
+    shape = vols[0].shape
+    if mem_budget_mb is not None:
+        # Every worker holds one slab at a time
+        occupancy = np.count_nonzero(mask) / max(mask.size, 1) if mask is not None else 1.0
+        depth = slab_depth_for_budget(shape, n, mem_budget_mb / workers, fit, b1 is not None, precision, occupancy)
+    elif workers == 1:
+        depth = shape[-1]
+    else:
+        depth = default_slab_depth(shape[-1], workers)
+
+    outs = [np.full(shape, f, dtype=precision, order=_memory_order(vols[0])) for f in fills]
+
+    def fit_slab(sl) -> None:
+        m = None
+        if mask is not None:
+            m = np.asarray(mask[sl])
+            if not m.any():
+                return
+        S = [np.asarray(v[sl]) for v in vols]
+        # Flatten in the memory order of the data (Fortran for NIfTI) to avoid copies
+        order = "F" if np.isfortran(S[0]) else "C"
+        S = [Si.reshape(-1, order=order) for Si in S]
+        if m is not None:
+            m = m.reshape(-1, order=order)
+        b = np.asarray(b1[sl]).reshape(-1, order=order) if b1 is not None else None
+        idx, res = block_fn(S, m, b)
+        for o, r in zip(outs, res):
+            _scatter(o[sl], idx, r, order)
+
+    run_slabs(fit_slab, shape[-1], depth, workers)
+    return outs
+
+
+def vfa_fit_e1(
+    vols: List[np.ndarray],
+    fas_deg: List[float],
+    mask: Optional[np.ndarray] = None,
+    e1_min: float = 1e-6,
+    e1_max: float = 0.999999,
+    fit: str = "ols",
+    mem_budget_mb: Optional[float] = None,
+    workers: int = 1,
+    wls_iter: int = 2,
+    nlls_max_iter: int = 50,
+    nlls_tol: float = 1e-6,
+    tr_s: Optional[float] = None,
+    b1: Optional[np.ndarray] = None,
+    precision: str = "float64",
+) -> Dict[str, np.ndarray]:
+    """
+    Fit E1 voxelwise from 2+ flip-angle volumes (arrays or vfa_io.LazyVolume).
+    Returns {"E1", "b"} (plus "converged", "rms" for fit="nlls"), arrays of the
+    volume shape with nan where no fit was made. If tr_s is given, "T1" (seconds, 0
+    where no fit was made, as e1_to_t1) is computed in the same pass.
+
+    precision ("float64" or "float32") is the dtype of all intermediates and outputs.
+
+    b1 is an optional relative B1 map (1.0 = nominal): each voxel's flip angles are
+    b1 * fas_deg. Voxels with non-finite/non-positive B1, or whose scaled angles leave
+    (0, 180) degrees, are not fitted.
+
+    If mem_budget_mb is given, the fit streams over slabs along the last (z) axis
+    so that the working set of each slab stays within the budget. With workers > 1,
+    slabs are fitted concurrently by a thread pool (inputs and outputs are shared,
+    not copied; NumPy releases the GIL in the heavy ufuncs/reductions).
+    The per-voxel arithmetic does not depend on the slab size, so streamed and
+    threaded results are identical to the single-pass fit.
+    """
+    _, fas = _check_vfa_inputs(vols, fas_deg, mask, workers, b1)
+    if fit not in FIT_METHODS:
+        raise ValueError(f"fit must be one of {FIT_METHODS}; got {fit!r}")
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {PRECISIONS}; got {precision!r}")
+    if wls_iter < 1:
+        raise ValueError(f"wls_iter must be >= 1; got {wls_iter}")
+    if nlls_max_iter < 1:
+        raise ValueError(f"nlls_max_iter must be >= 1; got {nlls_max_iter}")
+
+    if tr_s is not None and tr_s <= 0:
+        raise ValueError(f"TR must be > 0 seconds; got {tr_s}")
+
+    def block(S, m, b):
+        return _fit_block(S, m, fas, e1_min, e1_max, fit, wls_iter, nlls_max_iter, nlls_tol, tr_s, b, precision)
+
+    names = ["E1", "b", "converged", "rms"] if fit == "nlls" else ["E1", "b"]
+    fills = [np.nan] * len(names)
+    if tr_s is not None:
+        names.append("T1")
+        fills.append(0.0)
+    outs = _fit_slabs(block, vols, mask, fills, mem_budget_mb, workers, fit, b1, precision)
+    return dict(zip(names, outs))
+
+
+def vfa_fit_e1_least_squares(
+    vols: List[np.ndarray],
+    fas_deg: List[float],
+    mask: Optional[np.ndarray],
+    e1_min: float,
+    e1_max: float,
+    mem_budget_mb: Optional[float] = None,
+    workers: int = 1,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit E1 (slope) and intercept voxelwise using OLS for y = E1*x + b.
+    Returns (E1, b). Voxels failing mask get E1=nan, b=nan.
+    """
+    r = vfa_fit_e1(vols, fas_deg, mask, e1_min, e1_max, "ols", mem_budget_mb, workers)
+    return r["E1"], r["b"]
+
+
+def vfa_fit_e1_wls(
+    vols: List[np.ndarray],
+    fas_deg: List[float],
+    mask: Optional[np.ndarray],
+    e1_min: float,
+    e1_max: float,
+    mem_budget_mb: Optional[float] = None,
+    workers: int = 1,
+    n_iter: int = 2,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit E1 and intercept voxelwise by iteratively reweighted least squares
+    (DESPOT1-WLS, n_iter reweighting passes after the OLS seed).
+    Returns (E1, b). Voxels failing mask get E1=nan, b=nan.
+    """
+    r = vfa_fit_e1(vols, fas_deg, mask, e1_min, e1_max, "wls", mem_budget_mb, workers, wls_iter=n_iter)
+    return r["E1"], r["b"]
+
+
+def vfa_fit_e1_nlls(
+    vols: List[np.ndarray],
+    fas_deg: List[float],
+    mask: Optional[np.ndarray],
+    e1_min: float,
+    e1_max: float,
+    mem_budget_mb: Optional[float] = None,
+    workers: int = 1,
+    max_iter: int = 50,
+    tol: float = 1e-6,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fit S(a) = K*(1-E1)*sin(a)/(1-E1*cos(a)) voxelwise by nonlinear least squares
+    (batched Levenberg-Marquardt, seeded by the OLS fit).
+    Returns (E1, b, converged, rms); b = K*(1-E1) matches the OLS intercept,
+    converged is 1/0 and rms is the RMS signal residual. Voxels failing mask get nan.
+    """
+    r = vfa_fit_e1(
+        vols, fas_deg, mask, e1_min, e1_max, "nlls", mem_budget_mb, workers,
+        nlls_max_iter=max_iter, nlls_tol=tol,
+    )
+    return r["E1"], r["b"], r["converged"], r["rms"]
+
+
+def e1_to_t1(E1: np.ndarray, tr_s: float, fill: float = 0.0) -> np.ndarray:
+    T1 = np.full(E1.shape, fill, dtype=np.float64)
+    good = np.isfinite(E1) & (E1 > 0) & (E1 < 1)
+    T1[good] = -tr_s / np.log(E1[good])
+    return T1
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+vfa_io.py
+
+Lazy NIfTI access for the VFA scripts (vfa_t1map_2fa.py, vfa_t1map_multi.py).
+
+nib.load(...).get_fdata(dtype=np.float32) decompresses and casts the whole volume
+before the fit casts it again to float64. LazyVolume instead:
+  - memory-maps uncompressed .nii files directly (np.memmap at the header's vox_offset)
+  - slices .nii.gz files through nibabel's array proxy, keeping the gzip stream open
+    so that consecutive z-slabs are read with forward seeks only
+  - returns slabs in the on-disk dtype; scl_slope/scl_inter are only applied to the
+    slab being read, and only when they are not the identity
+
+Slabs are taken along the last axis (z for 3D volumes), which is contiguous on disk
+for NIfTI's Fortran-ordered data. run_slabs() schedules per-slab work, optionally
+on a thread pool: slabs share the input/output arrays instead of pickling them, and
+NumPy releases the GIL in the elementwise ops and reductions the fitters use.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Tuple
+
+import numpy as np
+import nibabel as nib
+
+
+class LazyVolume:
+    """
+    Array-like, read-only view of a NIfTI image.
+
+    Supports .shape/.ndim/.dtype, basic slicing (v[..., z0:z1]) and np.asarray(v).
+    Slices come back in NIfTI's Fortran memory order (.order).
+    """
+
+    order = "F"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.img = nib.load(path, mmap=True, keep_file_open=True)
+        proxy = self.img.dataobj
+        self.shape: Tuple[int, ...] = tuple(int(s) for s in proxy.shape)
+        self.raw_dtype = np.dtype(self.img.header.get_data_dtype())
+
+        slope = getattr(proxy, "slope", 1.0)
+        inter = getattr(proxy, "inter", 0.0)
+        self.slope = 1.0 if slope is None or not np.isfinite(slope) or slope == 0 else float(slope)
+        self.inter = 0.0 if inter is None or not np.isfinite(inter) else float(inter)
+
+        self._mmap = None
+        if not path.endswith(".gz"):
+            try:
+                self._mmap = np.memmap(
+                    path,
+                    dtype=self.raw_dtype,
+                    mode="r",
+                    offset=int(proxy.offset),
+                    shape=self.shape,
+                    order="F",
+                )
+            except (ValueError, OSError):
+                # Truncated/odd files: fall back to proxy slicing
+                self._mmap = None
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def scaled(self) -> bool:
+        return self.slope != 1.0 or self.inter != 0.0
+
+    @property
+    def dtype(self) -> np.dtype:
+        """dtype of the arrays returned by slicing."""
+        if self.scaled:
+            return np.result_type(self.raw_dtype, np.float32)
+        return self.raw_dtype
+
+    def _scale(self, raw: np.ndarray) -> np.ndarray:
+        if not self.scaled:
+            return raw
+        out = np.asarray(raw, dtype=self.dtype) * self.dtype.type(self.slope)
+        if self.inter != 0.0:
+            out += self.dtype.type(self.inter)
+        return out
+
+    def __getitem__(self, key) -> np.ndarray:
+        if self._mmap is not None:
+            return self._scale(self._mmap[key])
+        # ArrayProxy applies slope/inter itself, and only to the requested slice
+        return np.asarray(self.img.dataobj[key]).astype(self.dtype, copy=False)
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[...]
+        if dtype is not None:
+            arr = arr.astype(dtype, copy=False)
+        return np.asarray(arr)
+
+
+def load_nifti(path: str) -> Tuple[np.ndarray, nib.Nifti1Image]:
+    img = nib.load(path)
+    data = img.get_fdata(dtype=np.float32)
+    return data, img
+
+
+def save_like(data: np.ndarray, ref_img: nib.Nifti1Image, path: str) -> None:
+    """Save data with ref_img's affine/header and data's dtype."""
+    out_img = nib.Nifti1Image(data, affine=ref_img.affine, header=ref_img.header)
+    out_img.header.set_data_dtype(data.dtype)
+    nib.save(out_img, path)
+
+
+def load_nifti_lazy(path: str) -> Tuple[LazyVolume, nib.Nifti1Image]:
+    """Drop-in for load_nifti() that defers reading voxel data."""
+    v = LazyVolume(path)
+    return v, v.img
+
+
+def default_slab_depth(nz: int, workers: int, slabs_per_worker: int = 4) -> int:
+    """Slab depth giving each worker a few slabs, for load balancing across the mask."""
+    return max(1, -(-nz // (workers * slabs_per_worker)))
+
+
+def run_slabs(fn: Callable, nz: int, depth: int, workers: int = 1) -> None:
+    """Call fn(slice) for every slab along the last axis, on a thread pool if workers > 1."""
+    slabs = [(Ellipsis, slice(z0, min(z0 + depth, nz))) for z0 in range(0, nz, depth)]
+    if workers == 1 or len(slabs) == 1:
+        for sl in slabs:
+            fn(sl)
+        return
+    with ThreadPoolExecutor(max_workers=min(workers, len(slabs))) as ex:
+        # list() re-raises the first worker exception here
+        list(ex.map(fn, slabs))
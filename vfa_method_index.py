@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+vfa_method_index.py
+
+Persistent index of parsed Bruker .method / acqp files for the VFA tools.
+
+Each entry is keyed by absolute path and is only trusted while the file's mtime and
+size (and vfa_core.METHOD_PARSER_VERSION) are unchanged. It holds the ##$KEY=VALUE
+record strings (compressed JSON; values are typed when read, as with
+parse_bruker_method) plus the inferred TR (s) and flip angle (deg), in one SQLite file.
+
+vfa_core.infer_tr_fa_from_method() goes through the index when one is active
+(vfa_core.use_method_index(), --method-index in the VFA scripts, or the
+VFA_METHOD_INDEX environment variable): hits skip the parse, misses are parsed
+and recorded.
+
+Usage:
+  # index a study archive: parallel parse, unchanged files are skipped
+  python vfa_method_index.py index /data/study --index ~/vfa_methods.sqlite --workers 8
+
+  # TR/FA (and any other keys) of everything indexed under a folder, without walking it
+  python vfa_method_index.py query /data/study/mouse12 --index ~/vfa_methods.sqlite --keys PVM_EchoTime
+
+  # drop entries whose files are gone or changed
+  python vfa_method_index.py prune --index ~/vfa_methods.sqlite
+
+  # then, for the VFA scripts:
+  export VFA_METHOD_INDEX=~/vfa_methods.sqlite
+"""
+
+import argparse
+import csv
+import fnmatch
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from vfa_core import METHOD_PARSER_VERSION, MethodParams, infer_tr_fa, parse_bruker_method
+
+
+DEFAULT_PATTERNS = ("method", "acqp", "*.method")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path     TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size     INTEGER NOT NULL,
+    parser   INTEGER NOT NULL,
+    tr_s     REAL,
+    fa_deg   REAL,
+    details  TEXT NOT NULL,
+    params   BLOB NOT NULL
+)
+"""
+_COLUMNS = ("path", "mtime_ns", "size", "parser", "tr_s", "fa_deg", "details", "params")
+
+
+def _pack(params: MethodParams) -> bytes:
+    # The undecoded record strings: building the index never pays for decoding the
+    # large arrays, and values are decoded per key when a record is read back.
+    # Mostly long numeric text, so compressed JSON keeps the index several times
+    # smaller than the files it describes
+    return zlib.compress(json.dumps(params.raw, separators=(",", ":")).encode("utf-8"), 1)
+
+
+def _unpack(blob: bytes) -> MethodParams:
+    return MethodParams(json.loads(zlib.decompress(blob)))
+
+
+def parse_record(path: str) -> Dict[str, object]:
+    """Parse one method/acqp file into an index record (stat taken before reading)."""
+    p = os.path.abspath(path)
+    st = os.stat(p)
+    params = parse_bruker_method(p)
+    tr_s, fa, details = infer_tr_fa(params)
+    return {
+        "path": p,
+        "mtime_ns": st.st_mtime_ns,
+        "size": st.st_size,
+        "parser": METHOD_PARSER_VERSION,
+        "tr_s": tr_s,
+        "fa_deg": fa,
+        "details": details,
+        "params": params,
+    }
+
+
+def _parse_or_error(path: str) -> Dict[str, object]:
+    try:
+        return parse_record(path)
+    except Exception as e:
+        return {"path": os.path.abspath(path), "error": f"{type(e).__name__}: {e}"}
+
+
+class MethodIndex:
+    """
+    SQLite-backed cache of parse_record() results; safe to share between threads.
+    Records are dicts with the _COLUMNS keys, "params" being a vfa_core.MethodParams.
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        d = os.path.dirname(self.path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(_SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self) -> "MethodIndex":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    @staticmethod
+    def _record(row: Tuple) -> Dict[str, object]:
+        rec = dict(zip(_COLUMNS, row))
+        if "params" in rec:
+            rec["params"] = _unpack(rec["params"])
+        return rec
+
+    @staticmethod
+    def _fresh(rec: Dict[str, object], st: os.stat_result) -> bool:
+        return (
+            rec["mtime_ns"] == st.st_mtime_ns
+            and rec["size"] == st.st_size
+            and rec["parser"] == METHOD_PARSER_VERSION
+        )
+
+    def get(self, path: str, with_params: bool = True) -> Optional[Dict[str, object]]:
+        """
+        Cached record for path if it is still valid for the file on disk, else None.
+        with_params=False skips decoding the parameter dict (no "params" key).
+        """
+        p = os.path.abspath(path)
+        cols = _COLUMNS if with_params else _COLUMNS[:-1]
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT {', '.join(cols)} FROM files WHERE path = ?", (p,)
+            ).fetchone()
+        if row is None:
+            return None
+        rec = self._record(row)
+        try:
+            st = os.stat(p)
+        except OSError:
+            return None
+        return rec if self._fresh(rec, st) else None
+
+    def put(self, records: List[Dict[str, object]]) -> None:
+        rows = [
+            tuple(_pack(r["params"]) if c == "params" else r[c] for c in _COLUMNS)
+            for r in records
+        ]
+        with self._lock, self._db:
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO files ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})",
+                rows,
+            )
+
+    def lookup(self, path: str, with_params: bool = True) -> Dict[str, object]:
+        """Cached record, or parse the file and record it. Raises FileNotFoundError like parse_bruker_method."""
+        rec = self.get(path, with_params)
+        if rec is not None:
+            return rec
+        rec = parse_record(path)
+        try:
+            self.put([rec])
+        except sqlite3.Error:
+            # Read-only or locked index: still answer from the fresh parse
+            pass
+        return rec
+
+    def tr_fa(self, path: str) -> Tuple[Optional[float], Optional[float], str]:
+        """Drop-in for vfa_core.infer_tr_fa_from_method()."""
+        rec = self.lookup(path, with_params=False)
+        return rec["tr_s"], rec["fa_deg"], rec["details"]
+
+    def query(self, root: str) -> List[Dict[str, object]]:
+        """Records of the current parser version under the folder root (not checked against the files)."""
+        prefix = os.path.join(os.path.abspath(root), "")
+        # Paths starting with prefix sort between prefix and prefix + U+10FFFF
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM files WHERE path >= ? AND path < ? AND parser = ? ORDER BY path",
+                (prefix, prefix + "\U0010ffff", METHOD_PARSER_VERSION),
+            ).fetchall()
+        return [self._record(r) for r in rows]
+
+    def stamps(self) -> Dict[str, Tuple[int, int, int]]:
+        """path -> (mtime_ns, size, parser) for every record."""
+        with self._lock:
+            rows = self._db.execute("SELECT path, mtime_ns, size, parser FROM files").fetchall()
+        return {r[0]: tuple(r[1:]) for r in rows}
+
+    def delete(self, paths: List[str]) -> None:
+        with self._lock, self._db:
+            self._db.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in paths])
+
+
+def walk_method_files(root: str, patterns=DEFAULT_PATTERNS) -> Iterator[Tuple[str, os.stat_result]]:
+    """Yield (path, stat) of files under root whose name matches any pattern (one scandir walk)."""
+    stack = [os.path.abspath(root)]
+    while stack:
+        d = stack.pop()
+        try:
+            with os.scandir(d) as it:
+                for e in it:
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            stack.append(e.path)
+                        elif any(fnmatch.fnmatchcase(e.name, p) for p in patterns) and e.is_file():
+                            yield e.path, e.stat()
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+
+
+def index_tree(
+    index: MethodIndex,
+    root: str,
+    workers: int = 1,
+    patterns=DEFAULT_PATTERNS,
+    batch: int = 500,
+) -> Dict[str, object]:
+    """
+    Bring the index up to date for every matching file under root: unchanged files are
+    skipped, new/changed ones are parsed (in worker processes if workers > 1).
+    Returns counts and the list of files that failed to parse.
+    """
+    stamps = index.stamps()
+    found = 0
+    todo = []
+    for path, st in walk_method_files(root, patterns):
+        found += 1
+        if stamps.get(path) != (st.st_mtime_ns, st.st_size, METHOD_PARSER_VERSION):
+            todo.append(path)
+
+    errors = []
+    pending = []
+
+    def flush() -> None:
+        if pending:
+            index.put(pending)
+            pending.clear()
+
+    def collect(rec: Dict[str, object]) -> None:
+        if "error" in rec:
+            errors.append(rec)
+            return
+        pending.append(rec)
+        if len(pending) >= batch:
+            flush()
+
+    if workers > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            for rec in ex.map(_parse_or_error, todo, chunksize=max(1, min(64, len(todo) // (4 * workers)))):
+                collect(rec)
+    else:
+        for path in todo:
+            collect(_parse_or_error(path))
+    flush()
+
+    return {
+        "found": found,
+        "unchanged": found - len(todo),
+        "parsed": len(todo) - len(errors),
+        "errors": errors,
+    }
+
+
+def prune_index(index: MethodIndex) -> int:
+    """Delete records whose file is gone or no longer matches; returns the count."""
+    stale = []
+    for path, (mtime_ns, size, parser) in index.stamps().items():
+        try:
+            st = os.stat(path)
+        except OSError:
+            stale.append(path)
+            continue
+        if (st.st_mtime_ns, st.st_size, parser) != (mtime_ns, size, METHOD_PARSER_VERSION):
+            stale.append(path)
+    index.delete(stale)
+    return len(stale)
+
+
+# -------------------------
+# CLI
+# -------------------------
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Build and query the Bruker method/acqp metadata index used by the VFA scripts.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    def common(p):
+        p.add_argument("--index", default=os.environ.get("VFA_METHOD_INDEX"), help="Index file (default: $VFA_METHOD_INDEX)")
+
+    p = sub.add_parser("index", help="Parse every method/acqp file under a folder into the index")
+    p.add_argument("root")
+    common(p)
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Parser processes (default: all CPUs)")
+    p.add_argument("--patterns", nargs="+", default=list(DEFAULT_PATTERNS), help="File name patterns to index (default: method acqp *.method)")
+
+    p = sub.add_parser("query", help="Print TR/FA of the indexed files under a folder as CSV")
+    p.add_argument("root")
+    common(p)
+    p.add_argument("--keys", nargs="+", default=[], help="Extra parameters to print")
+
+    p = sub.add_parser("prune", help="Drop records of deleted or changed files")
+    common(p)
+
+    args = ap.parse_args()
+    if not args.index:
+        ap.error("--index is required (or set VFA_METHOD_INDEX)")
+    if getattr(args, "workers", 1) < 1:
+        ap.error("--workers must be >= 1")
+    return args
+
+
+def main():
+    args = parse_args()
+    with MethodIndex(args.index) as index:
+        if args.cmd == "index":
+            if not os.path.isdir(args.root):
+                raise SystemExit(f"ERROR: Not a folder: {args.root}")
+            t0 = time.perf_counter()
+            res = index_tree(index, args.root, args.workers, args.patterns)
+            print("=== Method index ===")
+            print(f"Index    : {index.path}")
+            print(f"Root     : {os.path.abspath(args.root)}")
+            print(f"Files    : {res['found']} ({res['unchanged']} unchanged, {res['parsed']} parsed, {len(res['errors'])} failed)")
+            print(f"Time     : {time.perf_counter() - t0:.2f} s ({args.workers} workers)")
+            for e in res["errors"]:
+                print(f"[FAILED] {e['path']}: {e['error']}", file=sys.stderr)
+            return 1 if res["errors"] else 0
+
+        if args.cmd == "query":
+            w = csv.writer(sys.stdout)
+            w.writerow(["path", "tr_s", "fa_deg", *args.keys])
+            for rec in index.query(args.root):
+                w.writerow([rec["path"], rec["tr_s"], rec["fa_deg"], *[rec["params"].get(k, "") for k in args.keys]])
+            return 0
+
+        n = prune_index(index)
+        print(f"Pruned {n} stale records from {index.path}")
+        return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,593 @@
+#!/usr/bin/env python3
+"""
+vfa_pipeline.py
+
+Per-subject N4 -> VFA T1 -> QA pipeline for a whole study in one submission.
+
+Usage:
+  python vfa_pipeline.py run --manifest study.csv -- --auto-mask --workers 4
+  python vfa_pipeline.py run --manifest study.csv --executor local
+  python vfa_pipeline.py qa --t1 sub01_T1.nii.gz --mask sub01_mask.nii.gz
+
+The manifest is the one of vfa_t1map_batch.py (subject, imgs, out and optionally
+methods, mask, b1map, fas, tr). Every subject becomes a small DAG of jobs:
+
+  n4/<k>  N4BiasFieldCorrection of imgs[k] -> <img>_bfc.nii.gz (+ .method copy),
+          same job script as submit_simple_n4_slurm.py
+  vfa     vfa_t1map_multi.py on the bias-corrected images -> out
+  qa      T1 summary inside the mask -> <out stem>_qa.json; fails on implausible maps
+
+With --executor slurm (default) all jobs are submitted at once, each with
+--dependency=afterok on its own subject's jobs only: a subject's T1 fit starts as soon
+as its N4 jobs finish, not after the whole batch. With --executor local the same
+scripts run on this machine, each job as soon as its dependencies are done.
+
+Arguments after the run options (optionally after "--") go to vfa_t1map_multi.py.
+
+Re-running resumes. Every submission/run is recorded in a JSON-lines ledger (see
+slurm_submit.py) keyed by "<subject>/<node>". A node is skipped when its outputs exist
+(for qa: a passing report) and its last ledger record is not failed/blocked, unless
+something upstream of it is rerun. A node whose Slurm job is still pending or running
+is not resubmitted; its job id is reused for the dependencies of the nodes after it.
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from slurm_submit import (
+    LocalEngine,
+    SubmissionEngine,
+    SubmitRequest,
+    SubmitResult,
+    available_cpus,
+    job_active,
+    read_ledger,
+)
+from submit_simple_n4_slurm import N4_DEFAULTS, build_job_script, shell_quote
+from vfa_core import default_adjacent_method_path
+from vfa_t1map_batch import check_extra_args, load_manifest, subject_argv
+from vfa_t1map_multi import sidecar_path
+
+HERE = Path(__file__).resolve().parent
+
+# ledger statuses after which a node's outputs are not trusted
+BAD_STATUSES = ("failed", "blocked")
+
+
+# -------------------------
+# DAG
+# -------------------------
+
+@dataclass
+class Node:
+    key: str  # "<subject>/<stage>", the ledger key
+    job_name: str
+    script: str  # job script text
+    outputs: List[str]
+    deps: List[str] = field(default_factory=list)  # keys of nodes that must succeed first
+    complete: Optional[Callable[[], bool]] = None  # overrides "all outputs exist"
+
+    def outputs_ok(self) -> bool:
+        if self.complete is not None:
+            return self.complete()
+        return all(os.path.isfile(p) for p in self.outputs)
+
+
+def safe_name(s: str) -> str:
+    return re.sub(r"[^\w.-]", "_", s)
+
+
+def qa_report_path(t1_out: str) -> str:
+    """foo.nii.gz -> foo_qa.json."""
+    for ext in (".nii.gz", ".nii"):
+        if t1_out.endswith(ext):
+            return t1_out[: -len(ext)] + "_qa.json"
+    return t1_out + "_qa.json"
+
+
+def qa_passed(report: str) -> bool:
+    try:
+        with open(report, "r", encoding="utf-8") as f:
+            return bool(json.load(f).get("passed"))
+    except (OSError, ValueError):
+        return False
+
+
+def python_job_script(
+    *,
+    argv: List[str],
+    job_name: str,
+    sbatch_dir: Path,
+    cpus: int,
+    mem_gb: int,
+    time_str: str,
+    partition: str | None,
+) -> str:
+    """Job script running one command (argv), with the same header and log layout as the N4 jobs."""
+    log_pattern = sbatch_dir / "slurm-%j.out"
+
+    lines = [
+        "#!/bin/bash",
+        f"#SBATCH --job-name={job_name}",
+        f"#SBATCH --output={log_pattern}",
+        f"#SBATCH --error={log_pattern}",
+        f"#SBATCH --cpus-per-task={cpus}",
+        f"#SBATCH --mem={mem_gb}G",
+        f"#SBATCH --time={time_str}",
+    ]
+
+    if partition:
+        lines.append(f"#SBATCH --partition={partition}")
+
+    cmd = "\n".join(f"    {shell_quote(str(a))}" for a in argv)
+
+    return "\n".join(lines) + f"""
+
+set -euo pipefail
+
+echo "===== JOB START ====="
+date
+hostname
+echo "SLURM_JOB_ID=${{SLURM_JOB_ID:-}}"
+
+cmd=(
+{cmd}
+)
+
+echo
+printf '  %q' "${{cmd[@]}}"
+echo
+
+"${{cmd[@]}}"
+
+echo
+echo "===== JOB END ====="
+date
+"""
+
+
+def subject_nodes(entry: Dict[str, object], args: argparse.Namespace, extra: List[str], sbatch_dir: Path) -> List[Node]:
+    """n4/<k> for each image, then vfa, then qa (topological order)."""
+    subject = entry["subject"]
+    tag = safe_name(subject)
+    resources = dict(cpus=args.cpus, mem_gb=args.mem_gb, time_str=args.time, partition=args.partition)
+
+    nodes = []
+    bfc_imgs = []
+    methods = entry.get("methods")
+    adjacent = [default_adjacent_method_path(img) for img in entry["imgs"]]
+    if not methods and all(os.path.isfile(m) for m in adjacent):
+        methods = adjacent  # the originals: no need to rely on the N4 job's .method copy
+
+    for k, img in enumerate(entry["imgs"]):
+        output_nii = sidecar_path(img, args.output_suffix)
+        bias_nii = sidecar_path(img, args.bias_suffix)
+        method_in = default_adjacent_method_path(img)
+        job_name = f"n4_{tag}_{k}"
+
+        script = build_job_script(
+            input_nii=Path(img),
+            output_nii=Path(output_nii),
+            bias_nii=Path(bias_nii),
+            mask_nii=Path(entry["mask"]) if args.n4_mask and entry.get("mask") else None,
+            method_in=Path(method_in) if os.path.isfile(method_in) else None,
+            method_out=Path(default_adjacent_method_path(output_nii)),
+            sbatch_dir=sbatch_dir,
+            n4_path=args.n4_path,
+            imagemath_path=args.imagemath_path,
+            threads=args.cpus,
+            overwrite=False,
+            job_name=job_name,
+            **N4_DEFAULTS,
+            **resources,
+        )
+        nodes.append(Node(f"{subject}/n4/{k}", job_name, script, [output_nii, bias_nii]))
+        bfc_imgs.append(output_nii)
+
+    vfa_entry = dict(entry, imgs=bfc_imgs, methods=methods)
+    vfa_argv = [args.python, str(HERE / "vfa_t1map_multi.py"), *subject_argv(vfa_entry, extra)]
+    nodes.append(
+        Node(
+            f"{subject}/vfa",
+            f"vfa_{tag}",
+            python_job_script(argv=vfa_argv, job_name=f"vfa_{tag}", sbatch_dir=sbatch_dir, **resources),
+            [entry["out"]],
+            deps=[n.key for n in nodes],
+        )
+    )
+
+    report = qa_report_path(entry["out"])
+    qa_argv = [
+        args.python, str(HERE / "vfa_pipeline.py"), "qa",
+        "--t1", entry["out"],
+        "--report", report,
+        "--t1-range", str(args.qa_t1_range[0]), str(args.qa_t1_range[1]),
+        "--min-fitted", str(args.qa_min_fitted),
+        "--max-out-of-range", str(args.qa_max_out_of_range),
+    ]
+    if entry.get("mask"):
+        qa_argv += ["--mask", entry["mask"]]
+    nodes.append(
+        Node(
+            f"{subject}/qa",
+            f"qa_{tag}",
+            python_job_script(argv=qa_argv, job_name=f"qa_{tag}", sbatch_dir=sbatch_dir, **dict(resources, cpus=1)),
+            [report],
+            deps=[f"{subject}/vfa"],
+            complete=lambda report=report: qa_passed(report),
+        )
+    )
+    return nodes
+
+
+def plan(nodes: List[Node], ledger: Dict[str, dict], executor: str) -> Dict[str, tuple]:
+    """
+    key -> ("complete", None) | ("active", job_id) | ("run", None), nodes in topological order.
+    A node reruns if its outputs are missing or untrusted, or if anything upstream reruns.
+    """
+    actions = {}
+    for node in nodes:
+        rec = ledger.get(node.key) or {}
+        upstream_rerun = any(actions[d][0] == "run" for d in node.deps)
+
+        if not upstream_rerun and rec.get("status") not in BAD_STATUSES and node.outputs_ok():
+            actions[node.key] = ("complete", None)
+        elif (
+            executor == "slurm"
+            and not upstream_rerun
+            and rec.get("status") == "submitted"
+            and rec.get("job_id")
+            and job_active(rec["job_id"])
+        ):
+            actions[node.key] = ("active", rec["job_id"])
+        else:
+            actions[node.key] = ("run", None)
+    return actions
+
+
+# -------------------------
+# Execution
+# -------------------------
+
+def write_script(node: Node, sbatch_dir: Path) -> Path:
+    path = sbatch_dir / f"TMP_{node.job_name}.sbatch"
+    path.write_text(node.script)
+    return path
+
+
+def report_result(result: SubmitResult, verb: str) -> None:
+    key = result.request.key
+
+    if result.ok:
+        line = f"[{verb}] {key} (job {result.job_id}"
+        line += f", {result.seconds:.1f} s)" if result.seconds is not None else ")"
+        print(line, flush=True)
+        return
+
+    print(f"[FAILED] {key}" + (f" (job {result.job_id})" if result.job_id else ""), file=sys.stderr, flush=True)
+    print(f"  {result.error}", file=sys.stderr, flush=True)
+
+
+def block(engine: SubmissionEngine, node: Node, reason: str) -> None:
+    print(f"[BLOCKED] {node.key}: {reason}", file=sys.stderr, flush=True)
+    engine.record(key=node.key, job_id=None, script="", status="blocked", error=reason)
+
+
+def run_slurm(engine: SubmissionEngine, nodes: List[Node], actions: Dict[str, tuple], sbatch_dir: Path) -> Dict[str, str]:
+    """
+    Submit the nodes to run in dependency waves (all n4 jobs, then all vfa jobs, ...),
+    each with --dependency=afterok on its own upstream jobs. Returns key -> final state.
+    """
+    by_key = {n.key: n for n in nodes}
+    job_ids = {k: a[1] for k, a in actions.items() if a[0] == "active"}
+    state = {k: a[0] for k, a in actions.items()}
+
+    depth = {}
+    for node in nodes:
+        depth[node.key] = 1 + max((depth[d] for d in node.deps), default=-1)
+
+    for level in sorted(set(depth.values())):
+        requests = []
+        for node in nodes:
+            if depth[node.key] != level or state[node.key] != "run":
+                continue
+
+            bad = [d for d in node.deps if state[d] in ("failed", "blocked")]
+            if bad:
+                state[node.key] = "blocked"
+                block(engine, node, f"{bad[0]} {state[bad[0]]}")
+                continue
+
+            sbatch_args = []
+            dep_ids = [job_ids[d] for d in node.deps if d in job_ids]
+            if dep_ids:
+                sbatch_args = [f"--dependency=afterok:{':'.join(dep_ids)}", "--kill-on-invalid-dep=yes"]
+
+            requests.append(SubmitRequest(node.key, write_script(node, sbatch_dir), node.job_name, sbatch_args))
+
+        for result in engine.submit_all(requests, on_result=lambda r: report_result(r, "SUBMITTED")):
+            key = result.request.key
+            if result.ok:
+                job_ids[key] = result.job_id
+                state[key] = "submitted"
+            else:
+                state[key] = "failed"
+
+    for key in by_key:
+        if state[key] == "active":
+            print(f"[ACTIVE] {key} (job {job_ids[key]})")
+    return state
+
+
+def run_local(engine: LocalEngine, nodes: List[Node], actions: Dict[str, tuple], sbatch_dir: Path) -> Dict[str, str]:
+    """Run each node once all its dependencies are done, up to engine.max_parallel at a time."""
+    state = {k: a[0] for k, a in actions.items()}
+    pending = [n for n in nodes if state[n.key] == "run"]
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=engine.max_parallel) as ex:
+        while pending or running:
+            for node in list(pending):
+                deps = [state[d] for d in node.deps]
+                bad = [d for d in node.deps if state[d] in ("failed", "blocked")]
+                if bad:
+                    pending.remove(node)
+                    state[node.key] = "blocked"
+                    block(engine, node, f"{bad[0]} {state[bad[0]]}")
+                elif all(s in ("complete", "done") for s in deps):
+                    pending.remove(node)
+                    state[node.key] = "running"
+                    request = SubmitRequest(node.key, write_script(node, sbatch_dir), node.job_name)
+                    running[ex.submit(engine.submit, request)] = node.key
+
+            if not running:
+                # What is left waits on a dependency that will not finish in this run
+                # (e.g. still active in Slurm): record it as blocked, not as run
+                for node in pending:
+                    dep = next(d for d in node.deps if state[d] not in ("complete", "done"))
+                    state[node.key] = "blocked"
+                    block(engine, node, f"{dep} {state[dep]}")
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                result = fut.result()
+                del running[fut]
+                state[result.request.key] = "done" if result.ok else "failed"
+                report_result(result, "DONE")
+
+    return state
+
+
+# -------------------------
+# QA
+# -------------------------
+
+def t1_qa(
+    t1_path: str,
+    mask_path: Optional[str] = None,
+    t1_range: tuple = (0.05, 10.0),
+    min_fitted: float = 0.5,
+    max_out_of_range: float = 0.1,
+) -> Dict[str, object]:
+    """
+    Summary of a T1 map (seconds) inside the mask, or over its fitted (T1 > 0) voxels
+    without one. passed: the mask is mostly fitted and the fitted T1s are mostly in range.
+    """
+    import numpy as np
+
+    from vfa_io import load_nifti
+
+    t1, _ = load_nifti(t1_path)
+    fitted = np.isfinite(t1) & (t1 > 0)
+
+    if mask_path:
+        mask, _ = load_nifti(mask_path)
+        mask = mask > 0
+        if mask.shape != t1.shape:
+            raise SystemExit(f"ERROR: Mask shape {mask.shape} does not match T1 map shape {t1.shape}")
+    else:
+        mask = fitted
+
+    n_voxels = int(mask.sum())
+    values = t1[mask & fitted]
+    fitted_frac = float(values.size / n_voxels) if n_voxels else 0.0
+    in_range = (values >= t1_range[0]) & (values <= t1_range[1])
+    out_of_range_frac = float(1.0 - in_range.mean()) if values.size else 1.0
+
+    report = {
+        "t1": t1_path,
+        "mask": mask_path,
+        "voxels": n_voxels,
+        "fitted_frac": round(fitted_frac, 6),
+        "out_of_range_frac": round(out_of_range_frac, 6),
+        "t1_range_s": list(t1_range),
+        "median_s": None,
+        "p5_s": None,
+        "p95_s": None,
+    }
+    if values.size:
+        p5, p50, p95 = np.percentile(values, [5, 50, 95])
+        report.update(median_s=round(float(p50), 6), p5_s=round(float(p5), 6), p95_s=round(float(p95), 6))
+
+    report["passed"] = bool(values.size) and fitted_frac >= min_fitted and out_of_range_frac <= max_out_of_range
+    return report
+
+
+def qa_main(args: argparse.Namespace) -> int:
+    if not os.path.isfile(args.t1):
+        raise SystemExit(f"ERROR: T1 map not found: {args.t1}")
+
+    report = t1_qa(args.t1, args.mask, tuple(args.t1_range), args.min_fitted, args.max_out_of_range)
+    path = args.report or qa_report_path(args.t1)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print("=== T1 QA ===")
+    print(f"T1     : {args.t1}")
+    print(f"Mask   : {args.mask or 'fitted voxels'} ({report['voxels']} voxels)")
+    print(f"Fitted : {100 * report['fitted_frac']:.1f}%")
+    if report["median_s"] is not None:
+        print(f"T1 (s) : median {report['median_s']:.4g}, 5-95% {report['p5_s']:.4g}-{report['p95_s']:.4g}")
+    print(f"Range  : {100 * report['out_of_range_frac']:.1f}% outside {args.t1_range[0]:g}-{args.t1_range[1]:g} s")
+    print(f"Report : {path}")
+    print("PASSED" if report["passed"] else "FAILED")
+    return 0 if report["passed"] else 1
+
+
+# -------------------------
+# CLI
+# -------------------------
+
+def parse_args(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(
+        description="Per-subject N4 -> VFA T1 -> QA pipeline (Slurm afterok dependencies or local), with resume.",
+    )
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    r = sub.add_parser(
+        "run",
+        help="Submit (or run locally) the pipeline for a manifest",
+        epilog="Unrecognized arguments are passed to vfa_t1map_multi.py for every subject.",
+    )
+    r.add_argument("--manifest", required=True, help="CSV or JSON manifest, as for vfa_t1map_batch.py")
+    r.add_argument("--subjects", nargs="+", default=None, help="Only run these subjects from the manifest")
+    r.add_argument("--sbatch_dir", default=None, help="Job scripts and logs (default: <manifest folder>/sbatch)")
+    r.add_argument("--ledger", default=None, help="Pipeline ledger, JSON lines (default: <sbatch_dir>/pipeline.jsonl)")
+    r.add_argument("--executor", choices=("slurm", "local"), default="slurm")
+    r.add_argument("--local_jobs", type=int, default=0, help="Jobs run at once by the local executor (default: CPUs // --cpus)")
+    r.add_argument("--dry_run", action="store_true", help="Only print what would be skipped, kept or (re)run")
+
+    r.add_argument("--n4_path", default="N4BiasFieldCorrection")
+    r.add_argument("--imagemath_path", default="ImageMath")
+    r.add_argument("--n4_mask", action="store_true", help="Also give the subject's mask (dilated) to N4")
+    r.add_argument("--output_suffix", default="_bfc")
+    r.add_argument("--bias_suffix", default="_biasfield")
+    r.add_argument("--python", default=sys.executable, help="Python for the vfa/qa jobs (default: this one)")
+
+    r.add_argument("--cpus", type=int, default=4, help="CPUs per n4/vfa job (N4 uses them all as ITK threads)")
+    r.add_argument("--mem_gb", type=int, default=16)
+    r.add_argument("--time", default="04:00:00")
+    r.add_argument("--partition", default=None)
+
+    r.add_argument("--qa_t1_range", nargs=2, type=float, default=[0.05, 10.0], metavar=("MIN", "MAX"), help="Plausible T1 in s")
+    r.add_argument("--qa_min_fitted", type=float, default=0.5, help="Fraction of mask voxels that must have a T1")
+    r.add_argument("--qa_max_out_of_range", type=float, default=0.1, help="Fraction of fitted voxels allowed outside --qa_t1_range")
+
+    r.add_argument("--max_parallel", type=int, default=8, help="Concurrent sbatch calls")
+    r.add_argument("--rate", type=float, default=5.0, help="sbatch calls per second, retries included (0 = unlimited)")
+    r.add_argument("--burst", type=int, default=10, help="sbatch calls allowed back to back before --rate applies")
+    r.add_argument("--retries", type=int, default=4, help="Retries (exponential backoff) on transient sbatch errors")
+    r.add_argument("--sbatch_path", default="sbatch", help="sbatch executable (e.g. fake_sbatch.py to test without a cluster)")
+
+    q = sub.add_parser("qa", help="Check one T1 map (the pipeline's qa jobs)")
+    q.add_argument("--t1", required=True, help="T1 map (s)")
+    q.add_argument("--mask", default=None, help="Mask to summarize over (default: the fitted voxels)")
+    q.add_argument("--report", default=None, help="JSON report (default: <t1 stem>_qa.json)")
+    q.add_argument("--t1-range", nargs=2, type=float, default=[0.05, 10.0], metavar=("MIN", "MAX"))
+    q.add_argument("--min-fitted", type=float, default=0.5)
+    q.add_argument("--max-out-of-range", type=float, default=0.1)
+
+    args, extra = ap.parse_known_args(argv)
+    if extra and args.command != "run":
+        ap.error(f"unrecognized arguments: {' '.join(extra)}")
+    if extra and extra[0] == "--":
+        extra = extra[1:]
+    if extra:
+        # Caught here rather than as a failed vfa node for every subject
+        error = check_extra_args(extra)
+        if error:
+            ap.error(error)
+    return args, extra
+
+
+def run_main(args: argparse.Namespace, extra: List[str]) -> int:
+    try:
+        entries = load_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        raise SystemExit(f"ERROR: {e}")
+
+    if args.subjects:
+        wanted = set(args.subjects)
+        entries = [e for e in entries if e["subject"] in wanted]
+    if not entries:
+        raise SystemExit("ERROR: No subjects to run.")
+
+    if args.executor == "local":
+        args.cpus = min(args.cpus, len(available_cpus()))
+
+    sbatch_dir = Path(args.sbatch_dir or Path(args.manifest).resolve().parent / "sbatch").expanduser()
+    ledger_path = Path(args.ledger).expanduser() if args.ledger else sbatch_dir / "pipeline.jsonl"
+
+    nodes = []
+    for entry in entries:
+        nodes += subject_nodes(entry, args, extra, sbatch_dir)
+
+    actions = plan(nodes, read_ledger(ledger_path), args.executor)
+    counts = {a: sum(v[0] == a for v in actions.values()) for a in ("complete", "active", "run")}
+
+    print("=== N4 -> VFA T1 -> QA pipeline ===")
+    print(f"Manifest: {args.manifest} ({len(entries)} subjects, {len(nodes)} jobs)")
+    print(f"Executor: {args.executor}")
+    if extra:
+        print(f"VFA args: {' '.join(extra)}")
+    print(f"Plan    : {counts['run']} to run, {counts['complete']} complete, {counts['active']} still queued/running")
+
+    if args.dry_run:
+        for node in nodes:
+            action, job_id = actions[node.key]
+            print(f"  [{action.upper()}] {node.key}" + (f" (job {job_id})" if job_id else ""))
+        return 0
+
+    if not counts["run"]:
+        print("Nothing to run.")
+        return 0
+
+    sbatch_dir.mkdir(parents=True, exist_ok=True)
+
+    if args.executor == "local":
+        engine = LocalEngine(
+            state_dir=sbatch_dir,
+            cpus_per_job=args.cpus,
+            max_parallel=args.local_jobs or None,
+            ledger=ledger_path,
+        )
+        state = run_local(engine, nodes, actions, sbatch_dir)
+        ok = ("complete", "done")
+    else:
+        engine = SubmissionEngine(
+            sbatch=args.sbatch_path,
+            max_parallel=args.max_parallel,
+            rate=args.rate,
+            burst=args.burst,
+            retries=args.retries,
+            ledger=ledger_path,
+        )
+        state = run_slurm(engine, nodes, actions, sbatch_dir)
+        ok = ("complete", "active", "submitted")
+
+    n_bad = sum(s not in ok for s in state.values())
+    summary = ", ".join(f"{n} {s}" for s, n in sorted(
+        {s: list(state.values()).count(s) for s in set(state.values())}.items()
+    ))
+    print(f"Done: {summary}")
+    print(f"Ledger: {ledger_path}")
+    return 0 if n_bad == 0 else 1
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args, extra = parse_args(argv)
+    if args.command == "qa":
+        return qa_main(args)
+    return run_main(args, extra)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
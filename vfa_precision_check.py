@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+vfa_precision_check.py
+
+Validate the float32 VFA fit against float64 on real data before adopting
+--precision float32.
+
+Usage:
+  python vfa_precision_check.py --tol 5e-3 --report check.json -- \
+      --imgs fa3.nii.gz fa6.nii.gz fa10.nii.gz fa15.nii.gz --auto-mask --fit wls
+
+  # also write the float32 - float64 T1 difference map
+  python vfa_precision_check.py --out-diff dT1.nii.gz -- --imgs a.nii.gz b.nii.gz --fas 4 20 --tr 15 --tr-units ms
+
+Everything after the check options (optionally after "--") is parsed as
+vfa_t1map_multi.py arguments (--out is not needed). Inputs, TR/FA resolution, mask,
+B1 map and fit options are identical for both runs; only --precision differs.
+
+Reported:
+  - voxels fitted by each precision and voxels fitted by only one of them
+  - over voxels with 0 < T1(float64) <= --t1-max: max |dT1| (seconds, with its
+    voxel), max/p99.9/p99 relative deviation |dT1|/T1(float64)
+  - runtime of both fits
+Voxels above --t1-max (noise-only background, E1 pinned near --e1-max) are
+counted but not compared: their T1 is not determined by either fit.
+
+Exits with status 1 if the max relative deviation exceeds --tol or if the fitted
+voxel sets differ.
+"""
+
+import argparse
+import json
+import time
+from typing import Dict
+
+import numpy as np
+
+import vfa_t1map_multi
+from vfa_io import save_like
+
+
+def compare_t1(T1_64: np.ndarray, T1_32: np.ndarray, t1_max: float) -> Dict[str, object]:
+    """Deviation statistics of T1_32 against the float64 reference T1_64 (seconds, 0 = not fitted)."""
+    fit64 = T1_64 > 0
+    fit32 = T1_32 > 0
+    cmp = fit64 & (T1_64 <= t1_max)
+
+    stats: Dict[str, object] = {
+        "fitted_float64": int(fit64.sum()),
+        "fitted_float32": int(fit32.sum()),
+        "fitted_mismatch": int((fit64 != fit32).sum()),
+        "compared": int(cmp.sum()),
+        "above_t1_max": int((fit64 & ~cmp).sum()),
+    }
+    if not cmp.any():
+        stats.update(max_abs_s=0.0, max_abs_voxel=None, max_abs_t1_s=None, max_rel=0.0, p999_rel=0.0, p99_rel=0.0)
+        return stats
+
+    ref = T1_64[cmp].astype(np.float64)
+    diff = np.abs(T1_32[cmp].astype(np.float64) - ref)
+    rel = diff / ref
+    i = int(np.argmax(diff))
+    voxel = [int(c[i]) for c in np.nonzero(cmp)]
+    stats.update(
+        max_abs_s=float(diff[i]),
+        max_abs_voxel=voxel,
+        max_abs_t1_s=float(ref[i]),
+        max_rel=float(rel.max()),
+        p999_rel=float(np.percentile(rel, 99.9)),
+        p99_rel=float(np.percentile(rel, 99)),
+    )
+    return stats
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(
+        description="Maximum T1 deviation of the float32 VFA fit against float64 on a dataset.",
+        epilog="Unrecognized arguments are parsed as vfa_t1map_multi.py arguments.",
+    )
+    ap.add_argument("--tol", type=float, default=5e-3, help="Max allowed relative T1 deviation (default 5e-3)")
+    ap.add_argument("--t1-max", type=float, default=10.0, help="Only compare voxels with float64 T1 <= this (seconds, default 10)")
+    ap.add_argument("--report", default=None, help="Write the statistics as JSON")
+    ap.add_argument("--out-diff", default=None, help="Write T1(float32) - T1(float64) as a float32 NIfTI")
+    args, extra = ap.parse_known_args()
+    if extra and extra[0] == "--":
+        extra = extra[1:]
+    if args.tol <= 0:
+        ap.error("--tol must be > 0")
+    if args.t1_max <= 0:
+        ap.error("--t1-max must be > 0")
+    return args, extra
+
+
+def main():
+    args, extra = parse_args()
+    fit_args = vfa_t1map_multi.parse_args(extra, require_out=False)
+
+    vols, ref_img, mask, b1, info = vfa_t1map_multi.load_inputs(fit_args)
+
+    T1 = {}
+    seconds = {}
+    for precision in ("float64", "float32"):
+        t0 = time.perf_counter()
+        T1[precision] = vfa_t1map_multi.fit_t1(fit_args, vols, mask, b1, info, precision=precision)["T1"]
+        seconds[precision] = time.perf_counter() - t0
+
+    stats = compare_t1(T1["float64"], T1["float32"], args.t1_max)
+    ok = stats["max_rel"] <= args.tol and stats["fitted_mismatch"] == 0
+    stats.update(
+        fit=fit_args.fit,
+        imgs=fit_args.imgs,
+        tr_s=info["tr_s"],
+        fas=info["fas"],
+        t1_max_s=args.t1_max,
+        tol=args.tol,
+        seconds_float64=round(seconds["float64"], 3),
+        seconds_float32=round(seconds["float32"], 3),
+        passed=bool(ok),
+    )
+
+    if args.out_diff:
+        diff = T1["float32"].astype(np.float32) - T1["float64"].astype(np.float32)
+        save_like(diff, ref_img, args.out_diff)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(stats, f, indent=2)
+
+    print("=== VFA float32 vs float64 ===")
+    print(f"Fit     : {fit_args.fit}")
+    print(f"Imgs    : {len(fit_args.imgs)}  (TR {info['tr_s']:.6g} s, FAs {', '.join(str(f) for f in info['fas'])} deg)")
+    print(f"Fitted  : {stats['fitted_float64']} (float64), {stats['fitted_float32']} (float32), "
+          f"{stats['fitted_mismatch']} in only one")
+    print(f"Compared: {stats['compared']} voxels with T1 <= {args.t1_max:g} s ({stats['above_t1_max']} above)")
+    if stats["compared"]:
+        print(f"Max dT1 : {stats['max_abs_s']:.3g} s at {tuple(stats['max_abs_voxel'])} (T1 {stats['max_abs_t1_s']:.4g} s)")
+        print(f"Rel dT1 : max {stats['max_rel']:.3g}, p99.9 {stats['p999_rel']:.3g}, p99 {stats['p99_rel']:.3g}")
+    print(f"Time    : float64 {seconds['float64']:.3f} s, float32 {seconds['float32']:.3f} s "
+          f"(x{seconds['float64'] / max(seconds['float32'], 1e-12):.2f})")
+    if args.out_diff:
+        print(f"Diff    : {args.out_diff}")
+    if args.report:
+        print(f"Report  : {args.report}")
+    print(f"Result  : {'PASS' if ok else 'FAIL'} (tol {args.tol:g})")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -14,6 +14,9 @@ Usage:
   # override/force:
   python vfa_t1map_2fa.py img1.nii.gz img2.nii.gz out_t1.nii.gz --fa1 5 --fa2 15 --tr 0.015
 
+  # B1-corrected (relative B1 map, 1.0 = nominal flip angle):
+  python vfa_t1map_2fa.py img1.nii.gz img2.nii.gz out_t1.nii.gz --b1map b1_rel.nii.gz
+
 Flip angles/TR can be provided manually or inferred from adjacent .method files:
   foo.nii.gz -> foo.method
 or explicitly via --method1/--method2.
@@ -26,194 +29,23 @@ Bruker .method parsing:
 
 Output:
 - T1 map (seconds) saved as float32 NIfTI using img1 affine/header.
+- With --cache stat|hash, <out stem>.manifest.json; re-runs with unchanged images, mask,
+  B1 map, FAs/TR, options and code then skip the fit (see result_cache.py).
+
+The fitting kernel and .method parsing are shared with vfa_t1map_multi.py via vfa_core.py.
 """
 
 import argparse
 import os
-import re
-from typing import Dict, Optional, Tuple, List
+from typing import Optional
 
 import numpy as np
-import nibabel as nib
-
-
-# -------------------------
-# Method file parsing
-# -------------------------
-
-def _strip_quotes(s: str) -> str:
-    s = s.strip()
-    if len(s) >= 2 and ((s[0] == '"' and s[-1] == '"') or (s[0] == "'" and s[-1] == "'")):
-        return s[1:-1]
-    return s
-
-
-def parse_bruker_method(method_path: str) -> Dict[str, str]:
-    """Parse Bruker-style .method entries of the form ##$KEY=VALUE (including multiline values)."""
-    if not os.path.isfile(method_path):
-        raise FileNotFoundError(f"Method file not found: {method_path}")
-
-    with open(method_path, "r", encoding="utf-8", errors="replace") as f:
-        lines = f.readlines()
-
-    data: Dict[str, str] = {}
-    key = None
-    buf: List[str] = []
-
-    entry_re = re.compile(r"^\s*##\$(?P<key>[A-Za-z0-9_]+)\s*=\s*(?P<val>.*)\s*$")
-
-    def flush():
-        nonlocal key, buf
-        if key is not None:
-            data[key] = "\n".join(buf).strip()
-        key = None
-        buf = []
-
-    for line in lines:
-        m = entry_re.match(line)
-        if m:
-            flush()
-            key = m.group("key").strip()
-            buf = [m.group("val").strip()]
-        else:
-            if key is not None:
-                buf.append(line.rstrip("\n"))
-
-    flush()
-    return data
-
-
-def _extract_first_number(raw: Optional[str]) -> Optional[float]:
-    """Extract the first float-like token from a raw method value string."""
-    if raw is None:
-        return None
-    s = _strip_quotes(raw.strip()).replace("<", " ").replace(">", " ")
-    m = re.search(r"[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?", s)
-    if not m:
-        return None
-    try:
-        return float(m.group(0))
-    except Exception:
-        return None
-
-
-def _parse_excpulse_tuple_flip_angle(raw: Optional[str]) -> Optional[float]:
-    """
-    Parse flip angle from Bruker ExcPulse tuple like:
-      (1, 6000, 15, Yes, 4, ...)
-    We interpret the 3rd element (index 2) as flip angle in degrees
-    (per user report / typical sequence convention).
-    """
-    if raw is None:
-        return None
 
-    s = raw.strip()
-
-    # Some files store as "(...)" possibly across lines; keep only first line unless closing paren found
-    # We'll just flatten whitespace/newlines then try to extract tuple contents.
-    s = " ".join(s.split())
-
-    # Find the first parenthesized group
-    m = re.search(r"\((.*)\)", s)
-    if not m:
-        return None
-
-    inside = m.group(1).strip()
-    parts = [p.strip() for p in inside.split(",")]
-
-    if len(parts) < 3:
-        return None
-
-    # Third element
-    fa_str = parts[2]
-    fa_val = _extract_first_number(fa_str)
-    if fa_val is None:
-        return None
-
-    # sanity
-    if 0 < fa_val < 180:
-        return fa_val
-    return None
-
-
-def default_adjacent_method_path(nifti_path: str) -> str:
-    base = os.path.basename(nifti_path)
-    d = os.path.dirname(os.path.abspath(nifti_path))
-    if base.endswith(".nii.gz"):
-        stem = base[:-7]
-    elif base.endswith(".nii"):
-        stem = base[:-4]
-    else:
-        stem = os.path.splitext(base)[0]
-    return os.path.join(d, f"{stem}.method")
-
-
-def infer_tr_seconds(method_dict: Dict[str, str]) -> Tuple[Optional[float], str]:
-    tr_keys = ["PVM_RepetitionTime", "RepetitionTime", "PVM_TR", "TR"]
-    used = None
-    raw = None
-    for k in tr_keys:
-        if k in method_dict:
-            raw = method_dict[k]
-            used = k
-            break
-
-    tr_val = _extract_first_number(raw)
-    if tr_val is None:
-        return None, "TR not found in method"
-
-    # Heuristic: Bruker commonly stores ms
-    if tr_val > 0.5:
-        tr_s = tr_val / 1000.0
-        return tr_s, f"TR inferred from {used}={tr_val} (assumed ms -> {tr_s:.6g} s)"
-    else:
-        return tr_val, f"TR inferred from {used}={tr_val} (assumed s)"
-
-
-def infer_fa_degrees(method_dict: Dict[str, str]) -> Tuple[Optional[float], str]:
-    """
-    Infer flip angle in degrees from:
-      - explicit keys (PVM_FlipAngle, etc.)
-      - ExcPulse tuple keys (ExcPulse1 / PVM_ExcPulse1 / etc.)
-    """
-    # Direct scalar keys first
-    scalar_keys = [
-        "PVM_FlipAngle",
-        "FlipAngle",
-        "PVM_ExcPulseAngle",
-        "PVM_ExcPulAngle",
-        "PVM_ExcFlipAngle",
-        "PVM_ExFlipAngle",
-    ]
-    for k in scalar_keys:
-        if k in method_dict:
-            v = _extract_first_number(method_dict[k])
-            if v is not None and 0 < v < 180:
-                return v, f"Flip angle inferred from {k}={v} (degrees assumed)"
-
-    # ExcPulse tuple keys (your case)
-    tuple_keys = [
-        "ExcPulse1",
-        "ExcPulse2",
-        "ExcPulse",
-        "PVM_ExcPulse1",
-        "PVM_ExcPulse2",
-        "PVM_ExcPulse",
-    ]
-    for k in tuple_keys:
-        if k in method_dict:
-            v = _parse_excpulse_tuple_flip_angle(method_dict[k])
-            if v is not None:
-                return v, f"Flip angle inferred from {k} tuple (3rd field) = {v} deg"
-
-    return None, "Flip angle not found in method (no scalar key and no parsable ExcPulse tuple)"
-
-
-def infer_tr_and_fa_from_method(method_path: str) -> Tuple[Optional[float], Optional[float], str]:
-    d = parse_bruker_method(method_path)
-    tr_s, tr_note = infer_tr_seconds(d)
-    fa_deg, fa_note = infer_fa_degrees(d)
-    return tr_s, fa_deg, f"{tr_note}; {fa_note}"
+import vfa_core
+import vfa_io
+from result_cache import CACHE_MODES, ResultCache
+from vfa_core import default_adjacent_method_path, infer_tr_and_fa_from_method, use_method_index, vfa_fit_e1
+from vfa_io import load_nifti, load_nifti_lazy, save_like
 
 
 # -------------------------
@@ -229,54 +61,31 @@ def vfa_t1_two_point(
     mask: Optional[np.ndarray] = None,
     e1_min: float = 1e-6,
     e1_max: float = 0.999999,
+    workers: int = 1,
+    b1: Optional[np.ndarray] = None,
+    precision: str = "float64",
 ) -> np.ndarray:
+    """
+    Closed-form 2-point T1 (seconds); voxels failing the checks/mask get 0.
+    With workers > 1, z-slabs are computed concurrently on a thread pool.
+    b1 is an optional relative B1 map scaling both flip angles per voxel.
+    precision ("float64" or "float32") is the compute and output dtype.
+    """
     if tr_s <= 0:
         raise ValueError(f"TR must be > 0 seconds; got {tr_s}")
     if not (0 < fa1_deg < 180) or not (0 < fa2_deg < 180):
         raise ValueError(f"Flip angles must be in (0,180) degrees; got {fa1_deg}, {fa2_deg}")
 
-    a1 = np.deg2rad(fa1_deg)
-    a2 = np.deg2rad(fa2_deg)
-
-    S1 = S1.astype(np.float64, copy=False)
-    S2 = S2.astype(np.float64, copy=False)
-
-    y1 = S1 / np.sin(a1)
-    y2 = S2 / np.sin(a2)
-    x1 = S1 / np.tan(a1)
-    x2 = S2 / np.tan(a2)
-
-    denom = x2 - x1
-    numer = y2 - y1
-
-    good = np.isfinite(numer) & np.isfinite(denom) & (np.abs(denom) > 0)
-    good &= (S1 > 0) & (S2 > 0)
-    if mask is not None:
-        good &= (mask != 0)
-
-    E1 = np.full(S1.shape, np.nan, dtype=np.float64)
-    E1[good] = numer[good] / denom[good]
-    E1 = np.clip(E1, e1_min, e1_max)
-
-    T1 = -tr_s / np.log(E1)
-    T1[~good] = 0.0
-    return T1
-
-
-def build_default_mask(S1: np.ndarray, S2: np.ndarray, frac: float = 0.05) -> np.ndarray:
-    comb = np.maximum(S1, S2)
-    comb = comb[np.isfinite(comb)]
-    if comb.size == 0:
-        return np.zeros(S1.shape, dtype=np.uint8)
-    p = np.percentile(comb, 95)
-    thr = frac * p
-    return (np.maximum(S1, S2) > thr).astype(np.uint8)
+    fit = vfa_fit_e1(
+        [S1, S2], [fa1_deg, fa2_deg], mask, e1_min, e1_max,
+        workers=workers, tr_s=tr_s, b1=b1, precision=precision,
+    )
+    return fit["T1"]
 
 
-def load_nifti(path: str) -> Tuple[np.ndarray, nib.Nifti1Image]:
-    img = nib.load(path)
-    data = img.get_fdata(dtype=np.float32)
-    return data, img
+def build_default_mask(S1: np.ndarray, S2: np.ndarray, frac: float = 0.05, **kwargs) -> np.ndarray:
+    """vfa_core.build_default_mask() for two images (kwargs: workers, fill_holes, largest_component)."""
+    return vfa_core.build_default_mask([S1, S2], frac=frac, **kwargs)
 
 
 # -------------------------
@@ -297,16 +106,25 @@ def parse_args():
 
     ap.add_argument("--method1", default=None, help="Explicit .method file for img1 (optional)")
     ap.add_argument("--method2", default=None, help="Explicit .method file for img2 (optional)")
+    ap.add_argument("--method-index", default=None, help="Metadata index of parsed .method files (see vfa_method_index.py; default: $VFA_METHOD_INDEX)")
 
     ap.add_argument("--require-same-tr", action="store_true")
 
     ap.add_argument("--mask", default=None)
     ap.add_argument("--auto-mask", action="store_true")
     ap.add_argument("--auto-mask-frac", type=float, default=0.05)
+    ap.add_argument("--auto-mask-fill-holes", action="store_true", help="Fill enclosed holes in the auto-mask (needs scipy)")
+    ap.add_argument("--auto-mask-largest", action="store_true", help="Keep only the largest connected component of the auto-mask (needs scipy)")
+
+    ap.add_argument("--b1map", default=None, help="Relative B1 map NIfTI (1.0 = nominal) scaling both flip angles per voxel")
 
     ap.add_argument("--e1-min", type=float, default=1e-6)
     ap.add_argument("--e1-max", type=float, default=0.999999)
 
+    ap.add_argument("--workers", type=int, default=1, help="Number of threads computing z-slabs concurrently (default 1)")
+    ap.add_argument("--precision", choices=["float64", "float32"], default="float64", help="Compute dtype (default float64)")
+    ap.add_argument("--cache", choices=CACHE_MODES, default="off", help="Skip the fit if inputs (compared by stat or sha256), FAs/TR, options and code match the manifest next to --out (default off)")
+
     args = ap.parse_args()
 
     if len(args.positional) not in (0, 3):
@@ -320,19 +138,14 @@ def parse_args():
 
     if not args.img1 or not args.img2 or not args.out:
         ap.error("Missing required inputs. Provide --img1 --img2 --out OR positional: img1 img2 out")
+    if args.workers < 1:
+        ap.error("--workers must be >= 1")
 
     return args
 
 
-def main():
-    args = parse_args()
-
-    S1, img1 = load_nifti(args.img1)
-    S2, img2 = load_nifti(args.img2)
-
-    if S1.shape != S2.shape:
-        raise SystemExit(f"ERROR: Shape mismatch: img1 {S1.shape} vs img2 {S2.shape}")
-
+def fit_and_save(args, S1, S2, img1, fa1: float, fa2: float, tr_s: float) -> None:
+    """Build/load the mask and B1 map, fit and write --out."""
     mask = None
     if args.mask:
         m, _ = load_nifti(args.mask)
@@ -340,7 +153,45 @@ def main():
             raise SystemExit(f"ERROR: Mask shape mismatch: mask {m.shape} vs images {S1.shape}")
         mask = (m != 0).astype(np.uint8)
     elif args.auto_mask:
-        mask = build_default_mask(S1, S2, frac=args.auto_mask_frac)
+        mask = build_default_mask(
+            S1, S2,
+            frac=args.auto_mask_frac,
+            workers=args.workers,
+            fill_holes=args.auto_mask_fill_holes,
+            largest_component=args.auto_mask_largest,
+        )
+
+    b1 = None
+    if args.b1map:
+        b1, _ = load_nifti_lazy(args.b1map)
+        if b1.shape != S1.shape:
+            raise SystemExit(f"ERROR: B1 map shape mismatch: b1map {b1.shape} vs images {S1.shape}")
+
+    T1 = vfa_t1_two_point(
+        S1=S1,
+        S2=S2,
+        fa1_deg=float(fa1),
+        fa2_deg=float(fa2),
+        tr_s=float(tr_s),
+        mask=mask,
+        e1_min=args.e1_min,
+        e1_max=args.e1_max,
+        workers=args.workers,
+        b1=b1,
+        precision=args.precision,
+    )
+
+    save_like(T1.astype(np.float32, copy=False), img1, args.out)
+
+
+def main():
+    args = parse_args()
+
+    S1, img1 = load_nifti_lazy(args.img1)
+    S2, img2 = load_nifti_lazy(args.img2)
+
+    if S1.shape != S2.shape:
+        raise SystemExit(f"ERROR: Shape mismatch: img1 {S1.shape} vs img2 {S2.shape}")
 
     fa1 = args.fa1
     fa2 = args.fa2
@@ -353,6 +204,8 @@ def main():
     need_fa2 = (fa2 is None)
     need_tr = (tr_s is None)
 
+    if args.method_index:
+        use_method_index(args.method_index)
     method1_path = args.method1 or default_adjacent_method_path(args.img1)
     method2_path = args.method2 or default_adjacent_method_path(args.img2)
 
@@ -414,22 +267,31 @@ def main():
                 "If expected, omit --require-same-tr or provide --tr explicitly."
             )
 
-    T1 = vfa_t1_two_point(
-        S1=S1,
-        S2=S2,
-        fa1_deg=float(fa1),
-        fa2_deg=float(fa2),
-        tr_s=float(tr_s),
-        mask=mask,
-        e1_min=args.e1_min,
-        e1_max=args.e1_max,
-    )
-
-    out_img = nib.Nifti1Image(T1.astype(np.float32), affine=img1.affine, header=img1.header)
-    out_img.header.set_data_dtype(np.float32)
-    nib.save(out_img, args.out)
+    cached = False
+    if args.cache != "off":
+        inputs = [args.img1, args.img2] + [p for p in (args.mask, args.b1map) if p]
+        params = {
+            "tr_s": float(tr_s),
+            "fas": [float(fa1), float(fa2)],
+            "e1_min": args.e1_min,
+            "e1_max": args.e1_max,
+            "precision": args.precision,
+            "auto_mask": None,
+        }
+        if not args.mask and args.auto_mask:
+            params["auto_mask"] = [args.auto_mask_frac, args.auto_mask_fill_holes, args.auto_mask_largest]
+        cache = ResultCache(args.out, args.cache, inputs, params, [__file__, vfa_core.__file__, vfa_io.__file__])
+        cached = cache.fresh()
+        if not cached:
+            cache.invalidate()
+            fit_and_save(args, S1, S2, img1, fa1, fa2, tr_s)
+            cache.store([args.out])
+    else:
+        fit_and_save(args, S1, S2, img1, fa1, fa2, tr_s)
 
     print("=== VFA T1 mapping (2-point) ===")
+    if cached:
+        print(f"cache: {args.out} is up to date ({args.cache}); fit skipped")
     print(f"img1: {args.img1}")
     print(f"img2: {args.img2}")
     print(f"out : {args.out}")
@@ -439,9 +301,14 @@ def main():
     if args.mask:
         print(f"mask: {args.mask}")
     elif args.auto_mask:
-        print(f"mask: auto (frac={args.auto_mask_frac})")
+        cleanup = [c for c, on in (("fill holes", args.auto_mask_fill_holes), ("largest component", args.auto_mask_largest)) if on]
+        print(f"mask: auto (frac={args.auto_mask_frac}{''.join(', ' + c for c in cleanup)})")
     else:
         print("mask: none")
+    if args.b1map:
+        print(f"b1  : {args.b1map}")
+    if args.precision != "float64":
+        print(f"prec: {args.precision}")
     if details:
         print("--- method parsing ---")
         for d in details:
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+vfa_t1map_batch.py
+
+Run vfa_t1map_multi.py for a whole study in one long-lived process.
+
+Usage:
+  python vfa_t1map_batch.py --manifest study.csv --report t1_report.csv --jobs 4 -- --auto-mask --workers 2
+
+Manifest (CSV or JSON), one entry per subject:
+  CSV : header with columns subject, imgs, out and optionally methods, mask, b1map, fas, tr.
+        List columns (imgs, methods, fas) are ';'-separated.
+  JSON: a list of objects with the same keys, or an object mapping subject -> entry.
+        List keys may be JSON arrays or ';'-separated strings.
+Relative paths are taken relative to the manifest's folder.
+
+Anything after the batch options (optionally after "--") is passed to every subject
+as vfa_t1map_multi.py arguments, e.g. --auto-mask, --tr-units ms, --mem-budget-mb 2000.
+Per-subject TR/FA resolution, masking and fitting go through vfa_t1map_multi.run(),
+so results match one-off runs of the CLI.
+
+Up to --jobs subjects are in flight at once; their (lazy) image reads overlap with the
+fits of the others. The report (CSV, or JSON if the path ends in .json) lists per
+subject: status, wall time, resolved TR/FAs, output and error message.
+
+With "--cache stat" (or "hash") among the passed-through arguments, subjects whose
+inputs, TR/FAs, options and code are unchanged since their last run are not refitted
+and are reported with status "cached".
+"""
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+import vfa_t1map_multi
+
+
+LIST_FIELDS = ("imgs", "methods", "fas")
+PATH_FIELDS = ("imgs", "methods", "mask", "b1map", "out")
+REPORT_FIELDS = ["subject", "status", "seconds", "tr_s", "fas", "out", "error"]
+DONE_STATUSES = ("ok", "cached")
+
+
+def _as_list(v) -> Optional[List[str]]:
+    if v is None or v == "":
+        return None
+    if isinstance(v, (list, tuple)):
+        return [str(x) for x in v]
+    return [p.strip() for p in str(v).split(";") if p.strip()]
+
+
+def load_manifest(path: str) -> List[Dict[str, object]]:
+    """Read a CSV/JSON manifest into a list of normalized subject entries."""
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"Manifest not found: {path}")
+
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+        if isinstance(raw, dict):
+            rows = [dict(v, subject=k) for k, v in raw.items()]
+        else:
+            rows = list(raw)
+    else:
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            rows = list(csv.DictReader(f))
+
+    base = os.path.dirname(os.path.abspath(path))
+
+    def resolve(p: str) -> str:
+        p = os.path.expanduser(p)
+        return p if os.path.isabs(p) else os.path.join(base, p)
+
+    entries = []
+    for i, row in enumerate(rows):
+        e = {k: (v.strip() if isinstance(v, str) else v) for k, v in row.items() if k}
+        for k in LIST_FIELDS:
+            e[k] = _as_list(e.get(k))
+        for k in ("mask", "b1map", "tr"):
+            if e.get(k) in ("", None):
+                e[k] = None
+        if not e.get("imgs") or not e.get("out"):
+            raise ValueError(f"Manifest entry {i} needs at least 'imgs' and 'out'")
+        e["subject"] = str(e.get("subject") or f"subject_{i}")
+        for k in PATH_FIELDS:
+            if isinstance(e.get(k), list):
+                e[k] = [resolve(p) for p in e[k]]
+            elif e.get(k):
+                e[k] = resolve(e[k])
+        entries.append(e)
+
+    subjects = [e["subject"] for e in entries]
+    dupes = sorted({s for s in subjects if subjects.count(s) > 1})
+    if dupes:
+        raise ValueError(f"Duplicate subjects in manifest: {', '.join(dupes)}")
+    return entries
+
+
+def subject_argv(entry: Dict[str, object], extra: List[str]) -> List[str]:
+    """vfa_t1map_multi.py argument list for one manifest entry."""
+    argv = ["--imgs", *entry["imgs"], "--out", entry["out"]]
+    if entry.get("methods"):
+        argv += ["--methods", *entry["methods"]]
+    if entry.get("mask"):
+        argv += ["--mask", entry["mask"]]
+    if entry.get("b1map"):
+        argv += ["--b1map", entry["b1map"]]
+    if entry.get("fas"):
+        argv += ["--fas", *[str(f) for f in entry["fas"]]]
+    if entry.get("tr") is not None:
+        argv += ["--tr", str(entry["tr"])]
+    return argv + list(extra)
+
+
+def run_subject(entry: Dict[str, object], extra: List[str]) -> Dict[str, object]:
+    rec = {"subject": entry["subject"], "out": entry["out"], "tr_s": None, "fas": None, "error": ""}
+    t0 = time.perf_counter()
+    try:
+        args = vfa_t1map_multi.parse_args(subject_argv(entry, extra))
+        info = vfa_t1map_multi.run(args)
+        rec["status"] = "cached" if info.get("cached") else "ok"
+        rec["tr_s"] = info["tr_s"]
+        rec["fas"] = info["fas"]
+    except SystemExit as e:
+        # Input/metadata problems reported by vfa_t1map_multi (or argparse, code 2)
+        rec["status"] = "failed"
+        rec["error"] = str(e.code) if not isinstance(e.code, int) else f"invalid arguments (exit {e.code})"
+    except Exception as e:
+        rec["status"] = "error"
+        rec["error"] = f"{type(e).__name__}: {e}"
+    rec["seconds"] = round(time.perf_counter() - t0, 3)
+    return rec
+
+
+def write_report(path: str, records: List[Dict[str, object]]) -> None:
+    if path.endswith(".json"):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(records, f, indent=2)
+        return
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        w = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        w.writeheader()
+        for r in records:
+            row = dict(r)
+            if row.get("fas") is not None:
+                row["fas"] = ";".join(str(x) for x in row["fas"])
+            row["error"] = " | ".join(str(row.get("error") or "").splitlines())
+            w.writerow(row)
+
+
+def check_extra_args(extra: List[str]) -> Optional[str]:
+    """
+    Error message if the pass-through arguments are not valid vfa_t1map_multi.py
+    options, else None. Catches typos once, up front, rather than once per subject.
+    """
+    err = io.StringIO()
+    try:
+        with contextlib.redirect_stderr(err):
+            vfa_t1map_multi.parse_args(["--imgs", "check.nii.gz", "--out", "check.nii.gz", *extra])
+    except SystemExit:
+        lines = err.getvalue().strip().splitlines()
+        detail = lines[-1].split("error: ", 1)[-1] if lines else " ".join(extra)
+        return f"vfa_t1map_multi.py: {detail}"
+    return None
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(
+        description="Batch multi-angle VFA T1 mapping for a manifest of subjects in one process.",
+        epilog="Unrecognized arguments are passed to vfa_t1map_multi.py for every subject.",
+    )
+    ap.add_argument("--manifest", required=True, help="CSV or JSON manifest (subject, imgs, out, [methods, mask, b1map, fas, tr])")
+    ap.add_argument("--report", default=None, help="Per-subject status/timing report (.csv or .json). Default: <manifest>_report.csv")
+    ap.add_argument("--jobs", type=int, default=2, help="Subjects processed concurrently (default 2)")
+    ap.add_argument("--subjects", nargs="+", default=None, help="Only run these subjects from the manifest")
+    args, extra = ap.parse_known_args()
+    if extra and extra[0] == "--":
+        extra = extra[1:]
+    if args.jobs < 1:
+        ap.error("--jobs must be >= 1")
+    error = check_extra_args(extra)
+    if error:
+        ap.error(error)
+    return args, extra
+
+
+def main():
+    args, extra = parse_args()
+
+    try:
+        entries = load_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        raise SystemExit(f"ERROR: {e}")
+
+    if args.subjects:
+        wanted = set(args.subjects)
+        entries = [e for e in entries if e["subject"] in wanted]
+    if not entries:
+        raise SystemExit("ERROR: No subjects to run.")
+
+    report = args.report or os.path.splitext(args.manifest)[0] + "_report.csv"
+
+    print("=== Batch VFA T1 mapping ===")
+    print(f"Manifest: {args.manifest} ({len(entries)} subjects)")
+    print(f"Jobs    : {args.jobs}")
+    if extra:
+        print(f"Args    : {' '.join(extra)}")
+
+    t0 = time.perf_counter()
+    records = {}
+    with ThreadPoolExecutor(max_workers=args.jobs) as ex:
+        futs = {ex.submit(run_subject, e, extra): e["subject"] for e in entries}
+        for fut in as_completed(futs):
+            rec = fut.result()
+            records[rec["subject"]] = rec
+            line = f"[{rec['status'].upper()}] {rec['subject']} ({rec['seconds']:.1f} s)"
+            if rec["error"]:
+                line += f": {rec['error'].splitlines()[0]}"
+            print(line, file=sys.stdout if rec["status"] in DONE_STATUSES else sys.stderr, flush=True)
+
+    ordered = [records[e["subject"]] for e in entries]
+    write_report(report, ordered)
+
+    n_ok = sum(r["status"] in DONE_STATUSES for r in ordered)
+    n_cached = sum(r["status"] == "cached" for r in ordered)
+    print(f"Done: {n_ok}/{len(ordered)} ok ({n_cached} cached) in {time.perf_counter() - t0:.1f} s")
+    print(f"Report: {report}")
+    return 0 if n_ok == len(ordered) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -12,8 +12,15 @@ Let:
 Then:
   y = E1 * x + K*(1 - E1)
 
-For >=2 flip angles, fit slope E1 via (weighted) least squares.
-For exactly 2 flip angles, this reduces to the standard 2-point formula.
+For >=2 flip angles, fit slope E1 via least squares: OLS by default, or with
+--fit wls, DESPOT1-WLS (a few reweighting passes with noise-propagation weights
+w = (sin a / (1 - E1 cos a))^2 for the x/y transform).
+For exactly 2 flip angles, both reduce to the standard 2-point formula.
+
+With --fit nlls, the OLS result seeds a nonlinear least-squares fit of S(a) itself
+(batched Levenberg-Marquardt over all voxels), which avoids the low-SNR bias of the
+linearization. Per-voxel convergence (1/0) and RMS residual maps are written next
+to --out (or to --out-conv / --out-rms).
 
 Inputs:
   - N NIfTI files (--imgs img1 img2 [img3 ...])
@@ -26,314 +33,102 @@ Bruker .method parsing:
   - Flip angle from scalar keys or from ExcPulse1 tuple where 3rd element is FA:
       ##$ExcPulse1=(1, 6000, 15, Yes, ...)
 
+--precision float32 runs the whole fit in float32 (the output is float32 either way);
+vfa_precision_check.py reports how far it deviates from float64 on a given dataset.
+
+--cache stat|hash writes <out stem>.manifest.json after a successful run and skips the
+fit on re-runs while the images, mask, B1 map, resolved TR/FAs, fit options and code
+are unchanged and the outputs are untouched (see result_cache.py).
+
+The fitting kernel and .method parsing live in vfa_core.py (shared with
+vfa_t1map_2fa.py); this script is the command-line wrapper.
+
 Notes:
   - Assumes RF spoiling + adequate gradient spoiling (true SPGR/FLASH spoiled regime)
-  - If B1 varies spatially, VFA T1 can be biased without B1 correction.
+  - If B1 varies spatially, VFA T1 can be biased without B1 correction: pass a relative
+    B1 map (--b1map, 1.0 = nominal) to scale each voxel's flip angles.
 """
 
 import argparse
 import os
-import re
 from typing import Dict, Optional, Tuple, List
 
 import numpy as np
-import nibabel as nib
-
-
-# -------------------------
-# Method file parsing
-# -------------------------
-
-def _strip_quotes(s: str) -> str:
-    s = s.strip()
-    if len(s) >= 2 and ((s[0] == '"' and s[-1] == '"') or (s[0] == "'" and s[-1] == "'")):
-        return s[1:-1]
-    return s
-
-
-def parse_bruker_method(method_path: str) -> Dict[str, str]:
-    if not os.path.isfile(method_path):
-        raise FileNotFoundError(f"Method file not found: {method_path}")
-
-    with open(method_path, "r", encoding="utf-8", errors="replace") as f:
-        lines = f.readlines()
-
-    data: Dict[str, str] = {}
-    key = None
-    buf: List[str] = []
-
-    entry_re = re.compile(r"^\s*##\$(?P<key>[A-Za-z0-9_]+)\s*=\s*(?P<val>.*)\s*$")
-
-    def flush():
-        nonlocal key, buf
-        if key is not None:
-            data[key] = "\n".join(buf).strip()
-        key = None
-        buf = []
-
-    for line in lines:
-        m = entry_re.match(line)
-        if m:
-            flush()
-            key = m.group("key").strip()
-            buf = [m.group("val").strip()]
-        else:
-            if key is not None:
-                buf.append(line.rstrip("\n"))
-
-    flush()
-    return data
-
-
-def _extract_first_number(raw: Optional[str]) -> Optional[float]:
-    if raw is None:
-        return None
-    s = _strip_quotes(raw.strip()).replace("<", " ").replace(">", " ")
-    m = re.search(r"[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?", s)
-    if not m:
-        return None
-    try:
-        return float(m.group(0))
-    except Exception:
-        return None
-
-
-def _parse_excpulse_tuple_flip_angle(raw: Optional[str]) -> Optional[float]:
-    """
-    Parse flip angle from tuple like:
-      (1, 6000, 15, Yes, 4, ...)
-    We interpret the 3rd element as FA in degrees.
-    """
-    if raw is None:
-        return None
-    s = " ".join(raw.strip().split())
-    m = re.search(r"\((.*)\)", s)
-    if not m:
-        return None
-    inside = m.group(1).strip()
-    parts = [p.strip() for p in inside.split(",")]
-    if len(parts) < 3:
-        return None
-    fa_val = _extract_first_number(parts[2])
-    if fa_val is None:
-        return None
-    if 0 < fa_val < 180:
-        return fa_val
-    return None
-
-
-def default_adjacent_method_path(nifti_path: str) -> str:
-    base = os.path.basename(nifti_path)
-    d = os.path.dirname(os.path.abspath(nifti_path))
-    if base.endswith(".nii.gz"):
-        stem = base[:-7]
-    elif base.endswith(".nii"):
-        stem = base[:-4]
-    else:
-        stem = os.path.splitext(base)[0]
-    return os.path.join(d, f"{stem}.method")
-
-
-def infer_tr_seconds(d: Dict[str, str]) -> Tuple[Optional[float], str]:
-    tr_keys = ["PVM_RepetitionTime", "RepetitionTime", "PVM_TR", "TR"]
-    used = None
-    raw = None
-    for k in tr_keys:
-        if k in d:
-            raw = d[k]
-            used = k
-            break
-    tr_val = _extract_first_number(raw)
-    if tr_val is None:
-        return None, "TR not found"
-    if tr_val > 0.5:
-        tr_s = tr_val / 1000.0
-        return tr_s, f"TR from {used}={tr_val} (ms->s => {tr_s:.6g}s)"
-    return tr_val, f"TR from {used}={tr_val} (assumed s)"
-
-
-def infer_fa_degrees(d: Dict[str, str]) -> Tuple[Optional[float], str]:
-    scalar_keys = [
-        "PVM_FlipAngle", "FlipAngle",
-        "PVM_ExcPulseAngle", "PVM_ExcPulAngle",
-        "PVM_ExcFlipAngle", "PVM_ExFlipAngle",
-    ]
-    for k in scalar_keys:
-        if k in d:
-            v = _extract_first_number(d[k])
-            if v is not None and 0 < v < 180:
-                return v, f"FA from {k}={v}"
-
-    tuple_keys = ["ExcPulse1", "ExcPulse2", "ExcPulse", "PVM_ExcPulse1", "PVM_ExcPulse2", "PVM_ExcPulse"]
-    for k in tuple_keys:
-        if k in d:
-            v = _parse_excpulse_tuple_flip_angle(d[k])
-            if v is not None:
-                return v, f"FA from {k} tuple third field = {v}"
-
-    return None, "FA not found"
-
-
-def infer_tr_fa_from_method(method_path: str) -> Tuple[Optional[float], Optional[float], str]:
-    d = parse_bruker_method(method_path)
-    tr_s, tr_note = infer_tr_seconds(d)
-    fa, fa_note = infer_fa_degrees(d)
-    return tr_s, fa, f"{tr_note}; {fa_note}"
-
-
-# -------------------------
-# VFA regression
-# -------------------------
 
-def build_default_mask(vols: List[np.ndarray], frac: float = 0.05) -> np.ndarray:
-    comb = np.maximum.reduce(vols)
-    comb = comb[np.isfinite(comb)]
-    if comb.size == 0:
-        return np.zeros(vols[0].shape, dtype=np.uint8)
-    p = np.percentile(comb, 95)
-    thr = frac * p
-    return (np.maximum.reduce(vols) > thr).astype(np.uint8)
+import vfa_core
+import vfa_io
+from result_cache import CACHE_MODES, ResultCache
+from vfa_core import (
+    build_default_mask,
+    default_adjacent_method_path,
+    infer_tr_fa_from_method,
+    slab_depth_for_budget,
+    use_method_index,
+    vfa_fit_e1,
+)
+from vfa_io import LazyVolume, load_nifti, load_nifti_lazy, save_like
 
 
-def vfa_fit_e1_least_squares(
-    vols: List[np.ndarray],
-    fas_deg: List[float],
-    mask: Optional[np.ndarray],
-    e1_min: float,
-    e1_max: float,
-) -> Tuple[np.ndarray, np.ndarray]:
-    """
-    Fit E1 (slope) and intercept voxelwise using OLS for y = E1*x + b.
-    Returns (E1, b). Voxels failing mask get E1=nan, b=nan.
-    """
-    n = len(vols)
-    if n < 2:
-        raise ValueError("Need at least 2 flip angles.")
-
-    shape = vols[0].shape
-    for v in vols[1:]:
-        if v.shape != shape:
-            raise ValueError("All volumes must have same shape.")
-
-    fas = np.deg2rad(np.array(fas_deg, dtype=np.float64))
-    if np.any(fas <= 0) or np.any(fas >= np.pi):
-        raise ValueError("Flip angles must be in (0,180) degrees.")
-    sin_a = np.sin(fas)
-    tan_a = np.tan(fas)
-
-    # Stack into (n, vox)
-    V = np.stack([v.astype(np.float64, copy=False) for v in vols], axis=0)
-    vox = np.prod(shape)
-    V2 = V.reshape((n, vox))
-
-    X = (V2 / tan_a[:, None])
-    Y = (V2 / sin_a[:, None])
-
-    # Build good mask: positive signals across angles and finite
-    good = np.all(np.isfinite(X) & np.isfinite(Y), axis=0) & np.all(V2 > 0, axis=0)
-    if mask is not None:
-        good &= (mask.reshape(vox) != 0)
-
-    E1 = np.full(vox, np.nan, dtype=np.float64)
-    b = np.full(vox, np.nan, dtype=np.float64)
-
-    # OLS slope/intercept per voxel:
-    # E1 = cov(X,Y)/var(X)
-    # b  = mean(Y) - E1*mean(X)
-    Xg = X[:, good]
-    Yg = Y[:, good]
-
-    Xm = np.mean(Xg, axis=0)
-    Ym = np.mean(Yg, axis=0)
-    Xc = Xg - Xm
-    Yc = Yg - Ym
-
-    varX = np.sum(Xc * Xc, axis=0)
-    covXY = np.sum(Xc * Yc, axis=0)
-
-    # Avoid divide-by-zero (ill-conditioned when angles are too close / saturated)
-    ok = varX > 0
-    e1 = np.full(Xm.shape, np.nan, dtype=np.float64)
-    e1[ok] = covXY[ok] / varX[ok]
-    e1 = np.clip(e1, e1_min, e1_max)
-
-    bb = Ym - e1 * Xm
-
-    E1[good] = e1
-    b[good] = bb
-
-    return E1.reshape(shape), b.reshape(shape)
-
-
-def e1_to_t1(E1: np.ndarray, tr_s: float, fill: float = 0.0) -> np.ndarray:
-    T1 = np.full(E1.shape, fill, dtype=np.float64)
-    good = np.isfinite(E1) & (E1 > 0) & (E1 < 1)
-    T1[good] = -tr_s / np.log(E1[good])
-    return T1
-
-
-def load_nifti(path: str) -> Tuple[np.ndarray, nib.Nifti1Image]:
-    img = nib.load(path)
-    data = img.get_fdata(dtype=np.float32)
-    return data, img
+def sidecar_path(out_path: str, suffix: str) -> str:
+    """foo.nii.gz + '_rms' -> foo_rms.nii.gz (same folder and extension)."""
+    for ext in (".nii.gz", ".nii"):
+        if out_path.endswith(ext):
+            return out_path[: -len(ext)] + suffix + ext
+    return out_path + suffix + ".nii.gz"
 
 
 # -------------------------
 # CLI
 # -------------------------
 
-def parse_args():
+def parse_args(argv: Optional[List[str]] = None, require_out: bool = True):
     ap = argparse.ArgumentParser(description="Multi-flip-angle VFA T1 mapping (2+ angles) with optional Bruker .method parsing.")
     ap.add_argument("--imgs", nargs="+", required=True, help="List of NIfTI images at different flip angles (2 or more).")
-    ap.add_argument("--out", required=True, help="Output T1 map NIfTI (.nii or .nii.gz)")
+    ap.add_argument("--out", required=require_out, help="Output T1 map NIfTI (.nii or .nii.gz)")
 
     ap.add_argument("--fas", nargs="+", type=float, default=None, help="Flip angles in degrees, same count/order as --imgs")
     ap.add_argument("--tr", type=float, default=None, help="TR value (optional if parsed)")
     ap.add_argument("--tr-units", choices=["s", "ms"], default="s", help="Units for --tr if provided manually (default s)")
 
     ap.add_argument("--methods", nargs="+", default=None, help="Optional explicit .method files (same count/order as --imgs). If omitted, uses adjacent basename.method")
+    ap.add_argument("--method-index", default=None, help="Metadata index of parsed .method files (see vfa_method_index.py; default: $VFA_METHOD_INDEX)")
 
     ap.add_argument("--mask", default=None, help="Optional binary mask NIfTI")
     ap.add_argument("--auto-mask", action="store_true", help="Build a simple intensity mask if no --mask provided")
     ap.add_argument("--auto-mask-frac", type=float, default=0.05, help="Auto-mask threshold fraction of 95th percentile")
+    ap.add_argument("--auto-mask-fill-holes", action="store_true", help="Fill enclosed holes in the auto-mask (needs scipy)")
+    ap.add_argument("--auto-mask-largest", action="store_true", help="Keep only the largest connected component of the auto-mask (needs scipy)")
+
+    ap.add_argument("--b1map", default=None, help="Optional relative B1 map NIfTI (1.0 = nominal); each voxel's flip angles are scaled by it")
 
     ap.add_argument("--e1-min", type=float, default=1e-6)
     ap.add_argument("--e1-max", type=float, default=0.999999)
 
-    ap.add_argument("--require-same-tr", action="store_true", help="If TR is parsed from multiple methods, require they match.")
+    ap.add_argument("--fit", choices=["ols", "wls", "nlls"], default="ols", help="ols: linearized least squares (default); wls: DESPOT1-WLS (about 1.7x the OLS run time with the default 2 passes); nlls: Levenberg-Marquardt on the SPGR equation, seeded by OLS")
+    ap.add_argument("--wls-iter", type=int, default=2, help="Reweighting passes for --fit wls")
+    ap.add_argument("--nlls-max-iter", type=int, default=50, help="Max LM iterations for --fit nlls")
+    ap.add_argument("--nlls-tol", type=float, default=1e-6, help="Relative step/cost tolerance for --fit nlls")
+    ap.add_argument("--out-conv", default=None, help="NLLS convergence map (default: <out>_nlls_converged)")
+    ap.add_argument("--out-rms", default=None, help="NLLS RMS residual map (default: <out>_nlls_rms)")
 
-    return ap.parse_args()
+    ap.add_argument("--precision", choices=["float64", "float32"], default="float64", help="Compute dtype of the fit (default float64); float32 halves memory traffic, see vfa_precision_check.py")
 
+    ap.add_argument("--mem-budget-mb", type=float, default=None, help="Fit one z-slab at a time, keeping each slab's working set under this many MB (default: single pass)")
+    ap.add_argument("--workers", type=int, default=1, help="Number of threads fitting z-slabs concurrently (default 1)")
 
-def main():
-    args = parse_args()
+    ap.add_argument("--require-same-tr", action="store_true", help="If TR is parsed from multiple methods, require they match.")
 
-    if len(args.imgs) < 2:
-        raise SystemExit("ERROR: Provide at least 2 images via --imgs")
+    ap.add_argument("--cache", choices=CACHE_MODES, default="off", help="Skip the fit if inputs (compared by stat or sha256), TR/FAs, options and code match the manifest next to --out (default off)")
 
-    # Load images
-    vols = []
-    ref_img = None
-    for p in args.imgs:
-        v, im = load_nifti(p)
-        if ref_img is None:
-            ref_img = im
-            ref_shape = v.shape
-        else:
-            if v.shape != ref_shape:
-                raise SystemExit(f"ERROR: Shape mismatch: {p} has {v.shape}, expected {ref_shape}")
-        vols.append(v)
+    return ap.parse_args(argv)
 
-    # Mask
-    mask = None
-    if args.mask:
-        m, _ = load_nifti(args.mask)
-        if m.shape != ref_shape:
-            raise SystemExit(f"ERROR: Mask shape {m.shape} != image shape {ref_shape}")
-        mask = (m != 0).astype(np.uint8)
-    elif args.auto_mask:
-        mask = build_default_mask(vols, frac=args.auto_mask_frac)
 
+def resolve_tr_fa(args: argparse.Namespace) -> Tuple[float, List[float], List[str]]:
+    """
+    Resolve TR (seconds) and flip angles (degrees) from CLI values, falling back to
+    explicit --methods or adjacent .method files. Returns (tr_s, fas, details).
+    Raises SystemExit with an ERROR message if anything is missing or inconsistent.
+    """
     # Resolve TR
     tr_s = None
     if args.tr is not None:
@@ -401,31 +196,221 @@ def main():
                         + "\n".join(details)
                     )
 
-    # Fit E1 and compute T1
-    E1, intercept = vfa_fit_e1_least_squares(
+    return tr_s, [float(f) for f in fas], details
+
+
+def prepare(args: argparse.Namespace) -> Dict[str, object]:
+    """
+    Validate args and resolve TR/FAs without reading any image data.
+    Returns info with tr_s, fas and details; raises SystemExit with an ERROR message on bad inputs.
+    """
+    if len(args.imgs) < 2:
+        raise SystemExit("ERROR: Provide at least 2 images via --imgs")
+    if args.workers < 1:
+        raise SystemExit("ERROR: --workers must be >= 1")
+    if args.nlls_max_iter < 1:
+        raise SystemExit("ERROR: --nlls-max-iter must be >= 1")
+    if args.wls_iter < 1:
+        raise SystemExit("ERROR: --wls-iter must be >= 1")
+    for p in list(args.imgs) + [p for p in (args.mask, args.b1map) if p]:
+        if not os.path.isfile(p):
+            raise SystemExit(f"ERROR: Input not found: {p}")
+
+    if args.method_index:
+        use_method_index(args.method_index)
+    tr_s, fas, details = resolve_tr_fa(args)
+    return {"tr_s": tr_s, "fas": fas, "details": details}
+
+
+def load_inputs(
+    args: argparse.Namespace,
+    info: Optional[Dict[str, object]] = None,
+) -> Tuple[List[LazyVolume], object, Optional[np.ndarray], Optional[LazyVolume], Dict[str, object]]:
+    """
+    Open the images, mask and B1 map (after prepare(), unless its info is passed in).
+    Returns (vols, ref_img, mask, b1, info); info holds tr_s, fas, details, shape and occupancy.
+    Raises SystemExit with an ERROR message on bad inputs.
+    """
+    if info is None:
+        info = prepare(args)
+
+    # Load images (lazily; voxel data is read slab by slab during the fit)
+    vols = []
+    ref_img = None
+    for p in args.imgs:
+        v, im = load_nifti_lazy(p)
+        if ref_img is None:
+            ref_img = im
+            ref_shape = v.shape
+        else:
+            if v.shape != ref_shape:
+                raise SystemExit(f"ERROR: Shape mismatch: {p} has {v.shape}, expected {ref_shape}")
+        vols.append(v)
+
+    # Mask
+    mask = None
+    if args.mask:
+        m, _ = load_nifti(args.mask)
+        if m.shape != ref_shape:
+            raise SystemExit(f"ERROR: Mask shape {m.shape} != image shape {ref_shape}")
+        mask = (m != 0).astype(np.uint8)
+    elif args.auto_mask:
+        mask = build_default_mask(
+            vols,
+            frac=args.auto_mask_frac,
+            workers=args.workers,
+            fill_holes=args.auto_mask_fill_holes,
+            largest_component=args.auto_mask_largest,
+        )
+
+    # B1 map (read slab by slab like the images)
+    b1 = None
+    if args.b1map:
+        b1, _ = load_nifti_lazy(args.b1map)
+        if b1.shape != ref_shape:
+            raise SystemExit(f"ERROR: B1 map shape {b1.shape} != image shape {ref_shape}")
+
+    info["shape"] = ref_shape
+    info["occupancy"] = np.count_nonzero(mask) / mask.size if mask is not None else 1.0
+    return vols, ref_img, mask, b1, info
+
+
+def fit_t1(
+    args: argparse.Namespace,
+    vols: List[LazyVolume],
+    mask: Optional[np.ndarray],
+    b1: Optional[LazyVolume],
+    info: Dict[str, object],
+    precision: Optional[str] = None,
+) -> Dict[str, np.ndarray]:
+    """vfa_fit_e1() with the fit options in args (precision overrides args.precision)."""
+    return vfa_fit_e1(
         vols=vols,
-        fas_deg=[float(f) for f in fas],
+        fas_deg=info["fas"],
         mask=mask,
         e1_min=args.e1_min,
         e1_max=args.e1_max,
+        fit=args.fit,
+        mem_budget_mb=args.mem_budget_mb,
+        workers=args.workers,
+        wls_iter=args.wls_iter,
+        nlls_max_iter=args.nlls_max_iter,
+        nlls_tol=args.nlls_tol,
+        tr_s=info["tr_s"],
+        b1=b1,
+        precision=precision or args.precision,
     )
-    T1 = e1_to_t1(E1, tr_s=tr_s, fill=0.0).astype(np.float32)
 
-    out_img = nib.Nifti1Image(T1, affine=ref_img.affine, header=ref_img.header)
-    out_img.header.set_data_dtype(np.float32)
-    nib.save(out_img, args.out)
+
+def nlls_sidecar_paths(args: argparse.Namespace) -> Tuple[str, str]:
+    """(convergence map, RMS map) paths written by --fit nlls."""
+    return (
+        args.out_conv or sidecar_path(args.out, "_nlls_converged"),
+        args.out_rms or sidecar_path(args.out, "_nlls_rms"),
+    )
+
+
+def cache_params(args: argparse.Namespace, info: Dict[str, object]) -> Dict[str, object]:
+    """Everything besides the input files that the saved maps depend on."""
+    params = {
+        "tr_s": info["tr_s"],
+        "fas": info["fas"],
+        "fit": args.fit,
+        "e1_min": args.e1_min,
+        "e1_max": args.e1_max,
+        "precision": args.precision,
+        "auto_mask": None,
+    }
+    if not args.mask and args.auto_mask:
+        params["auto_mask"] = [args.auto_mask_frac, args.auto_mask_fill_holes, args.auto_mask_largest]
+    if args.fit == "wls":
+        params["wls_iter"] = args.wls_iter
+    if args.fit == "nlls":
+        params["nlls"] = [args.nlls_max_iter, args.nlls_tol]
+        # the sidecars are outputs too: asking for new paths must not hit the cache
+        params["sidecars"] = list(nlls_sidecar_paths(args))
+    return params
+
+
+def run(args: argparse.Namespace) -> Dict[str, object]:
+    """
+    Resolve TR/FAs, fit and save one T1 map for parsed CLI args.
+    Raises SystemExit with an ERROR message on bad inputs; returns a summary dict
+    ("cached" is True if --cache found the outputs up to date and nothing was fitted).
+    """
+    info = prepare(args)
+
+    cache = None
+    if args.cache != "off":
+        inputs = list(args.imgs) + [p for p in (args.mask, args.b1map) if p]
+        code = [__file__, vfa_core.__file__, vfa_io.__file__]
+        cache = ResultCache(args.out, args.cache, inputs, cache_params(args, info), code)
+        if cache.fresh() and cache.result is not None:
+            return dict(cache.result, cached=True)
+        cache.invalidate()
+
+    vols, ref_img, mask, b1, info = load_inputs(args, info)
+    fit = fit_t1(args, vols, mask, b1, info)
+    T1 = fit["T1"].astype(np.float32, copy=False)
+
+    save_like(T1, ref_img, args.out)
+    outputs = [args.out]
+
+    if args.fit == "nlls":
+        conv = fit["converged"]
+        rms = fit["rms"]
+        fitted = np.isfinite(conv)
+        info["conv_path"], info["rms_path"] = nlls_sidecar_paths(args)
+        info["converged_frac"] = float(np.mean(conv[fitted])) if fitted.any() else 0.0
+        save_like(np.where(fitted, conv, 0).astype(np.uint8), ref_img, info["conv_path"])
+        save_like(np.where(fitted, rms, 0).astype(np.float32), ref_img, info["rms_path"])
+        outputs += [info["conv_path"], info["rms_path"]]
+
+    if cache is not None:
+        cache.store(outputs, result=info)
+    info["cached"] = False
+    return info
+
+
+def print_summary(args: argparse.Namespace, info: Dict[str, object]) -> None:
+    tr_s = info["tr_s"]
+    fas = info["fas"]
+    details = info["details"]
 
     print("=== Multi-angle VFA T1 mapping ===")
+    if info.get("cached"):
+        print(f"Cache: {args.out} is up to date ({args.cache}); fit skipped")
     print(f"TR  : {tr_s:.6g} s")
     print(f"FAs : {', '.join(str(f) for f in fas)} deg")
     print(f"Imgs: {len(args.imgs)}")
     print(f"Out : {args.out}")
+    if args.fit == "nlls":
+        print(f"Fit : nlls ({100 * info['converged_frac']:.1f}% converged)")
+        print(f"Conv: {info['conv_path']}")
+        print(f"RMS : {info['rms_path']}")
+    elif args.fit == "wls":
+        print(f"Fit : wls ({args.wls_iter} reweighting passes)")
+    else:
+        print("Fit : ols")
+    if args.precision != "float64":
+        print(f"Prec: {args.precision}")
     if args.mask:
         print(f"Mask: {args.mask}")
     elif args.auto_mask:
-        print(f"Mask: auto (frac={args.auto_mask_frac})")
+        cleanup = [c for c, on in (("fill holes", args.auto_mask_fill_holes), ("largest component", args.auto_mask_largest)) if on]
+        print(f"Mask: auto (frac={args.auto_mask_frac}{''.join(', ' + c for c in cleanup)})")
     else:
         print("Mask: none")
+    if args.b1map:
+        print(f"B1  : {args.b1map}")
+    if args.mem_budget_mb is not None:
+        depth = slab_depth_for_budget(
+            info["shape"], len(args.imgs), args.mem_budget_mb / args.workers, args.fit, bool(args.b1map),
+            args.precision, info["occupancy"],
+        )
+        print(f"Slab: {depth} planes (budget {args.mem_budget_mb:g} MB)")
+    if args.workers > 1:
+        print(f"Workers: {args.workers}")
     if details:
         print("--- method parsing ---")
         for d in details:
@@ -433,5 +418,11 @@ def main():
     print("Done.")
 
 
+def main():
+    args = parse_args()
+    info = run(args)
+    print_summary(args, info)
+
+
 if __name__ == "__main__":
     main()